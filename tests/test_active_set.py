@@ -0,0 +1,60 @@
+import numpy as np
+import scipy.sparse as sp
+
+from transit_circuits.active_set import ActiveSetSolver
+from transit_circuits.generators import make_grid_network, make_random_OD
+from transit_circuits.sparse_circuit import SparseCircuit
+from transit_circuits.transit_network import TransitNetwork
+
+def _incidence(edges, n):
+    edges = np.asarray(edges)
+    rows = np.repeat(np.arange(len(edges)), 2)
+    return sp.csr_matrix((np.tile([1., -1.], len(edges)), (rows, edges.ravel())), shape=(len(edges), n))
+
+def test_active_set_solver():
+    # A current of 10 from node 0 (ground) to node 3, through a diode 0 -> 1 and a resistor 1 -> 3 of
+    # conductance 1/2, in parallel with a diode 2 -> 0 that blocks the resistor 2 -> 3.
+    A_R = _incidence([(1, 3), (2, 3)], 4)
+    P = A_R.T @ sp.diags([1/2, 2]) @ A_R
+    q = np.array([-10., 0, 0, 10])
+    A = _incidence([(0, 1), (2, 0)], 4)
+
+    solver = ActiveSetSolver()
+    v, status = solver.solve(P, q, A, [0])
+    assert status == 'solved'
+    assert np.isclose(v[0] - v[3], 20)
+    assert np.all(A @ v <= 1e-9)
+
+    v_warm, _ = solver.solve(P, 2 * q, A, [0])
+    assert solver.n_iter == 1
+    assert np.allclose(v_warm, 2 * v)
+
+def test_active_set_solver_grid():
+    tn = TransitNetwork(*make_grid_network(10, 10, 6))
+    OD = make_random_OD(len(tn.stations), 1, seed=0).tocoo()
+    circuit = SparseCircuit(tn, 'ACTIVE_SET')
+    reference = SparseCircuit(tn, 'CLARABEL')
+
+    n_iter, n_fallbacks = [], 0
+    for o, d, flow in list(zip(OD.row.tolist(), OD.col.tolist(), OD.data.tolist()))[:100]:
+        v, status = circuit.solve(o, d, flow)
+        # The few that do not settle fall back to Clarabel.
+        assert status in ('solved', 'Solved')
+        n_fallbacks += status != 'solved'
+        n_iter.append(circuit.active_set.n_iter)
+        v_ref, _ = reference.solve(o, d, flow)
+        assert np.allclose(circuit.A_R @ v, reference.A_R @ v_ref, atol=1e-3 * flow)
+    assert np.mean(n_iter) < 10 and n_fallbacks <= 3
+
+def test_active_set_warm_start_ids():
+    A_R = _incidence([(1, 3), (2, 3)], 4)
+    P = A_R.T @ sp.diags([1/2, 2]) @ A_R
+    q = np.array([-10., 0, 0, 10])
+    A = _incidence([(0, 1), (2, 0)], 4)
+
+    solver = ActiveSetSolver()
+    solver.solve(P, q, A, [0], key=3, ids=[7, 5])
+    # The same diodes in the other order start from their own states.
+    v, _ = solver.solve(P, q, A[::-1], [0], key=3, ids=[5, 7])
+    assert solver.n_iter == 1
+    assert np.isclose(v[0] - v[3], 20)
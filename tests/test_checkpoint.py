@@ -0,0 +1,145 @@
+import time
+import os
+
+import numpy as np
+import pytest
+
+from transit_circuits.checkpoint import Checkpoint, WorkQueue
+from transit_circuits.generators import make_grid_network, make_random_OD
+from transit_circuits.instrumentation import SolveStats
+from transit_circuits.solution_cache import ODSolution
+from transit_circuits.transit_network import TransitNetwork
+
+def _solution(i):
+    return ODSolution(np.full(3, i, dtype=float), np.full(2, -i, dtype=float), np.arange(i + 1.), np.ones(2 - i % 2), 2. * i)
+
+def test_checkpoint_chunks(tmp_path):
+    checkpoint = Checkpoint(tmp_path, every=2)
+    for i in range(5):
+        checkpoint.add('a', i, i + 1, 10. * i, _solution(i))
+    assert len(list((tmp_path / 'a').iterdir())) == 2
+    checkpoint.flush()
+    checkpoint.add('b', 0, 1, 1., _solution(0))
+    checkpoint.flush()
+
+    solutions = Checkpoint(tmp_path).load('a')
+    assert sorted(solutions) == [(i, i + 1) for i in range(5)]
+    for i in range(5):
+        flow, solution = solutions[i, i + 1]
+        assert flow == 10. * i
+        for loaded, saved in zip(solution, _solution(i)):
+            assert np.array_equal(loaded, saved)
+    assert list(Checkpoint(tmp_path).load('b')) == [(0, 1)]
+    assert Checkpoint(tmp_path).load('c') == {}
+
+    # Loading again only reads the chunk files written since, by this checkpoint or another one.
+    reader = Checkpoint(tmp_path)
+    assert len(reader.load('a')) == 5
+    checkpoint.add('a', 5, 6, 50., _solution(5))
+    checkpoint.flush()
+    reader.add('a', 6, 7, 60., _solution(6))
+    reader.flush()
+    assert sorted(reader.load('a'))[-2:] == [(5, 6), (6, 7)]
+    assert len(reader._index['a'][0]) == 5
+    # The checkpoint only keeps the index of its OD pairs, and reads the solutions asked for.
+    assert all(len(entry) == 3 for entry in reader._index['a'][1].values())
+    assert list(reader.load('a', [(6, 7), (9, 9)])) == [(6, 7)]
+
+    checkpoint.clear()
+    assert checkpoint.load('a') == {}
+
+def test_work_queue(tmp_path):
+    queue = WorkQueue(tmp_path)
+    tasks = [(o, d, float(o + d)) for o in range(3) for d in range(3) if o != d]
+    queue.put(tasks, 4)
+    assert queue.counts() == {'pending': 4, 'claimed': 0, 'done': 0}
+
+    claimed = []
+    while (shard := queue.claim()) is not None:
+        claimed.append(shard)
+    assert len(claimed) == 4 and len(queue) == 0
+    assert [task for _, shard in claimed for task in shard] == tasks
+
+    queue.complete(claimed[0][0])
+    assert queue.requeue_stale(3600) == 0
+    assert queue.requeue_stale(-1) == 3
+    assert queue.counts() == {'pending': 3, 'claimed': 0, 'done': 1}
+    assert not any(queue.requeued(name) for name, _ in claimed)
+
+    # Requeued shards keep their OD pairs and count how often they were requeued.
+    name, shard = queue.claim()
+    assert name == 'shard-000001.r1.npy' and queue.requeued(name) and shard == claimed[1][1]
+    queue.requeue_stale(-1)
+    assert queue.claim()[0] == 'shard-000001.r2.npy'
+
+def test_work_queue_heartbeat(tmp_path):
+    queue = WorkQueue(tmp_path)
+    queue.put([(0, 1, 1.)], 1)
+    name, _ = queue.claim()
+    path = tmp_path / 'claimed' / name
+    os.utime(path, (0, 0))
+    with queue.heartbeat(name, 0.01):
+        time.sleep(0.2)
+        assert queue.requeue_stale(60) == 0
+    assert time.time() - os.path.getmtime(path) < 60
+
+def test_calculate_flows_resume(tmp_path):
+    tn = TransitNetwork(*make_grid_network(3, 3))
+    OD = make_random_OD(len(tn.stations), 0.5, seed=0)
+    tn.calculate_flows(OD, engine='sparse')
+    currents = [r.total_current for r in tn.compile().resistors]
+    tn.reset()
+
+    class Interrupted(Exception):
+        pass
+    def interrupt(record, n=[0]):
+        n[0] += 1
+        if n[0] == 10:
+            raise Interrupted()
+    with pytest.raises(Interrupted):
+        tn.calculate_flows(OD, engine='sparse', checkpoint=Checkpoint(tmp_path, every=4), callback=interrupt)
+    tn.reset()
+
+    stats = SolveStats()
+    tn.calculate_flows(OD, engine='sparse', checkpoint=tmp_path, resume=True, callback=stats)
+    # The chunks written before the interruption, and the one flushed by it.
+    assert sum(r.status == 'cached' for r in stats.records) == 10
+    assert np.allclose([r.total_current for r in tn.compile().resistors], currents, atol=1e-3)
+    with pytest.raises(ValueError):
+        tn.calculate_flows(OD, resume=True)
+
+def test_run_queue(tmp_path):
+    D, stations, lines = make_grid_network(3, 3)
+    OD = make_random_OD(len(stations), 0.5, seed=0).tocoo()
+    tn = TransitNetwork(D, stations, lines)
+    tn.calculate_flows(OD, engine='sparse')
+    currents = [r.total_current for r in tn.compile().resistors]
+
+    queue = WorkQueue(tmp_path / 'queue')
+    queue.put(list(zip(OD.row.tolist(), OD.col.tolist(), OD.data.tolist())), 5)
+    # Two processes sharing the queue and the checkpoint, the first of which stops during its second shard.
+    class Interrupted(Exception):
+        pass
+    def interrupt(record, n=[0]):
+        n[0] += 1
+        if n[0] == 10:
+            raise Interrupted()
+    with pytest.raises(Interrupted):
+        TransitNetwork(D, stations, lines).run_queue(queue, Checkpoint(tmp_path / 'checkpoint', every=1),
+                                                     engine='sparse', callback=interrupt)
+    assert queue.requeue_stale(-1) == 1
+    tn = TransitNetwork(D, stations, lines)
+    tn.calculate_flows(OD.tocsr()[:1], engine='sparse')
+    trips = {(o, d): t for o, ds in tn.trips.items() for d, t in ds.items()}
+    stats = SolveStats()
+    assert tn.run_queue(tmp_path / 'queue', tmp_path / 'checkpoint', engine='sparse', callback=stats) == 4
+    assert queue.counts() == {'pending': 0, 'claimed': 0, 'done': 5}
+    # Only the requeued shard reads the OD pairs checkpointed before the interruption.
+    assert sum(r.status == 'cached' for r in stats.records) == 3
+    assert {(o, d): t for o, ds in tn.trips.items() for d, t in ds.items()} == trips
+
+    tn = TransitNetwork(D, stations, lines)
+    stats = SolveStats()
+    tn.calculate_flows(OD, checkpoint=tmp_path / 'checkpoint', resume=True, callback=stats)
+    assert {r.status for r in stats.records} == {'cached'}
+    assert np.allclose([r.total_current for r in tn.compile().resistors], currents, atol=1e-3)
@@ -0,0 +1,115 @@
+import numpy as np
+import pytest
+
+from transit_circuits.compiled_network import CompiledNetwork
+from transit_circuits.transit_network import Line, Station, TransitNetwork
+from transit_circuits.generators import make_grid_network
+
+def _make_cross():
+    D = np.array([
+        [0, 10, -1, -1, -1],
+        [10, 0, 8, 5, 4],
+        [-1, 8, 0, -1, -1],
+        [-1, 5, -1, 0, -1],
+        [-1, 4, -1, -1, 0]
+    ])
+    stations = [Station(i) for i in range(D.shape[0])]
+    lines = [
+        Line(0, [stations[0], stations[1], stations[2]], avg_speed_kph=10, frequency_vph=1),
+        Line(1, [stations[3], stations[1], stations[4]], avg_speed_kph=20, frequency_vph=2)
+    ]
+    return D, stations, lines
+
+def test_compiled_network_cross():
+    D, stations, lines = _make_cross()
+    tn = TransitNetwork(D, stations, lines)
+    c = CompiledNetwork(tn)
+
+    assert c.n_segments == 12
+    assert len(c.resistors) == 8 + 8
+    assert len(c.diodes) == 12 + 8
+    assert c.n_nodes == 2 * 12 + 8
+    assert np.array_equal(c.station_segments[1], [2, 3, 4, 5])
+    assert np.allclose(c.station_origin_C[1], [2/60, 2/60, 4/60, 4/60])
+
+    k = c.segment_index(stations[0], lines[0], +1)
+    r = stations[0].lines[lines[0]][+1].tt_resistor
+    assert c.resistors[c.segment_resistor[k]] is r
+    assert np.isclose(c.segment_C[k], r.C)
+    assert c.segment_resistor[c.segment_index(stations[0], lines[0], -1)] == -1
+
+    assert np.allclose(c.A_R.sum(axis=1), 0)
+    assert np.all(c.transfer_station == 1)
+    assert np.all(c.segment_station[c.transfer_from] == c.segment_station[c.transfer_to])
+    assert np.all(c.segment_line[c.transfer_from] != c.segment_line[c.transfer_to])
+
+def test_compiled_network_read_only():
+    D, stations, lines = _make_cross()
+    tn = TransitNetwork(D, stations, lines)
+    c = tn.compile()
+
+    assert tn.compile() is c
+    with pytest.raises(ValueError):
+        c.segment_C[0] = 1
+    with pytest.raises(ValueError):
+        c.station_segments[0][0] = 1
+
+    tn.update_frequency(lines[0], frequency_vph=6)
+    assert tn.compile() is c
+    with pytest.raises(ValueError):
+        c.resistor_C[0] = 1
+
+def test_compiled_network_update_line():
+    D, stations, lines = _make_cross()
+    tn = TransitNetwork(D, stations, lines)
+    c = tn.compile()
+
+    tn.update_frequency(lines[1], frequency_vph=30)
+    tn.update_speed(lines[0], avg_speed_kph=20)
+    fresh = CompiledNetwork(tn)
+    assert np.allclose(c.resistor_C, fresh.resistor_C)
+    assert np.allclose(c.segment_C, fresh.segment_C)
+    for C, C_fresh in zip(c.station_origin_C, fresh.station_origin_C):
+        assert np.allclose(C, C_fresh)
+
+def _make_hub(n_lines):
+    # Every line runs from its own outer station through the hub, station 0.
+    D = np.full((n_lines + 1, n_lines + 1), -1)
+    D[0, 1:] = D[1:, 0] = 5
+    stations = [Station(i) for i in range(n_lines + 1)]
+    lines = [Line(i, [stations[i + 1], stations[0]], frequency_vph=i + 1) for i in range(n_lines)]
+    return D, stations, lines
+
+@pytest.mark.parametrize("n_lines", [2, 6])
+def test_compiled_network_compact_transfers(n_lines):
+    c = CompiledNetwork(TransitNetwork(*_make_hub(n_lines)))
+    c_compact = CompiledNetwork(TransitNetwork(*_make_hub(n_lines), compact_transfers=True))
+
+    n_travel = 2 * n_lines
+    assert len(c.resistors) == n_travel + 4 * n_lines * (n_lines - 1)
+    assert len(c_compact.resistors) == n_travel + 2 * n_lines
+    # Travel direction, boarding and alighting diodes, then the prefix and suffix chains.
+    assert len(c_compact.diodes) == 4 * n_lines + 2 * n_lines + 2 * n_lines + 4 * (n_lines - 1) + 2 * (n_lines - 2)
+    assert np.all(c_compact.transfer_from == -1)
+    assert np.all(c_compact.segment_station[c_compact.transfer_to] == 0)
+
+def test_compiled_network_od_nodes():
+    D, stations, lines = _make_cross()
+    c = TransitNetwork(D, stations, lines).compile()
+    keep = c.od_nodes(0, 2)
+    # Line 0 has no segment leaving station 0 backwards nor station 2 forwards, nor can the trip use them.
+    for k in (c.segment_index(stations[0], lines[0], -1), c.segment_index(stations[2], lines[0], +1)):
+        assert not keep[c.segment_v_diode(k)]
+    assert keep[c.segment_v_diode(c.segment_index(stations[0], lines[0], +1))]
+    assert keep.sum() < c.n_nodes
+
+def test_compiled_network_pass_through():
+    D, stations, lines = make_grid_network(5, 5, n_lines=2)
+    tn = TransitNetwork(D, stations, lines)
+    c = tn.compile()
+    # A row and a column meeting at their first stop: every stop but their ends is a pass-through stop.
+    n_lines = np.array([len(s.lines) for s in tn.stations])[c.segment_station]
+    interior = np.array([0 < line.stations.index(c.stations[i]) < len(line.stations) - 1
+                         for i, line in zip(c.segment_station, np.array(c.lines)[c.segment_line])])
+    assert np.array_equal(c.pass_through, (n_lines == 1) & interior)
+    assert c.pass_through.sum() == 2 * 3 * 2
@@ -1,6 +1,7 @@
 import pytest
 import cvxpy as cp
-from transit_circuits.components import Resistor, Diode, CurrentSource  # Assuming the code is saved in `components.py`
+import numpy as np
+from transit_circuits.components import Node, Resistor, Diode, CurrentSource  # Assuming the code is saved in `components.py`
 
 def test_resistor_energy():
     source = cp.Variable()
@@ -63,3 +64,52 @@ def test_current_source_initialization():
     assert str(current_source.source) == str(source)
     assert str(current_source.drain) == str(drain)
     assert current_source.I == i
+
+def test_component_history():
+    resistor = Resistor(0.5, cp.Variable(), cp.Variable())
+    voltages = np.arange(100, dtype=float)
+    for v in voltages:
+        resistor.cache(v)
+
+    assert np.array_equal(resistor.history, voltages)
+    assert resistor.last_voltage == voltages[-1]
+    assert resistor.n_cached == len(voltages)
+    assert np.isclose(resistor.total_current, 0.5 * np.sum(voltages))
+
+    resistor.reset()
+    assert len(resistor.history) == 0
+    assert resistor.total_current == 0
+
+def test_component_reserve():
+    diode = Diode(cp.Variable(), cp.Variable())
+    diode.reserve(1000)
+    buffer = diode._history
+    for v in range(1000):
+        diode.cache(v)
+
+    assert diode._history is buffer
+    assert np.array_equal(diode.history, np.arange(1000))
+
+def test_component_aggregates_only():
+    resistor = Resistor(2, cp.Variable(), cp.Variable())
+    resistor.keep_history = False
+    resistor.cache(3)
+    resistor.cache(4)
+
+    assert len(resistor.history) == 0
+    assert resistor.last_voltage == 4
+    assert resistor.n_cached == 2
+    assert resistor.total_current == 14
+
+def test_node_variable():
+    source, drain = Node(), Node()
+    resistor = Resistor(0.5, source, drain)
+    assert source._variable is None and source.value is None
+
+    # The Variables are created with the nodes' ids once an expression needs them.
+    assert str(resistor.energy) == str(0.5 * 0.5 * cp.power(source.variable - drain.variable, 2))
+    assert source.variable.id == source.id and source.variable is source.variable
+    source.value = 3.
+    drain.value = 1.
+    assert resistor.voltage.value == 2.
+
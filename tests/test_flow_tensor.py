@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from transit_circuits.flow_tensor import FlowTensor
+
+def _fill(tensor):
+    tensor.set_od(0, 1, [1., 0., 2., 0.])
+    tensor.set_od(0, 2, [0., 3., 0., 0.])
+    tensor.set_od(2, 1, [4., 0., 0., 5.])
+
+@pytest.mark.parametrize("layout", FlowTensor.LAYOUTS)
+def test_flow_tensor(layout):
+    tensor = FlowTensor(3, 4, layout=layout)
+    _fill(tensor)
+
+    assert np.array_equal(tensor.get_od(0, 1), [1., 0., 2., 0.])
+    assert np.array_equal(tensor.get_od(1, 0), np.zeros(4))
+    assert tensor.get(2, 1, 3) == 5.
+    assert np.array_equal(tensor.total(), [5., 3., 2., 5.])
+    assert np.array_equal(tensor.total(origins=[0]), [1., 3., 2., 0.])
+    assert np.array_equal(tensor.total(destinations=[1]), [5., 0., 2., 5.])
+    assert tensor.saved.sum() == 3
+
+def test_flow_tensor_layouts_match():
+    dense = FlowTensor(3, 4, dtype=np.float32)
+    sparse = FlowTensor(3, 4, dtype=np.float32, layout='sparse')
+    _fill(dense)
+    _fill(sparse)
+
+    assert sparse.to_dense().dtype == np.float32
+    assert np.array_equal(dense.to_dense(), sparse.to_dense())
+    assert sparse.nbytes < dense.nbytes
+
+@pytest.mark.parametrize("layout", FlowTensor.LAYOUTS)
+def test_flow_tensor_arrays(layout):
+    tensor = FlowTensor(3, 4, np.float32, layout)
+    _fill(tensor)
+    restored = FlowTensor.from_arrays(tensor.to_arrays())
+    assert restored.layout == layout and restored.dtype == np.float32
+    assert np.array_equal(restored.to_dense(), tensor.to_dense())
+    assert np.array_equal(restored.saved, tensor.saved)
+    assert np.array_equal(restored.total(origins=[0]), tensor.total(origins=[0]))
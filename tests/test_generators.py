@@ -0,0 +1,66 @@
+import json
+
+import numpy as np
+import pytest
+
+from transit_circuits.generators import make_grid_network, make_radial_network, make_random_OD
+from transit_circuits.benchmark import run_benchmarks, _time_od
+from transit_circuits.transit_network import TransitNetwork
+
+def test_make_grid_network():
+    D, stations, lines = make_grid_network(3, 4)
+    assert len(stations) == 12
+    assert len(lines) == 3 + 4
+    assert sorted(len(l.stations) for l in lines) == [3, 3, 3, 3, 4, 4, 4]
+    assert D[0, 1] == 1 and D[0, 4] == 1 and D[0, 5] == -1
+
+    D, stations, lines = make_grid_network(3, 4, n_lines=2)
+    assert len(lines) == 2
+    assert len(stations) == 4 + 3 - 1
+
+def test_make_radial_network():
+    D, stations, lines = make_radial_network(2, 6)
+    assert len(stations) == 1 + 2 * 6
+    assert len(lines) == 6 + 2
+    assert sum(stations[0] in l.stations for l in lines) == 6
+
+@pytest.mark.parametrize("make_network", [make_grid_network, make_radial_network])
+def test_transfer_density(make_network):
+    D, stations, lines = make_network(4, 4)
+    D_sparse, stations_sparse, lines_sparse = make_network(4, 4, transfer_density=0, seed=0)
+    n_stops = sum(len(l.stations) for l in lines)
+    n_stops_sparse = sum(len(l.stations) for l in lines_sparse)
+    assert len(stations_sparse) == len(stations)
+    assert n_stops_sparse < n_stops
+
+    # Dropped stops never disconnect the network, so every OD pair has a finite solution.
+    tn = TransitNetwork(D_sparse, stations_sparse, lines_sparse)
+    tn.calculate_flows(make_random_OD(len(stations_sparse), 0.2, seed=0), engine='sparse')
+    assert np.all(np.isfinite(tn.compile().total_segment_currents()))
+
+def test_make_random_OD():
+    OD = make_random_OD(20, od_density=0.25, max_flow=10, seed=0)
+    assert OD.shape == (20, 20)
+    assert OD.diagonal().sum() == 0
+    assert 0.15 < OD.nnz / (20 * 19) < 0.35
+    assert np.all((OD.data >= 1) & (OD.data <= 10))
+
+def test_run_benchmarks():
+    report = run_benchmarks('radial', [(1, 4)], engines=['sparse'], max_od=5)
+    result = report['results'][0]
+    assert result['n_stations'] == 5
+    assert result['n_od'] == 5
+    assert set(result['engines']['sparse']) == {'build_s', 'canonicalize_s', 'solve_s', 'total_s', 'peak_memory_mb'}
+    json.dumps(report)
+
+def test_time_od_prunes(monkeypatch):
+    # The cvxpy engine is timed on the pruned circuit that calculate_flows solves.
+    pruned = []
+    build_subcircuit = TransitNetwork._build_subcircuit
+    def _build_subcircuit(self, *args, prune=False):
+        pruned.append(prune)
+        return build_subcircuit(self, *args, prune=prune)
+    monkeypatch.setattr(TransitNetwork, '_build_subcircuit', _build_subcircuit)
+    phases = _time_od(TransitNetwork(*make_grid_network(3, 3)), 0, 8, 10., 'cvxpy')
+    assert pruned == [True]
+    assert all(phases[phase] > 0 for phase in ('build', 'canonicalize', 'solve'))
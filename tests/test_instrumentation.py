@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from transit_circuits.instrumentation import ODStats, SolveStats
+from transit_circuits.generators import make_grid_network, make_random_OD
+from transit_circuits.transit_network import TransitNetwork
+
+@pytest.mark.parametrize("engine", ['cvxpy', 'parametric', 'sparse'])
+def test_solve_stats(engine):
+    tn = TransitNetwork(*make_grid_network(2, 2))
+    OD = make_random_OD(len(tn.stations), 0.5, seed=0)
+    stats = SolveStats()
+    tn.calculate_flows(OD, engine=engine, callback=stats, _save_disaggregated=True)
+
+    assert len(stats) == OD.nnz
+    for r in stats.records:
+        assert r.engine == engine and r.status.lower() in ('solved', 'optimal')
+        assert r.n_iter > 0 and r.build_s > 0 and r.solve_s > 0 and r.cache_s > 0 and r.save_s > 0
+        assert (r.compile_s is None) == (engine == 'sparse')
+        assert r.flow == OD[r.origin, r.destination]
+    assert (stats.totals()['compile_s'] > 0) == (engine != 'sparse')
+    assert engine in stats.summary().splitlines()[1]
+
+def test_solve_stats_cached():
+    tn = TransitNetwork(*make_grid_network(2, 2))
+    OD = make_random_OD(len(tn.stations), 0.5, seed=0)
+    tn.calculate_flows(OD, engine='sparse', use_cache=True)
+    stats = SolveStats()
+    tn.calculate_flows(OD, engine='sparse', use_cache=True, callback=stats)
+    assert {r.status for r in stats.records} == {'cached'}
+    assert all(r.solve_s is None and r.cache_s > 0 for r in stats.records)
+
+def test_od_stats_defaults():
+    r = ODStats(0, 1, 2., 'sparse')
+    assert r.status is None and r.n_iter is None and r.build_s is None
+    assert SolveStats().summary().split() == ['engine', 'status', 'n_od', 'n_iter', 'build_ms', 'compile_ms', 'solve_ms', 'cache_ms', 'save_ms']
+
+def test_solve_stats_sparse_reduced():
+    tn = TransitNetwork(*make_grid_network(5, 5, 2))
+    OD = make_random_OD(len(tn.stations), 0.5, seed=0)
+    tn.calculate_flows(OD, engine='sparse')
+    currents = tn.compile().total_segment_currents()
+    tn.reset()
+
+    # The instrumented path solves the same pruned and reduced QPs.
+    circuit = tn._get_sparse_circuit()
+    circuit.n_pruned = circuit.n_reduced = 0
+    stats = SolveStats()
+    tn.calculate_flows(OD, engine='sparse', callback=stats)
+    assert circuit.n_pruned > 0 and circuit.n_reduced > 0
+    assert all(r.build_s > 0 and r.solve_s > 0 for r in stats.records)
+    assert np.allclose(tn.compile().total_segment_currents(), currents, atol=1e-6)
@@ -1,8 +1,10 @@
 from transit_circuits.optimization import Problem
 from transit_circuits.components import Resistor, Diode, CurrentSource
+from transit_circuits.active_set import ActiveSetSolver
 
 import cvxpy as cp
 import numpy as np
+import pytest
 
 def _make_resistors():
     R = [Resistor(1, 1, 0), Resistor(2, 1, 0), Resistor(3, 1, 0)]
@@ -159,3 +161,43 @@ def test_parallel():
     p.solve()
     
     assert np.isclose(V_0.value - V_1.value, 2, rtol=0, atol=1e-10)
+
+def test_active_set_parallel_opposing_diode():
+    V_0, V_1, V_2, V_3 = cp.Variable(), cp.Variable(), cp.Variable(), cp.Variable()
+
+    p = Problem()
+    p.add_current_source(CurrentSource(10, V_3, V_0))
+    p.add_diode(Diode(V_0, V_1), Diode(V_2, V_0))
+    p.add_resistor(Resistor(1/2, V_1, V_3), Resistor(1/0.5, V_2, V_3))
+    p.add_ground(V_2)
+
+    p.solve('ACTIVE_SET')
+
+    assert np.isclose(V_0.value - V_3.value, 20, rtol=0, atol=1e-6)
+    assert np.isclose(p.resistors[1].last_voltage, 0, rtol=0, atol=1e-6)
+
+def test_active_set_requires_ground():
+    V_0, V_1 = cp.Variable(), cp.Variable()
+
+    p = Problem()
+    p.add_current_source(CurrentSource(10, V_1, V_0))
+    p.add_resistor(Resistor(2, V_0, V_1))
+
+    with pytest.raises(ValueError):
+        p.solve('ACTIVE_SET')
+
+def test_active_set_falls_back():
+    V_0, V_1, V_2, V_3 = cp.Variable(), cp.Variable(), cp.Variable(), cp.Variable()
+
+    p = Problem()
+    p.add_current_source(CurrentSource(10, V_3, V_0))
+    p.add_diode(Diode(V_0, V_1), Diode(V_2, V_0))
+    p.add_resistor(Resistor(1/2, V_1, V_3), Resistor(1/0.5, V_2, V_3))
+    p.add_ground(V_2)
+
+    # Starting with both diodes conducting, a single linear solve cannot settle.
+    stats = {}
+    p.solve('ACTIVE_SET', ActiveSetSolver(max_iter=1), stats)
+
+    assert stats['status'] == 'optimal'
+    assert np.isclose(V_0.value - V_3.value, 20, rtol=0, atol=1e-6)
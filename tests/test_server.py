@@ -0,0 +1,88 @@
+from concurrent.futures import ThreadPoolExecutor
+import http.client
+import threading
+import json
+
+import numpy as np
+import pytest
+
+from transit_circuits.generators import make_grid_network, make_random_OD
+from transit_circuits.server import NetworkService, ServiceBusy, make_server
+from transit_circuits.transit_network import TransitNetwork
+
+def _od(tn):
+    OD = make_random_OD(len(tn.stations), 0.5, seed=0).tocoo()
+    return list(zip(OD.row.tolist(), OD.col.tolist(), OD.data.tolist()))
+
+@pytest.fixture
+def server():
+    service = NetworkService(TransitNetwork(*make_grid_network(3, 3)))
+    server = make_server(service)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def _request(server, method, path, body=None):
+    connection = http.client.HTTPConnection(*server.server_address)
+    connection.request(method, path, None if body is None else json.dumps(body))
+    response = connection.getresponse()
+    data = json.loads(response.read())
+    connection.close()
+    return response.status, data
+
+def test_service_queries():
+    D, stations, lines = make_grid_network(3, 3)
+    service = NetworkService(TransitNetwork(D, stations, lines))
+    with pytest.raises(ValueError):
+        service.segment_flow()
+    od = _od(service.network)
+    result = service.flows(od)
+    assert result['version'] == 1 and result['n_od'] == len(od)
+
+    line = lines[0]
+    station = stations.index(line.stations[0])
+    k = service.network.get_segment_index(line.stations[0], line, 1)
+    assert service.segment_flow(station, line.id, 1)['flow'] == result['segment_flows'][k]
+    assert service.flows(od)['segment_flows'] == pytest.approx(result['segment_flows'], abs=1e-3)
+
+    # The flows are solved again under the new frequency when they are read.
+    assert service.update_frequency(line.id, 30)['version'] == 3
+    updated = service.segment_flow()
+    assert updated['version'] == 4
+    tn = TransitNetwork(D, stations, lines)
+    tn.calculate_flows(od, engine='sparse')
+    assert np.allclose(updated['segment_flows'], tn.compile().total_segment_currents(), atol=1e-3)
+
+    with pytest.raises(ValueError):
+        service.update_frequency(-1, 30)
+    with pytest.raises(ValueError):
+        service.segment_flow(station, line.id, 2)
+
+def test_service_busy():
+    service = NetworkService(TransitNetwork(*make_grid_network(2, 2)), max_pending=1)
+    service.flows(_od(service.network))
+    with service._exclusive():
+        with pytest.raises(ServiceBusy):
+            service.update_frequency(service.network.lines[0].id, 30)
+
+def test_server(server):
+    status, health = _request(server, 'GET', '/health')
+    assert status == 200 and health['n_stations'] == 9 and health['version'] == 0
+    assert _request(server, 'GET', '/segment_flow')[0] == 400
+    assert _request(server, 'GET', '/unknown')[0] == 404
+    assert _request(server, 'POST', '/flows', {'od': [[0, 99, 1.]]})[0] == 400
+
+    od = _od(server.service.network)
+    status, result = _request(server, 'POST', '/flows', {'od': od})
+    assert status == 200 and result['n_od'] == len(od)
+    line = server.service.network.lines[0]
+    status, result = _request(server, 'POST', '/frequency', {'line': line.id, 'frequency_vph': 20})
+    assert status == 200 and result['version'] == 2
+
+    # Concurrent reads after the update solve the OD matrix again only once.
+    with ThreadPoolExecutor(4) as pool:
+        results = list(pool.map(lambda _: _request(server, 'GET', '/segment_flow'), range(8)))
+    assert {status for status, _ in results} == {200}
+    assert {result['version'] for _, result in results} == {3}
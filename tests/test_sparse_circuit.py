@@ -0,0 +1,166 @@
+import numpy as np
+import pytest
+
+from transit_circuits.optimization import Problem
+from transit_circuits.sparse_circuit import SparseCircuit
+from transit_circuits.transit_network import Line, Station, TransitNetwork
+from transit_circuits.generators import make_grid_network
+
+def _make_cross():
+    D = np.array([
+        [0, 10, -1, -1, -1],
+        [10, 0, 8, 5, 4],
+        [-1, 8, 0, -1, -1],
+        [-1, 5, -1, 0, -1],
+        [-1, 4, -1, -1, 0]
+    ])
+    stations = [Station(i) for i in range(D.shape[0])]
+    lines = [
+        Line(0, [stations[0], stations[1], stations[2]], avg_speed_kph=10, frequency_vph=1),
+        Line(1, [stations[3], stations[1], stations[4]], avg_speed_kph=20, frequency_vph=2)
+    ]
+    return D, stations, lines
+
+def test_sparse_circuit_matrices():
+    D, stations, lines = _make_cross()
+    tn = TransitNetwork(D, stations, lines)
+    c = SparseCircuit(tn)
+
+    assert c.A_R.shape == (len(c.resistors), c.n)
+    assert c.A_D.shape == (len(c.diodes), c.n)
+    assert np.allclose(c.A_R.sum(axis=1), 0)
+    assert np.allclose(c.A_D.sum(axis=1), 0)
+    assert np.allclose(c.L.sum(axis=1), 0)
+
+@pytest.mark.parametrize("solver", SparseCircuit.SOLVERS)
+def test_sparse_circuit_matches_cvxpy(solver):
+    D, stations, lines = _make_cross()
+    tn = TransitNetwork(D, stations, lines)
+    p = Problem()
+    tn._build_subcircuit(stations[0], stations[4], 20.0, p)
+    p.solve()
+    t = tn.trips[stations[0]][stations[4]]
+
+    c = SparseCircuit(tn, solver=solver)
+    v, _ = c.solve(0, 4, 20.0)
+
+    assert np.isclose(v[c.origin] - v[c.destination], t._v_origin.value - t._v_destination.value, rtol=1e-4)
+    I_cvxpy = np.array([r.C * r.voltage.value for r in c.resistors])
+    assert np.allclose(c.G @ c.A_R @ v, I_cvxpy, atol=1e-3)
+
+def test_calculate_flows_sparse():
+    D, stations, lines = _make_cross()
+    tn = TransitNetwork(D, stations, lines)
+    OD = {stations[0]: {stations[2]: 10.0, stations[4]: 20.0}}
+    tn.calculate_flows(OD, engine='sparse')
+
+    t = tn.trips[stations[0]][stations[2]]
+    assert np.isclose(t._current_source.history[0], -1380, rtol=1e-3)
+    assert np.isclose(stations[0].lines[lines[0]][+1].tt_resistor.total_current, 30, rtol=1e-3)
+
+@pytest.mark.parametrize("solver", SparseCircuit.SOLVERS)
+def test_sparse_circuit_solve_batch(solver):
+    D, stations, lines = _make_cross()
+    tn = TransitNetwork(D, stations, lines)
+    c = SparseCircuit(tn, solver=solver)
+    trips = [(0, 2, 10.0), (0, 4, 20.0), (3, 2, 5.0)]
+
+    V, _ = c.solve_batch(trips)
+
+    assert V.shape == (len(trips), c.n)
+    for (o, d, flow), v_batch in zip(trips, V):
+        v, _ = c.solve(o, d, flow)
+        assert np.allclose(c.G @ c.A_R @ v_batch, c.G @ c.A_R @ v, atol=1e-3)
+        assert np.isclose(v_batch[c.origin] - v_batch[c.destination], v[c.origin] - v[c.destination], rtol=1e-4)
+
+def test_calculate_flows_sparse_batch_size():
+    D, stations, lines = _make_cross()
+    tn = TransitNetwork(D, stations, lines)
+    OD = {o: {d: 0 if o == d else 10 for d in stations} for o in stations}
+    tn.calculate_flows(OD, engine='sparse')
+    currents = [r.total_current for r in tn._get_sparse_circuit().resistors]
+    tn.reset()
+
+    problems = tn.calculate_flows(OD, engine='sparse', batch_size=6)
+
+    assert problems == []
+    assert np.allclose([r.total_current for r in tn._get_sparse_circuit().resistors], currents, atol=1e-3)
+    with pytest.raises(ValueError):
+        tn.calculate_flows(OD, batch_size=6)
+
+@pytest.mark.parametrize("solver", SparseCircuit.SOLVERS)
+def test_sparse_circuit_prune(solver):
+    D, stations, lines = _make_cross()
+    tn = TransitNetwork(D, stations, lines)
+    full = SparseCircuit(tn, solver=solver, prune=False)
+    pruned = SparseCircuit(tn, solver=solver)
+    for o, d in [(0, 2), (0, 4), (3, 2), (2, 0)]:
+        v_full, _ = full.solve(o, d, 10.0)
+        v, _ = pruned.solve(o, d, 10.0)
+        assert pruned.n_pruned > 0
+        assert np.allclose(pruned.G @ pruned.A_R @ v, full.G @ full.A_R @ v_full, atol=1e-3)
+        assert np.isclose(v[pruned.origin] - v[pruned.destination], v_full[full.origin] - v_full[full.destination], rtol=1e-4)
+
+def test_build_subcircuit_prune():
+    D, stations, lines = _make_cross()
+    tn = TransitNetwork(D, stations, lines)
+    compiled = tn.compile()
+    p = Problem()
+    tn._build_subcircuit(stations[0], stations[2], 10.0, p, prune=True)
+    assert p.idle and len(p.resistors) + len(p.diodes) + len(p.idle) == \
+        len(compiled.resistors) + len(compiled.diodes) + 2 + 2
+    p.solve()
+    assert all(c.last_voltage == 0 for c in p.idle)
+    # The trip rides line 0 from 0 to 2, so the other line carries nothing.
+    currents = compiled.total_segment_currents()
+    assert np.allclose(currents[compiled.segment_line == 1], 0, atol=1e-4)
+    assert np.isclose(currents.max(), 10, rtol=1e-3)
+
+@pytest.mark.parametrize("solver", SparseCircuit.SOLVERS)
+def test_sparse_circuit_reduce(solver):
+    tn = TransitNetwork(*make_grid_network(9, 9, n_lines=3))
+    full = SparseCircuit(tn, solver=solver, reduce=False)
+    reduced = SparseCircuit(tn, solver=solver)
+    # Trips between pass-through stops, and from and to the ends and crossings of the lines.
+    for o, d in [(1, 7), (2, 14), (0, 24), (22, 5), (16, 8)]:
+        v_full, _ = full.solve(o, d, 10.0)
+        v, _ = reduced.solve(o, d, 10.0)
+        assert reduced.n_reduced > 0
+        assert np.allclose(reduced.G @ reduced.A_R @ v, full.G @ full.A_R @ v_full, atol=1e-3)
+        assert np.isclose(v[reduced.origin] - v[reduced.destination], v_full[full.origin] - v_full[full.destination], rtol=1e-4)
+
+@pytest.mark.parametrize("n_lines, all_aggregated", [(3, True), (4, False)])
+def test_sparse_circuit_solve_destination(n_lines, all_aggregated):
+    # Three lines form a tree, where every trip's solution is disaggregated, while four form a loop.
+    tn = TransitNetwork(*make_grid_network(9, 9, n_lines=n_lines))
+    c = SparseCircuit(tn)
+    d = 4
+    origins = [o for o in range(len(tn.stations)) if o != d]
+    flows = np.arange(1., len(origins) + 1)
+
+    V, aggregated, statuses = c.solve_destination(d, origins, flows)
+
+    assert V.shape == (len(origins), c.n)
+    assert aggregated.all() == all_aggregated and aggregated.any()
+    assert set(statuses) <= {'solved', 'Solved'}
+    for o, flow, v_aggregated in zip(origins, flows, V):
+        v, _ = c.solve(o, d, flow)
+        assert np.allclose(c.G @ c.A_R @ v_aggregated, c.G @ c.A_R @ v, atol=1e-3)
+        assert np.isclose(v_aggregated[c.origin] - v_aggregated[c.destination], v[c.origin] - v[c.destination], rtol=1e-4)
+
+def test_calculate_flows_aggregate_destinations():
+    D, stations, lines = _make_cross()
+    tn = TransitNetwork(D, stations, lines)
+    OD = {o: {d: 0 if o == d else 10 * (1 + o.id) for d in stations} for o in stations}
+    tn.calculate_flows(OD, engine='sparse', _save_disaggregated=True)
+    currents = [r.total_current for r in tn._get_sparse_circuit().resistors]
+    od_currents = tn._disaggregated_currents.to_dense()
+    tn.reset()
+
+    problems = tn.calculate_flows(OD, engine='sparse', aggregate_destinations=True, _save_disaggregated=True)
+
+    assert problems == []
+    assert np.allclose([r.total_current for r in tn._get_sparse_circuit().resistors], currents, atol=1e-3)
+    assert np.allclose(tn._disaggregated_currents.to_dense(), od_currents, atol=1e-3)
+    with pytest.raises(ValueError):
+        tn.calculate_flows(OD, aggregate_destinations=True)
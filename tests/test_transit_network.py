@@ -1,9 +1,15 @@
 import numpy as np
 import cvxpy as cp
+import scipy.sparse as sp
+import pytest
 
 from transit_circuits.components import Resistor, Diode, CurrentSource, TTResistor, TransferResistor
-from transit_circuits.optimization import Problem
+from transit_circuits.optimization import Problem, UnsolvedError
 from transit_circuits.transit_network import Line, Station, TransitNetwork
+from transit_circuits.solution_cache import ODSolution, DiskCache
+from transit_circuits.sparse_circuit import SparseCircuit
+from transit_circuits.checkpoint import Checkpoint
+from transit_circuits.generators import make_grid_network, make_radial_network, make_random_OD
 from transit_circuits.transit_network_plotter import TransitNetworkPlotter as TNP
 
 def _make_D_cross():
@@ -280,4 +286,372 @@ def test_build_subcircuit_grid():
     t_2 = tn.trips[origin_2][destination_2]
     v_2 = flow_2 * (63 + 63)
     assert np.isclose(t_2._v_origin.value - t_2._v_destination.value, v_2, atol=1e-5)
-    
\ No newline at end of file
+    
+def _segment_currents(tn):
+    return np.array([
+        s.lines[l][d].tt_resistor.total_current
+        for s in tn.stations for l in s.lines for d in (+1, -1)
+        if s.lines[l][d].tt_resistor is not None
+    ])
+
+def _make_OD_cross(stations):
+    return {o: {d: 0 if o == d else 10 for d in stations} for o in stations}
+
+def test_calculate_flows_parametric():
+    D, stations, lines = _make_cross()
+    tn = TransitNetwork(D, stations, lines)
+    tn.calculate_flows(_make_OD_cross(stations))
+
+    D_p, stations_p, lines_p = _make_cross()
+    tn_p = TransitNetwork(D_p, stations_p, lines_p)
+    problems = tn_p.calculate_flows(_make_OD_cross(stations_p), engine='parametric')
+
+    assert all(p is problems[0] for p in problems)
+    assert np.allclose(_segment_currents(tn), _segment_currents(tn_p), rtol=1e-3, atol=1e-3)
+
+def test_calculate_flows_workers():
+    D, stations, lines = _make_cross()
+    tn = TransitNetwork(D, stations, lines)
+    tn.calculate_flows(_make_OD_cross(stations), engine='sparse', _save_disaggregated=True)
+
+    D_w, stations_w, lines_w = _make_cross()
+    tn_w = TransitNetwork(D_w, stations_w, lines_w)
+    tn_w.calculate_flows(_make_OD_cross(stations_w), engine='sparse', _save_disaggregated=True, workers=2)
+
+    assert np.array_equal(_segment_currents(tn), _segment_currents(tn_w))
+    for o, o_w in zip(stations, stations_w):
+        for d, d_w in zip(stations, stations_w):
+            if o == d:
+                continue
+            assert np.array_equal(tn.trips[o][d]._current_source.history, tn_w.trips[o_w][d_w]._current_source.history)
+    assert np.array_equal(tn._disaggregated_currents.to_dense(), tn_w._disaggregated_currents.to_dense())
+
+def test_calculate_flows_unit_flow_cache():
+    D, stations, lines = _make_cross()
+    tn = TransitNetwork(D, stations, lines)
+    OD_1 = _make_OD_cross(stations)
+    OD_2 = {o: {d: 3 * flow for d, flow in OD_1[o].items()} for o in stations}
+
+    problems = tn.calculate_flows(OD_1, engine='sparse', use_cache=True)
+    assert len(problems) == 20
+    assert len(tn._unit_flow_cache) == 20
+    tn.reset()
+
+    problems = tn.calculate_flows(OD_2, engine='sparse', use_cache=True)
+    assert len(problems) == 0
+    currents_cached = _segment_currents(tn)
+    tn.reset()
+
+    tn.calculate_flows(OD_2, engine='sparse')
+    assert np.allclose(currents_cached, _segment_currents(tn), rtol=1e-6, atol=1e-6)
+
+    tn.update_frequency(lines[1], frequency_vph=4)
+    assert len(tn._unit_flow_cache) == 0
+    problems = tn.calculate_flows(OD_2, engine='sparse', use_cache=True)
+    assert len(problems) == 20
+
+def test_calculate_flows_disk_cache(tmp_path):
+    D, stations, lines = _make_cross()
+    tn = TransitNetwork(D, stations, lines, disk_cache=tmp_path)
+    problems = tn.calculate_flows(_make_OD_cross(stations), engine='sparse')
+    assert len(problems) == 20
+    assert len(tn.disk_cache) == 20 and len(list(tmp_path.glob('*.npz'))) == 20
+
+    # A new network in the same state, e.g. after a restart, reads every solution from disk.
+    D, stations, lines = _make_cross()
+    tn = TransitNetwork(D, stations, lines, disk_cache=tmp_path)
+    OD = {o: {d: 3 * flow for d, flow in ODs.items()} for o, ODs in _make_OD_cross(stations).items()}
+    problems = tn.calculate_flows(OD, engine='sparse')
+    assert len(problems) == 0 and tn.disk_cache.hits == 20
+    currents_cached = _segment_currents(tn)
+    tn.reset()
+    tn.disk_cache = None
+    tn.calculate_flows(OD, engine='sparse')
+    assert np.allclose(currents_cached, _segment_currents(tn), rtol=1e-6, atol=1e-6)
+
+    # Another state misses, and changing it back hits again.
+    tn.disk_cache = DiskCache(tmp_path)
+    frequency_vph = 60 * lines[1].frequency_vpm
+    tn.update_frequency(lines[1], frequency_vph=4)
+    assert len(tn.calculate_flows(OD, engine='sparse')) == 20
+    tn.update_frequency(lines[1], frequency_vph=frequency_vph)
+    assert len(tn.calculate_flows(OD, engine='sparse')) == 0
+
+def test_calculate_flows_unsolved(tmp_path, monkeypatch):
+    D, stations, lines = _make_cross()
+    tn = TransitNetwork(D, stations, lines, disk_cache=tmp_path / 'cache')
+    OD = _make_OD_cross(stations)
+    # The solver stops at its iteration limit from the fourth solve on.
+    solve_qp = SparseCircuit._solve_qp
+    def _solve_qp(self, *args, n=[0], **kwargs):
+        v, status = solve_qp(self, *args, **kwargs)
+        n[0] += 1
+        return v, status if n[0] <= 3 else 'maximum iterations reached'
+    monkeypatch.setattr(SparseCircuit, '_solve_qp', _solve_qp)
+
+    checkpoint = Checkpoint(tmp_path / 'checkpoint')
+    with pytest.raises(UnsolvedError):
+        tn.calculate_flows(OD, engine='sparse', use_cache=True, checkpoint=checkpoint)
+    assert len(tn._unit_flow_cache) == 3 and len(tn.disk_cache) == 3
+    assert len(checkpoint.load(tn._network_key())) == 3
+    assert sum(len(trips) for trips in tn.trips.values()) == 3
+
+    tn = TransitNetwork(D, stations, lines, disk_cache=tmp_path / 'other')
+    with pytest.raises(UnsolvedError):
+        list(tn.iter_flows(OD, engine='sparse'))
+    assert len(tn.disk_cache) == 0
+    with pytest.raises(UnsolvedError):
+        tn.calculate_flows(OD, engine='sparse', batch_size=4)
+    assert len(tn.disk_cache) == 0
+
+    # A destination whose aggregated QP is not solved falls back to separate solves.
+    c = SparseCircuit(tn)
+    V, aggregated, statuses = c.solve_destination(0, [1, 2], [1., 2.])
+    assert not aggregated.any() and statuses == ['maximum iterations reached'] * 2
+
+def test_disk_cache_eviction(tmp_path):
+    solution = ODSolution(np.ones(100), np.ones(100), np.ones(2), np.ones(2), 1.)
+    cache = DiskCache(tmp_path, max_bytes=10_000)
+    for d in range(10):
+        cache.put('network', 0, d, 2., solution)
+        assert cache.get('network', 0, 0, 2.) is not None
+    size = sum(f.stat().st_size for f in tmp_path.glob('*.npz'))
+    assert size <= 10_000 and len(cache) < 10
+    assert cache.get('network', 0, 1, 1.) is None
+    # The first OD pair is used the most recently, so it is kept.
+    assert np.allclose(cache.get('network', 0, 0, 4.).v_resistors, 2)
+    assert len(DiskCache(tmp_path)) == len(cache)
+
+@pytest.mark.parametrize("layout", ['dense', 'sparse'])
+def test_save_load_state_npz(tmp_path, layout):
+    D, stations, lines = _make_cross()
+    tn = TransitNetwork(D, stations, lines)
+    tn.update_frequency(lines[1], frequency_vph=4)
+    tn.calculate_flows(_make_OD_cross(stations), engine='sparse', _save_disaggregated=True,
+                       disaggregated_dtype=np.float32, disaggregated_layout=layout)
+    tn.save_state(tmp_path / 'state.npz')
+
+    loaded = TransitNetwork.load_state(tmp_path / 'state.npz')
+    assert loaded._state() == tn._state()
+    assert np.array_equal(loaded.D, tn.D)
+    assert {(o.id, d.id, t.flow) for o, ds in loaded.trips.items() for d, t in ds.items()} == \
+           {(o.id, d.id, t.flow) for o, ds in tn.trips.items() for d, t in ds.items()}
+    assert np.allclose(loaded.compile().total_segment_currents(), tn.compile().total_segment_currents())
+    assert loaded._disaggregated_currents.layout == layout
+    assert np.array_equal(loaded._disaggregated_currents.to_dense(), tn._disaggregated_currents.to_dense())
+
+    # The loaded network solves like the original one.
+    loaded.reset()
+    loaded.calculate_flows(_make_OD_cross(loaded.stations), engine='sparse')
+    assert np.allclose(loaded.compile().total_segment_currents(), tn.compile().total_segment_currents(), atol=1e-6)
+
+def test_save_load_state_json(tmp_path):
+    D, stations, lines = _make_cross()
+    tn = TransitNetwork(D, stations, lines)
+    tn.calculate_flows(_make_OD_cross(stations), engine='sparse')
+    tn.save_state(tmp_path / 'state.json')
+
+    with pytest.raises(ValueError):
+        TransitNetwork.load_state(tmp_path / 'state.json')
+    loaded = TransitNetwork.load_state(tmp_path / 'state.json', D=D)
+    assert loaded._state() == tn._state()
+    assert sum(len(ds) for ds in loaded.trips.values()) == 20
+
+@pytest.mark.parametrize("engine", ['cvxpy', 'sparse'])
+def test_iter_flows(engine):
+    D, stations, lines = _make_cross()
+    tn = TransitNetwork(D, stations, lines)
+    OD = _make_OD_cross(stations)
+    records = list(tn.iter_flows(OD, engine=engine))
+    assert len(records) == 20
+    assert not any(tn.trips.values())
+    assert all(r.status in ('optimal', 'Solved') for r in records)
+
+    tn.reset()
+    tn.calculate_flows(OD, engine='sparse')
+    assert np.allclose(sum(r.segment_currents for r in records), tn.compile().total_segment_currents(), atol=1e-3)
+    # Every rider of a trip between neighbors waits for the line and rides one segment.
+    r = next(r for r in records if (r.origin, r.destination) == (0, 1))
+    line = lines[0]
+    wait_m, ride_m = 1 / (2 * line.frequency_vpm), D[0, 1] / line.avg_speed_kpm
+    assert np.isclose(r.travel_time, r.flow * (wait_m + ride_m), rtol=1e-3)
+
+    # The trips and component histories of the earlier calculate_flows are left as they were.
+    trips = {(o, d): t for o, ds in tn.trips.items() for d, t in ds.items()}
+    components = tn.compile().resistors + tn.compile().diodes
+    histories = [len(c.history) for c in components]
+    list(tn.iter_flows(OD, engine=engine))
+    assert {(o, d): t for o, ds in tn.trips.items() for d, t in ds.items()} == trips
+    assert all(c.keep_history for c in components)
+    if engine == 'sparse':
+        assert [len(c.history) for c in components] == histories
+
+def test_frequency_sensitivities():
+    D, stations, lines = _make_cross()
+    tn = TransitNetwork(D, stations, lines)
+    OD = _make_OD_cross(stations)
+    d_currents, d_travel_time = tn.frequency_sensitivities(OD)
+    assert d_currents.shape == (2, tn.compile().n_segments)
+    # More frequent service means shorter waits.
+    assert np.all(d_travel_time < 0)
+
+    def totals():
+        records = list(tn.iter_flows(OD))
+        return sum(r.segment_currents for r in records), sum(r.travel_time for r in records)
+
+    for l, line in enumerate(lines):
+        frequency_vph, h = 60 * line.frequency_vpm, 1e-3
+        tn.update_frequency(line, frequency_vph + h)
+        currents_plus, travel_time_plus = totals()
+        tn.update_frequency(line, frequency_vph - h)
+        currents_minus, travel_time_minus = totals()
+        tn.update_frequency(line, frequency_vph)
+        assert np.isclose(d_travel_time[l], (travel_time_plus - travel_time_minus) / (2 * h), rtol=1e-4)
+        assert np.allclose(d_currents[l], (currents_plus - currents_minus) / (2 * h), atol=1e-4)
+
+def test_frequency_sensitivities_grid():
+    # Realistic flows, on a network where some diodes are only blocked by a small voltage.
+    D, stations, lines = make_grid_network(6, 6, 6)
+    tn = TransitNetwork(D, stations, lines)
+    for i, line in enumerate(lines):
+        tn.update_frequency(line, 5 + 3 * i)
+    OD = make_random_OD(len(stations), 0.05, max_flow=100, seed=1)
+    d_currents, d_travel_time = tn.frequency_sensitivities(OD)
+
+    def totals():
+        # The active set solver is exact, which keeps the finite differences clean.
+        records = list(tn.iter_flows(OD, solver='ACTIVE_SET'))
+        return sum(r.segment_currents for r in records), sum(r.travel_time for r in records)
+
+    for l, line in enumerate(lines[:3]):
+        frequency_vph, h = 60 * line.frequency_vpm, 1e-3
+        tn.update_frequency(line, frequency_vph + h)
+        currents_plus, travel_time_plus = totals()
+        tn.update_frequency(line, frequency_vph - h)
+        currents_minus, travel_time_minus = totals()
+        tn.update_frequency(line, frequency_vph)
+        assert np.isclose(d_travel_time[l], (travel_time_plus - travel_time_minus) / (2 * h), rtol=1e-3)
+        d_currents_fd = (currents_plus - currents_minus) / (2 * h)
+        assert np.allclose(d_currents[l], d_currents_fd, atol=1e-3 * np.abs(d_currents_fd).max())
+
+def test_design_frequencies():
+    D, stations, lines = _make_cross()
+    tn = TransitNetwork(D, stations, lines)
+    OD = _make_OD_cross(stations)
+    OD[stations[0]][stations[2]] = 100
+    fleet_size = sum(tn.fleet_size(line) for line in lines)
+
+    frequency_vph, travel_times = tn.design_frequencies(OD, min_frequency_vph=0.5)
+    assert len(travel_times) > 1 and np.all(np.diff(travel_times) < 0)
+    assert np.allclose(frequency_vph, [60 * line.frequency_vpm for line in lines])
+    assert sum(tn.fleet_size(line) for line in lines) <= fleet_size * (1 + 1e-6)
+    assert np.all(frequency_vph >= 0.5)
+    # Line 0 carries most of the demand, so it gets more of the fleet.
+    assert frequency_vph[0] > 1
+
+def test_sparse_engine_creates_no_variables():
+    D, stations, lines = _make_cross()
+    tn = TransitNetwork(D, stations, lines)
+    tn.calculate_flows(_make_OD_cross(stations), engine='sparse')
+    compiled = tn.compile()
+    assert all(seg.v_station._variable is None and seg.v_diode._variable is None for seg in compiled.segments)
+    assert all(r._voltage is None for r in compiled.resistors)
+
+def test_calculate_flows_keep_history():
+    D, stations, lines = _make_cross()
+    tn = TransitNetwork(D, stations, lines)
+    tn.calculate_flows(_make_OD_cross(stations), engine='sparse')
+    currents = _segment_currents(tn)
+    tn.reset()
+
+    tn.calculate_flows(_make_OD_cross(stations), engine='sparse', keep_history=False)
+
+    assert np.allclose(_segment_currents(tn), currents)
+    assert len(stations[1].lines[lines[0]][+1].tt_resistor.history) == 0
+    assert stations[1].lines[lines[0]][+1].tt_resistor.n_cached == 20
+
+def test_calculate_flows_disaggregated():
+    D, stations, lines = _make_cross()
+    tn = TransitNetwork(D, stations, lines)
+    tn.calculate_flows(_make_OD_cross(stations), engine='sparse', _save_disaggregated=True, disaggregated_layout='sparse')
+
+    flows = tn._disaggregated_currents
+    assert flows.shape == (5, 5, 12)
+    assert flows.saved.sum() == 20
+    k = tn.get_segment_index(stations[0], lines[0], +1)
+    assert np.isclose(flows.get(0, 2, k), 10, rtol=1e-4)
+    assert np.isclose(flows.total()[k], stations[0].lines[lines[0]][+1].tt_resistor.total_current)
+
+    plotter = TNP(tn)
+    plotter.plot_flow_one_to_one(stations[0], stations[2])
+    plotter.plot_flow_one_to_all(stations[0])
+    plotter.plot_flow_all_to_one(stations[2])
+
+def test_update_line_in_place():
+    tns = {}
+    for engine in ('cvxpy', 'parametric', 'sparse'):
+        D, stations, lines = _make_cross()
+        tn = TransitNetwork(D, stations, lines)
+        if engine != 'cvxpy':
+            # Build the engine before the updates, so that they are applied in place.
+            tn.calculate_flows(_make_OD_cross(stations), engine=engine)
+            tn.reset()
+        tn.update_frequency(lines[1], frequency_vph=30)
+        tn.update_speed(lines[0], avg_speed_kph=20)
+        assert np.isclose(stations[0].lines[lines[0]][+1].travel_time_m, 30)
+        tn.calculate_flows(_make_OD_cross(stations), engine=engine)
+        tns[engine] = tn
+
+    for engine in ('parametric', 'sparse'):
+        assert np.allclose(_segment_currents(tns['cvxpy']), _segment_currents(tns[engine]), rtol=1e-3, atol=1e-3)
+
+def test_calculate_flows_od_formats():
+    D, stations, lines = _make_cross()
+    tn = TransitNetwork(D, stations, lines)
+    OD = np.zeros((5, 5))
+    OD[0, 2] = 10
+    OD[3, 4] = 5
+    OD[4, 3] = 1e-3
+
+    problems = tn.calculate_flows(OD, engine='sparse', min_flow=1e-2)
+    assert len(problems) == 2
+    assert set(tn.trips) == {stations[0], stations[3]}
+    currents = _segment_currents(tn)
+
+    for make_OD in (lambda stations: sp.csr_matrix(OD),
+                    lambda stations: [(0, 2, 10), (stations[3], stations[4], 5), (4, 3, 1e-3), (1, 1, 3)]):
+        D, stations, lines = _make_cross()
+        tn = TransitNetwork(D, stations, lines)
+        OD_trips = make_OD(stations)
+        problems = tn.calculate_flows(OD_trips, engine='sparse', min_flow=1e-2)
+        assert len(problems) == 2
+        assert np.allclose(_segment_currents(tn), currents)
+
+def test_compact_transfers():
+    tns = []
+    for compact_transfers in (False, True):
+        D, stations, lines = _make_cross()
+        tn = TransitNetwork(D, stations, lines, compact_transfers=compact_transfers)
+        tn.update_frequency(lines[1], frequency_vph=3)
+        tn.calculate_flows(_make_OD_cross(stations), engine='sparse', _save_disaggregated=True)
+        tns.append(tn)
+
+    # Every trip of the cross transfers at most once, so both models give the same currents.
+    assert np.allclose(tns[0]._disaggregated_currents.to_dense(), tns[1]._disaggregated_currents.to_dense(), atol=1e-5)
+
+def test_compact_transfers_merging():
+    # On a radial network with mixed frequencies, the flows of trips merge at transfers, where the
+    # compact model is only an approximation, within the bounds of the TransitNetwork docstring.
+    records = []
+    for compact_transfers in (False, True):
+        D, stations, lines = make_radial_network(2, 6)
+        tn = TransitNetwork(D, stations, lines, compact_transfers=compact_transfers)
+        for line, frequency_vph in zip(lines, [6, 30, 12, 60, 20, 8, 40, 10]):
+            tn.update_frequency(line, frequency_vph=frequency_vph)
+        records.append(list(tn.iter_flows(make_random_OD(len(stations), 1.0, seed=0), engine='sparse')))
+
+    error = np.array([np.abs(full.segment_currents - compact.segment_currents).max() / full.flow
+                      for full, compact in zip(*records)])
+    travel_time_error = np.array([abs(compact.travel_time / full.travel_time - 1) for full, compact in zip(*records)])
+    assert np.mean(error > 0.01) > 0.5
+    assert error.max() < 0.2 and travel_time_error.max() < 0.2
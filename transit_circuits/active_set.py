@@ -0,0 +1,180 @@
+import scipy.sparse as sp
+import scipy.sparse.linalg as spla
+import scipy.sparse.csgraph as csgraph
+import numpy as np
+
+def diode_edges(A):
+    '''
+    Returns the (source node, drain node) of every diode, given the sparse incidence matrix A of the
+    diodes, whose rows have a +1 at their source and a -1 at their drain.
+    '''
+    A = sp.coo_matrix(A)
+    edges = np.empty((A.shape[0], 2), dtype=int)
+    edges[A.row[A.data > 0], 0] = A.col[A.data > 0]
+    edges[A.row[A.data < 0], 1] = A.col[A.data < 0]
+    return edges
+
+def merge_shorted_nodes(n, shorts, ground):
+    '''
+    Merges the nodes shorted together, e.g. by conducting diodes, into groups that share a voltage.
+    Parameters:
+    - n: the number of nodes.
+    - shorts: array of the (node, node) pairs shorted together, which must short the ground nodes together.
+    - ground: the indices of the nodes fixed to zero.
+    Returns:
+    - labels: the group of shorted nodes of every node.
+    - column: the unknown of every node's group, -1 for the grounded group.
+    - n_free: the number of unknowns.
+    '''
+    adjacency = sp.csr_matrix((np.ones(len(shorts)), (shorts[:, 0], shorts[:, 1])), shape=(n, n))
+    n_components, labels = csgraph.connected_components(adjacency, directed=False)
+
+    # Every group of shorted nodes becomes a single unknown, except the grounded one.
+    free = np.ones(n_components, dtype=bool)
+    free[labels[ground[0]]] = False
+    column = np.where(free, np.cumsum(free) - 1, -1)[labels]
+    return labels, column, free.sum()
+
+class ActiveSetSolver():
+    '''
+    A solver for resistor networks with ideal diodes, i.e. QPs of the form
+        minimize    0.5 v' P v + q' v
+        subject to  A v <= 0, v[ground] = 0
+    where P is a Laplacian of the resistors and every row of A is the incidence of a diode.
+    Once it is known which diodes conduct, the conducting diodes short their two nodes together, and
+    the problem reduces to a sparse SPD linear system over the merged nodes. The solver iterates on
+    the set of conducting diodes: it adds the diodes whose voltage is violated and drops the diodes
+    carrying a negative current, until none is violated. Flipping every violated diode at once usually
+    settles in a few solves, but it can cycle between active sets, so once it would return to an active
+    set it has already solved, it only flips the most violated diode at a time, or the next most
+    violated one if that also leads to an active set already solved. The active set of every solve is
+    kept under a key, e.g. the trip's destination, and the next solve with the same key is warm-started
+    from it. Diodes are matched between solves by an identifier, e.g. their row in the network's
+    diode matrix, so that problems with different subsets of the diodes can share warm starts.
+    Attributes:
+    - active: the conducting diodes of the last solve, a boolean mask over the rows of A.
+    - currents: the current of every diode in the last solve, zero for those that do not conduct.
+    - warm_starts: the identifiers of the diodes of every key, and whether they conducted when last solved.
+    - n_iter: the number of linear solves of the last solve.
+    - max_iter: the number of linear solves after which the solver gives up.
+    - tol: the relative tolerance on diode voltages and currents.
+    '''
+    def __init__(self, max_iter=50, tol=1e-9):
+        self.max_iter = max_iter
+        self.tol = tol
+        self.active = None
+        self.currents = None
+        self.warm_starts = {}
+        self.n_iter = 0
+        self._last = None
+
+    def _warm_start(self, ids, key):
+        active = np.ones(len(ids), dtype=bool)
+        previous = self.warm_starts.get(key, self._last)
+        if previous is not None and len(previous[0]):
+            previous_ids, previous_active = previous
+            i = np.minimum(np.searchsorted(previous_ids, ids), len(previous_ids) - 1)
+            found = previous_ids[i] == ids
+            active[found] = previous_active[i[found]]
+        return active
+
+    def _remember(self, ids, active, key):
+        '''
+        Keeps the active set of a solve under its key, along with the diodes of the key's earlier solves
+        that were not part of it.
+        '''
+        if key in self.warm_starts:
+            previous_ids, previous_active = self.warm_starts[key]
+            other = ~np.isin(previous_ids, ids)
+            ids, active = np.concatenate([previous_ids[other], ids]), np.concatenate([previous_active[other], active])
+        order = np.argsort(ids, kind='stable')
+        self._last = self.warm_starts[key] = ids[order], active[order]
+
+    def _solve_active(self, P, q, edges, ground, active):
+        '''
+        Solves the linear system of a given active set.
+        Returns:
+        - v: the node voltages.
+        - currents: the current of every diode, zero for those that do not conduct.
+        '''
+        n = len(q)
+        # The ground nodes are merged together, as if shorted by diodes of their own.
+        shorts = np.vstack([edges[active], np.column_stack([np.full(len(ground) - 1, ground[0]), ground[1:]])])
+        labels, column, n_free = merge_shorted_nodes(n, shorts, ground)
+
+        rows, cols = column[P.row], column[P.col]
+        keep = (rows >= 0) & (cols >= 0)
+        P_W = sp.csc_matrix((P.data[keep], (rows[keep], cols[keep])), shape=(n_free, n_free))
+        q_W = np.bincount(column[column >= 0], weights=q[column >= 0], minlength=n_free)
+        u = np.atleast_1d(spla.spsolve(P_W, -q_W))
+        v = np.where(column >= 0, u[np.maximum(column, 0)], 0.)
+
+        # The diode currents are the flow through the shorted nodes that balances the residual of every
+        # node, with one root per group of shorted nodes, the ground absorbing the imbalance of its own.
+        residual = -(P @ v + q)
+        _, roots = np.unique(labels, return_index=True)
+        roots[labels[ground[0]]] = ground[0]
+        a, b = shorts[:, 0], shorts[:, 1]
+        ones = np.ones(len(shorts))
+        L_W = sp.csc_matrix((
+            np.concatenate([ones, ones, -ones, -ones, np.ones(len(roots))]),
+            (np.concatenate([a, b, a, b, roots]), np.concatenate([a, b, b, a, roots])),
+        ), shape=(n, n))
+        phi = spla.spsolve(L_W, residual)
+
+        currents = np.zeros(len(edges))
+        currents[active] = phi[edges[active, 0]] - phi[edges[active, 1]]
+        return v, currents
+
+    def solve(self, P, q, A, ground, key=None, ids=None):
+        '''
+        Solves the QP.
+        Parameters:
+        - P: the sparse Laplacian of the resistors.
+        - q: the linear term, i.e. the currents injected by the current sources.
+        - A: the sparse incidence matrix of the diodes.
+        - ground: the indices of the nodes fixed to zero.
+        - key: the key to warm-start from and to keep the active set under. The last active set is
+            used for keys that have not been solved yet.
+        - ids: the identifier of every diode, which warm starts are matched by, the row of A by default.
+        Returns:
+        - v: the node voltages.
+        - status: 'solved', or 'max_iter' if the active set did not settle.
+        '''
+        edges = diode_edges(A)
+        ground = np.atleast_1d(ground)
+        ids = np.arange(len(edges)) if ids is None else np.asarray(ids)
+
+        # A small regularization keeps nodes that are only connected through diodes from being singular.
+        P = sp.csr_matrix(P, dtype=float)
+        P = sp.coo_matrix(P + 1e-10 * max(P.diagonal().mean(), 1) * sp.eye(P.shape[0]))
+        active = self._warm_start(ids, key)
+        i_scale = max(1, np.abs(q).max())
+
+        status = 'max_iter'
+        solved = set()
+        one_at_a_time = False
+        for self.n_iter in range(1, self.max_iter + 1):
+            v, currents = self._solve_active(P, q, edges, ground, active)
+            v_scale = max(1, np.abs(v).max())
+            violation = np.where(active, -currents / i_scale, (v[edges[:, 0]] - v[edges[:, 1]]) / v_scale)
+            violated = violation > self.tol
+            if not violated.any():
+                status = 'solved'
+                break
+
+            solved.add(active.tobytes())
+            update = active ^ violated
+            if one_at_a_time or update.tobytes() in solved:
+                one_at_a_time = True
+                for i in np.argsort(-violation)[:violated.sum()]:
+                    update = active.copy()
+                    update[i] = ~update[i]
+                    if update.tobytes() not in solved:
+                        break
+            active = update
+
+        self.active = active
+        self.currents = currents
+        self._remember(ids, active, key)
+        return v, status
@@ -0,0 +1,234 @@
+'''
+Benchmarks the engines of TransitNetwork.calculate_flows on synthetic networks of increasing size,
+and writes the results as JSON so that runs can be compared. Run it with
+    python -m transit_circuits.benchmark --kind grid --sizes 3x3 4x4 --out benchmark.json
+With --server, it benchmarks the requests per second of the query server instead.
+'''
+from transit_circuits.transit_network import TransitNetwork
+from transit_circuits.server import NetworkService, make_server
+from transit_circuits.generators import make_grid_network, make_radial_network, make_random_OD
+
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+import http.client
+import tracemalloc
+import threading
+import argparse
+import platform
+import json
+
+GENERATORS = {'grid': make_grid_network, 'radial': make_radial_network}
+ENGINES = ('cvxpy', 'parametric', 'sparse')
+
+def _time_od(tn:TransitNetwork, o:int, d:int, flow:float, engine:str):
+    '''
+    Solves an OD pair as calculate_flows does, see TransitNetwork._solve_od, and times its phases.
+    Returns:
+    - a dict with the build, canonicalize and solve times in seconds. The 'sparse' engine has no
+        canonicalization, its build time includes pruning and reducing the QP and expanding its
+        solution, and with cvxpy the time spent outside of compilation and the solver call
+        is left out of all three.
+    '''
+    stats = {}
+    tn._solve_od(tn.stations[o], tn.stations[d], flow, engine, stats=stats)
+    return {'build': stats['build_s'], 'canonicalize': stats.get('compile_s', 0.), 'solve': stats['solve_s']}
+
+def benchmark_network(D, stations, lines, engines=ENGINES, od_density=1.0, max_od=None, seed=None, memory=True):
+    '''
+    Benchmarks every engine on a network.
+    Parameters:
+    - D, stations, lines: the network, as the generators return it.
+    - engines: the engines to benchmark.
+    - od_density: the fraction of OD pairs with demand.
+    - max_od: if given, only the first max_od OD pairs with demand are solved.
+    - seed: the seed of the OD matrix.
+    - memory: whether to measure the peak memory of calculate_flows. Tracing allocations slows it
+        down severalfold, so it is measured in a separate, untimed run.
+    Returns:
+    - a dict with the size of the network, its construction and compile times, and for every engine
+        the mean per-OD build, canonicalize and solve times, the total time to solve every OD pair and
+        the peak traced memory of calculate_flows.
+    '''
+    t = perf_counter()
+    tn = TransitNetwork(D, stations, lines)
+    t_construct = perf_counter() - t
+    t = perf_counter()
+    compiled = tn.compile()
+    t_compile = perf_counter() - t
+
+    OD = make_random_OD(len(stations), od_density, seed=seed).tocoo()
+    pairs = list(zip(OD.row.tolist(), OD.col.tolist(), OD.data.tolist()))[:max_od]
+    result = {
+        'n_stations': len(stations),
+        'n_lines': len(lines),
+        'n_segments': compiled.n_segments,
+        'n_resistors': len(compiled.resistors),
+        'n_diodes': len(compiled.diodes),
+        'n_od': len(pairs),
+        'construction_s': t_construct,
+        'compile_s': t_compile,
+        'engines': {},
+    }
+
+    for engine in engines:
+        t = perf_counter()
+        phases = [_time_od(tn, o, d, flow, engine) for o, d, flow in pairs]
+        t_total = perf_counter() - t
+        tn.reset()
+
+        peak = None
+        if memory:
+            tracemalloc.start()
+            tn.calculate_flows(pairs, engine=engine, keep_history=False)
+            peak = tracemalloc.get_traced_memory()[1] / 2**20
+            tracemalloc.stop()
+            tn.reset()
+
+        result['engines'][engine] = {
+            **{f'{phase}_s': float(np.mean([p[phase] for p in phases])) for phase in ('build', 'canonicalize', 'solve')},
+            'total_s': t_total,
+            'peak_memory_mb': peak,
+        }
+    return result
+
+def run_benchmarks(kind='grid', sizes=((3, 3), (4, 4)), engines=ENGINES, transfer_density=1.0,
+                   od_density=1.0, max_od=None, seed=0, memory=True):
+    '''
+    Benchmarks every engine on synthetic networks of every size.
+    Parameters:
+    - kind: 'grid' or 'radial'.
+    - sizes: (rows, columns) of the grids, or (rings, spokes) of the radial networks.
+    - engines, od_density, max_od, memory: see benchmark_network.
+    - transfer_density: see generators.make_grid_network.
+    - seed: the seed of the networks and OD matrices.
+    Returns:
+    - a dict with the benchmark settings and the results of every size.
+    '''
+    results = []
+    for size in sizes:
+        D, stations, lines = GENERATORS[kind](*size, transfer_density=transfer_density, seed=seed)
+        result = benchmark_network(D, stations, lines, engines, od_density, max_od, seed, memory)
+        results.append({'size': list(size), **result})
+    return {
+        'kind': kind,
+        'transfer_density': transfer_density,
+        'od_density': od_density,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+
+def _request(connection, method, path, body=None):
+    connection.request(method, path, None if body is None else json.dumps(body))
+    response = connection.getresponse()
+    data = response.read()
+    if response.status != 200:
+        raise RuntimeError(f"{method} {path} failed with {response.status}: {data.decode()}")
+    return json.loads(data)
+
+def benchmark_server(D, stations, lines, n_requests=200, clients=4, od_density=1.0, max_od=None, seed=None):
+    '''
+    Benchmarks the query server on a network, against solving every query in a fresh network.
+    Parameters:
+    - D, stations, lines: the network, as the generators return it.
+    - n_requests: the number of requests of every workload.
+    - clients: the number of clients sending requests at the same time, each over its own connection.
+    - od_density, max_od, seed: the OD matrix of the flow queries, see benchmark_network.
+    Returns:
+    - a dict with the time to build a network and solve the OD matrix from scratch, as without the
+        server, and for every workload the requests per second and the median and 95th percentile
+        latency. The workloads are 'segment_flow', reading the flow of a segment, 'flows', solving the
+        OD matrix again, and 'what_if', updating a line's frequency and then reading a segment flow,
+        which solves the OD matrix again under the new frequency.
+    '''
+    OD = make_random_OD(len(stations), od_density, seed=seed).tocoo()
+    od = list(zip(OD.row.tolist(), OD.col.tolist(), OD.data.tolist()))[:max_od]
+    t = perf_counter()
+    TransitNetwork(D, stations, lines).calculate_flows(od, engine='sparse', keep_history=False, progress=False)
+    t_cold = perf_counter() - t
+
+    service = NetworkService(TransitNetwork(D, stations, lines))
+    server = make_server(service)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    port = server.server_address[1]
+    line = lines[0]
+    station = stations.index(line.stations[0])
+    segment = f'/segment_flow?station={station}&line={line.id}&direction=1'
+    frequencies = [line.frequency_vpm * 60 * s for s in (0.5, 2.)]
+    # Every workload is a sequence of requests, sent over and over.
+    workloads = {
+        'segment_flow': [lambda c, i: _request(c, 'GET', segment)],
+        'flows': [lambda c, i: _request(c, 'POST', '/flows', {'od': od})],
+        'what_if': [
+            lambda c, i: _request(c, 'POST', '/frequency', {'line': line.id, 'frequency_vph': frequencies[i % 2]}),
+            lambda c, i: _request(c, 'GET', segment),
+        ],
+    }
+
+    result = {'n_stations': len(stations), 'n_od': len(od), 'clients': clients, 'cold_query_s': t_cold, 'workloads': {}}
+    try:
+        with ThreadPoolExecutor(clients) as pool:
+            connections = [http.client.HTTPConnection('127.0.0.1', port) for _ in range(clients)]
+            _request(connections[0], 'POST', '/flows', {'od': od})
+            for name, workload in workloads.items():
+                def run(c):
+                    latencies = []
+                    for i in range(c, n_requests // len(workload), clients):
+                        for request in workload:
+                            start = perf_counter()
+                            request(connections[c], i)
+                            latencies.append(perf_counter() - start)
+                    return latencies
+                t = perf_counter()
+                latencies = [l for ls in pool.map(run, range(clients)) for l in ls]
+                elapsed = perf_counter() - t
+                result['workloads'][name] = {
+                    'requests': len(latencies),
+                    'requests_per_s': len(latencies) / elapsed,
+                    'p50_ms': 1e3 * float(np.percentile(latencies, 50)),
+                    'p95_ms': 1e3 * float(np.percentile(latencies, 95)),
+                }
+            for connection in connections:
+                connection.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--kind', choices=list(GENERATORS), default='grid')
+    parser.add_argument('--sizes', nargs='+', default=['3x3', '4x4'], help="sizes as ROWSxCOLUMNS or RINGSxSPOKES")
+    parser.add_argument('--engines', nargs='+', choices=ENGINES, default=list(ENGINES))
+    parser.add_argument('--transfer-density', type=float, default=1.0)
+    parser.add_argument('--od-density', type=float, default=1.0)
+    parser.add_argument('--max-od', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', action='store_true', help="skip the peak memory measurement")
+    parser.add_argument('--server', action='store_true', help="benchmark the query server instead of the engines")
+    parser.add_argument('--requests', type=int, default=200, help="with --server, the number of requests per workload")
+    parser.add_argument('--clients', type=int, default=4, help="with --server, the number of concurrent clients")
+    parser.add_argument('--out', default='benchmark.json')
+    args = parser.parse_args(argv)
+
+    sizes = [tuple(int(n) for n in size.split('x')) for size in args.sizes]
+    if args.server:
+        results = []
+        for size in sizes:
+            D, stations, lines = GENERATORS[args.kind](*size, transfer_density=args.transfer_density, seed=args.seed)
+            result = benchmark_server(D, stations, lines, args.requests, args.clients, args.od_density, args.max_od, args.seed)
+            results.append({'size': list(size), **result})
+        report = {'kind': args.kind, 'python': platform.python_version(), 'platform': platform.platform(), 'results': results}
+    else:
+        report = run_benchmarks(args.kind, sizes, args.engines, args.transfer_density, args.od_density, args.max_od, args.seed,
+                                not args.no_memory)
+    with open(args.out, 'w') as file:
+        json.dump(report, file, indent=4)
+    print(f"Benchmark results saved to {args.out}.")
+    return report
+
+if __name__ == '__main__':
+    main()
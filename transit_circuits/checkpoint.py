@@ -0,0 +1,283 @@
+from transit_circuits.solution_cache import ODSolution
+
+import numpy as np
+
+from collections import defaultdict
+from contextlib import contextmanager
+import threading
+import socket
+import time
+import re
+import os
+
+class Checkpoint():
+    '''
+    Periodic checkpoints of the OD solutions of TransitNetwork.calculate_flows, so that a run that is
+    interrupted can resume without solving its finished OD pairs again. The solutions are written in
+    chunks of .npz files to a subdirectory per network key, so a checkpoint is never resumed with a
+    network in another state. Every process writes its own chunk files, so several processes can
+    share a checkpoint directory, e.g. on a shared filesystem.
+    Attributes:
+    - directory: the directory of the checkpoint, created if it does not exist.
+    - every: the number of solved OD pairs between two chunk files.
+    '''
+    def __init__(self, directory, every=100):
+        self.directory = directory
+        self.every = every
+        self._pending = []
+        self._network_key = None
+        self._n_chunks = 0
+        # The chunk files indexed so far, and the flow, chunk file and row of every OD pair in them,
+        # by network key. The solutions themselves stay on disk.
+        self._index = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, network_key:str):
+        return os.path.join(self.directory, network_key)
+
+    def _update_index(self, network_key:str):
+        '''
+        Indexes the OD pairs of the chunk files written since the last call, reading only their
+        origins, destinations and flows. Unreadable chunk files, e.g. those of a process that was
+        killed while writing one, are skipped.
+        '''
+        names, index = self._index.setdefault(network_key, (set(), {}))
+        path = self._path(network_key)
+        if not os.path.isdir(path):
+            return index
+        for entry in sorted(os.scandir(path), key=lambda f: f.name):
+            if not entry.name.endswith('.npz') or entry.name in names:
+                continue
+            try:
+                with np.load(entry.path) as data:
+                    pairs = zip(data['origin'].tolist(), data['destination'].tolist(), data['flow'].tolist())
+                    for i, (o, d, flow) in enumerate(pairs):
+                        index[o, d] = flow, entry.name, i
+            except (OSError, ValueError, KeyError):
+                continue
+            names.add(entry.name)
+        return index
+
+    def load(self, network_key:str, pairs=None) -> dict:
+        '''
+        Returns the checkpointed solutions of a network, as a dict of (flow, ODSolution) pairs indexed
+        by (origin index, destination index). Only the chunk files written since the last load are
+        indexed, and only the solutions of the requested OD pairs are read, so loading again, e.g.
+        for every shard of run_queue, stays cheap and the checkpoint keeps no solutions in memory.
+        Parameters:
+        - network_key: the key of the network.
+        - pairs: the (origin index, destination index) pairs to read, every checkpointed one by default.
+        '''
+        index = self._update_index(network_key)
+        if pairs is None:
+            pairs = index
+        rows = defaultdict(list)
+        for pair in pairs:
+            if pair in index:
+                flow, name, i = index[pair]
+                rows[name].append((pair, flow, i))
+
+        solutions = {}
+        for name, chunk_rows in rows.items():
+            try:
+                with np.load(os.path.join(self._path(network_key), name)) as data:
+                    chunk = {key: data[key] for key in data.files}
+            except (OSError, ValueError):
+                continue
+            for pair, flow, i in chunk_rows:
+                solutions[pair] = flow, ODSolution(
+                    chunk['v_resistors'][i],
+                    chunk['v_diodes'][i],
+                    chunk['v_origin_resistors'][chunk['origin_indptr'][i]:chunk['origin_indptr'][i + 1]],
+                    chunk['v_destination_diodes'][chunk['destination_indptr'][i]:chunk['destination_indptr'][i + 1]],
+                    chunk['v_current_source'][i],
+                )
+        return solutions
+
+    def add(self, network_key:str, o:int, d:int, flow:float, solution:ODSolution):
+        '''
+        Adds the solution of an OD pair to the checkpoint, and writes a chunk file once `every` solutions
+        have been added since the last one.
+        '''
+        if self._network_key != network_key:
+            self.flush()
+            self._network_key = network_key
+        self._pending.append((o, d, flow, solution))
+        if len(self._pending) >= self.every:
+            self.flush()
+
+    def flush(self):
+        '''
+        Writes the solutions added since the last chunk file to a new chunk file.
+        '''
+        if not self._pending:
+            return
+        origin, destination, flow, solutions = zip(*self._pending)
+        solutions = ODSolution(*zip(*solutions))
+        chunk = {
+            'origin': np.array(origin, dtype=int),
+            'destination': np.array(destination, dtype=int),
+            'flow': np.array(flow, dtype=float),
+            'v_resistors': np.array(solutions.v_resistors, dtype=float),
+            'v_diodes': np.array(solutions.v_diodes, dtype=float),
+            'v_origin_resistors': np.concatenate([np.ravel(v) for v in solutions.v_origin_resistors]),
+            'origin_indptr': np.cumsum([0] + [np.size(v) for v in solutions.v_origin_resistors]),
+            'v_destination_diodes': np.concatenate([np.ravel(v) for v in solutions.v_destination_diodes]),
+            'destination_indptr': np.cumsum([0] + [np.size(v) for v in solutions.v_destination_diodes]),
+            'v_current_source': np.array(solutions.v_current_source, dtype=float),
+        }
+
+        path = self._path(self._network_key)
+        os.makedirs(path, exist_ok=True)
+        name = os.path.join(path, f"{socket.gethostname()}-{os.getpid()}-{time.time_ns()}-{self._n_chunks:06d}.npz")
+        # Write to a temporary file and rename it, so that readers never see a partial chunk.
+        tmp = f"{name}.tmp"
+        with open(tmp, 'wb') as file:
+            np.savez(file, **chunk)
+        os.replace(tmp, name)
+        if self._network_key in self._index:
+            names, index = self._index[self._network_key]
+            names.add(os.path.basename(name))
+            for i, (o, d, flow, _) in enumerate(self._pending):
+                index[o, d] = flow, os.path.basename(name), i
+        self._n_chunks += 1
+        self._pending = []
+
+    def clear(self):
+        '''
+        Deletes every chunk file of the checkpoint, and the solutions not written yet.
+        '''
+        self._pending = []
+        self._index = {}
+        for entry in os.scandir(self.directory):
+            if entry.is_dir():
+                for chunk in os.scandir(entry.path):
+                    os.remove(chunk.path)
+                os.rmdir(entry.path)
+
+class WorkQueue():
+    '''
+    A queue of shards of OD pairs in a directory, that independent processes on one machine or on a
+    shared filesystem take work from. Every shard is a file that moves from pending/ to claimed/ to
+    done/ by renaming it, which is atomic, so no two processes claim the same shard. A shard that is
+    requeued gets the number of times it was requeued in its name, e.g. shard-000003.r1.npy.
+    Attributes:
+    - directory: the directory of the queue, created if it does not exist.
+    '''
+    STATES = ('pending', 'claimed', 'done')
+
+    def __init__(self, directory):
+        self.directory = directory
+        for state in self.STATES:
+            os.makedirs(os.path.join(directory, state), exist_ok=True)
+
+    def _names(self, state):
+        return sorted(f for f in os.listdir(os.path.join(self.directory, state)) if f.endswith('.npy'))
+
+    def __len__(self):
+        '''
+        The number of shards that have not been claimed yet.
+        '''
+        return len(self._names('pending'))
+
+    def counts(self) -> dict:
+        '''
+        Returns the number of shards in every state.
+        '''
+        return {state: len(self._names(state)) for state in self.STATES}
+
+    def put(self, tasks, n_shards:int):
+        '''
+        Splits OD pairs into n_shards shards of consecutive pairs and adds them to the queue.
+        Parameters:
+        - tasks: list of (origin index, destination index, flow) tuples.
+        - n_shards: the number of shards.
+        '''
+        tasks = np.array(tasks, dtype=float).reshape(-1, 3)
+        start = len(self._names('pending')) + len(self._names('claimed')) + len(self._names('done'))
+        for i, shard in enumerate(np.array_split(tasks, n_shards)):
+            path = os.path.join(self.directory, 'pending', f"shard-{start + i:06d}.npy")
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, 'wb') as file:
+                np.save(file, shard)
+            os.replace(tmp, path)
+
+    def claim(self):
+        '''
+        Claims the next pending shard.
+        Returns:
+        - the name of the shard, to pass to complete, and its list of (origin index, destination
+            index, flow) tuples, or None if no shard is pending.
+        '''
+        for name in self._names('pending'):
+            claimed = os.path.join(self.directory, 'claimed', name)
+            try:
+                os.rename(os.path.join(self.directory, 'pending', name), claimed)
+            except FileNotFoundError:
+                # Claimed by another process in the meantime.
+                continue
+            # Renaming keeps the modification time, which dates the claim for requeue_stale.
+            os.utime(claimed)
+            shard = np.load(claimed)
+            return name, [(int(o), int(d), flow) for o, d, flow in shard.tolist()]
+        return None
+
+    @staticmethod
+    def requeued(name:str) -> bool:
+        '''
+        Returns whether a shard was claimed before and requeued, so that some of its OD pairs may
+        already be checkpointed.
+        '''
+        return re.search(r'\.r\d+\.npy$', name) is not None
+
+    @contextmanager
+    def heartbeat(self, name:str, interval_s:float=60):
+        '''
+        Touches a claimed shard every interval_s seconds on a background thread while the context is
+        open, so that requeue_stale only requeues the shards of processes that stopped, e.g.
+            with queue.heartbeat(name):
+                ...
+        interval_s must be well below the max_age_s of requeue_stale.
+        '''
+        path = os.path.join(self.directory, 'claimed', name)
+        stop = threading.Event()
+        def touch():
+            while not stop.wait(interval_s):
+                try:
+                    os.utime(path)
+                except FileNotFoundError:
+                    return
+        thread = threading.Thread(target=touch, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def complete(self, name:str):
+        '''
+        Marks a claimed shard as done.
+        '''
+        os.replace(os.path.join(self.directory, 'claimed', name), os.path.join(self.directory, 'done', name))
+
+    def requeue_stale(self, max_age_s:float) -> int:
+        '''
+        Moves the shards claimed, or touched by heartbeat, more than max_age_s seconds ago back to
+        pending, e.g. those of processes that were killed. The OD pairs they checkpointed are not
+        solved again on resume.
+        Returns:
+        - the number of shards requeued.
+        '''
+        n = 0
+        for name in self._names('claimed'):
+            path = os.path.join(self.directory, 'claimed', name)
+            match = re.fullmatch(r'(.*?)(?:\.r(\d+))?\.npy', name)
+            renamed = f"{match[1]}.r{int(match[2] or 0) + 1}.npy"
+            try:
+                if time.time() - os.path.getmtime(path) > max_age_s:
+                    os.rename(path, os.path.join(self.directory, 'pending', renamed))
+                    n += 1
+            except FileNotFoundError:
+                continue
+        return n
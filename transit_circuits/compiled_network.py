@@ -0,0 +1,229 @@
+import scipy.sparse as sp
+import scipy.sparse.csgraph as csgraph
+import numpy as np
+
+class CompiledNetwork():
+    '''
+    A read-only, integer-indexed view of the topology of a TransitNetwork, built once so that solvers,
+    result extraction and plotting do not have to walk the station.lines and _transfer_resistors dicts.
+
+    Every (station, line, direction) is a line segment k, with nodes v_station = 2k and v_diode = 2k + 1.
+    Transfer diodes add one internal node each, after those of the segments.
+    Attributes:
+    - stations, lines: the stations and lines of the network, which define the station and line indices.
+    - segments: the _LineSegment object of every segment.
+    - resistors: the travel time resistors of the segments that have one, followed by the transfer resistors.
+    - diodes: the travel direction diodes of all segments, followed by the transfer diodes.
+    - n_nodes: the number of nodes.
+    - resistor_edges, diode_edges: (source node, drain node) of every resistor and diode.
+    - resistor_C: the conductance of every resistor.
+    - A_R, A_D: the node-incidence matrices of the resistors and diodes.
+    - segment_station, segment_line, segment_direction: the station index, line index and direction of
+        every segment.
+    - segment_resistor: the row of every segment's travel time resistor in resistors, -1 if it has none.
+    - segment_C: the conductance of every segment's travel time resistor, 0 if it has none.
+    - transfer_station, transfer_from, transfer_to: the station index, and the segments transferred from
+        and to, of every transfer. With the compact transfer model, a transfer boards its segment from
+        the station's transfer node and transfer_from is -1.
+    - transfer_resistor, transfer_diode: the rows of every transfer's resistor and diode. The other
+        diodes of the compact transfer model come after the diode of the station's last transfer.
+    - station_segments: the segments of every station, as a list of index arrays, in the order Trip
+        creates its components.
+    - station_origin_C: the conductance of the origin resistor of every segment of every station.
+    - line_resistors: the rows of the resistors whose conductance depends on each line, i.e. its travel
+        time resistors and the transfer resistors boarding it, as a list of index arrays in line order.
+    - graph_edges: the (node, node) pairs current can flow along, i.e. both directions of every
+        resistor and the source to drain direction of every diode.
+    - pass_through: the mask of the segments whose only components are their travel direction diode
+        and the travel time resistors into and out of them, such as the stops of a single line without
+        transfers. Unless their station is the origin or destination of a trip, current can only ride
+        through them, see SparseCircuit.solve.
+    '''
+    def __init__(self, transit_network):
+        self.stations = list(transit_network.stations)
+        self.lines = list(transit_network.lines)
+        station_index = {s: i for i, s in enumerate(self.stations)}
+        line_index = {l: i for i, l in enumerate(self.lines)}
+
+        segments = [(s, line, direction) for s in self.stations for line in s.lines for direction in (+1, -1)]
+        self._segment_index = {seg: k for k, seg in enumerate(segments)}
+        self.segments = [s.lines[line][direction] for s, line, direction in segments]
+        n_segments = len(segments)
+
+        self._nodes = {}
+        for seg in self.segments:
+            self._node(seg.v_station)
+            self._node(seg.v_diode)
+
+        self.resistors = []
+        self.diodes = []
+        segment_resistor = np.full(n_segments, -1)
+        for k, seg in enumerate(self.segments):
+            self.diodes.append(seg.td_diode)
+            if seg.tt_resistor is not None:
+                segment_resistor[k] = len(self.resistors)
+                self.resistors.append(seg.tt_resistor)
+
+        transfers = []
+        for s in self.stations:
+            if s.compact_transfers:
+                for line in s._boarding_resistors:
+                    for direction in (+1, -1):
+                        transfers.append((
+                            station_index[s], -1, self._segment_index[s, line, direction],
+                            len(self.resistors), len(self.diodes),
+                        ))
+                        self.resistors.append(s._boarding_resistors[line][direction])
+                        self.diodes.append(s._boarding_diodes[line][direction])
+                self.diodes += s._transfer_chain_diodes
+                continue
+            for l1 in s.lines:
+                for d1 in (+1, -1):
+                    for l2 in s.lines:
+                        if l1 == l2:
+                            continue
+                        for d2 in (+1, -1):
+                            transfers.append((
+                                station_index[s], self._segment_index[s, l1, d1], self._segment_index[s, l2, d2],
+                                len(self.resistors), len(self.diodes),
+                            ))
+                            self.resistors.append(s._transfer_resistors[l1][d1][l2][d2])
+                            self.diodes.append(s._transfer_diodes[l1][d1][l2][d2])
+        transfers = np.array(transfers, dtype=int).reshape(-1, 5)
+
+        self.resistor_edges = np.array([self._edge(r) for r in self.resistors], dtype=int).reshape(-1, 2)
+        self.diode_edges = np.array([self._edge(d) for d in self.diodes], dtype=int).reshape(-1, 2)
+        self.n_nodes = len(self._nodes)
+        self.resistor_C = np.array([r.conductance for r in self.resistors], dtype=float)
+
+        self.segment_station = np.array([station_index[s] for s, _, _ in segments], dtype=int)
+        self.segment_line = np.array([line_index[line] for _, line, _ in segments], dtype=int)
+        self.segment_direction = np.array([direction for _, _, direction in segments], dtype=int)
+        self.segment_resistor = segment_resistor
+        self.segment_C = np.where(segment_resistor >= 0, self.resistor_C[segment_resistor], 0.)
+
+        self.transfer_station, self.transfer_from, self.transfer_to, self.transfer_resistor, self.transfer_diode = transfers.T
+
+        frequency_vpm = np.array([line.frequency_vpm for line in self.lines], dtype=float)
+        self.station_segments = [np.flatnonzero(self.segment_station == i) for i in range(len(self.stations))]
+        self.station_origin_C = [2 * frequency_vpm[self.segment_line[k]] for k in self.station_segments]
+
+        transfer_line = self.segment_line[self.transfer_to]
+        self.line_resistors = [
+            np.concatenate([
+                segment_resistor[(self.segment_line == l) & (segment_resistor >= 0)],
+                self.transfer_resistor[transfer_line == l],
+            ])
+            for l in range(len(self.lines))
+        ]
+
+        self.A_R = self.incidence(self.resistor_edges)
+        self.A_D = self.incidence(self.diode_edges)
+        self.graph_edges = np.vstack([self.resistor_edges, self.resistor_edges[:, ::-1], self.diode_edges])
+
+        degree = lambda nodes: np.bincount(nodes, minlength=self.n_nodes)
+        r_out, r_in = degree(self.resistor_edges[:, 0]), degree(self.resistor_edges[:, 1])
+        d_out, d_in = degree(self.diode_edges[:, 0]), degree(self.diode_edges[:, 1])
+        v_station = self.segment_v_station(np.arange(n_segments))
+        v_diode = self.segment_v_diode(np.arange(n_segments))
+        self.pass_through = (
+            (r_in[v_station] == 1) & (r_out[v_station] == 0) & (d_out[v_station] == 1) & (d_in[v_station] == 0)
+            & (r_out[v_diode] == 1) & (r_in[v_diode] == 0) & (d_in[v_diode] == 1) & (d_out[v_diode] == 0)
+        )
+
+        for value in vars(self).values():
+            for array in (value if isinstance(value, list) else [value]):
+                if isinstance(array, np.ndarray):
+                    array.flags.writeable = False
+
+    def update_line(self, line):
+        '''
+        Refreshes, in place, the conductances that depend on a line after its frequency or speed changed.
+        Only the line's own resistors and the origin conductances of its stations are read again.
+        Returns:
+        - rows: the rows of the updated resistors.
+        - old_C: their conductance before the update.
+        '''
+        l = self.lines.index(line)
+        rows = self.line_resistors[l]
+        old_C = self.resistor_C[rows]
+        segments = np.flatnonzero(self.segment_line == l)
+        stations = np.unique(self.segment_station[segments])
+
+        for array in [self.resistor_C, self.segment_C] + [self.station_origin_C[i] for i in stations]:
+            array.flags.writeable = True
+        self.resistor_C[rows] = [self.resistors[r].conductance for r in rows]
+        has_resistor = segments[self.segment_resistor[segments] >= 0]
+        self.segment_C[has_resistor] = self.resistor_C[self.segment_resistor[has_resistor]]
+        for i in stations:
+            self.station_origin_C[i][self.segment_line[self.station_segments[i]] == l] = 2 * line.frequency_vpm
+        for array in [self.resistor_C, self.segment_C] + [self.station_origin_C[i] for i in stations]:
+            array.flags.writeable = False
+
+        return rows, old_C
+
+    def _node(self, v):
+        return self._nodes.setdefault(v.id, len(self._nodes))
+
+    def _edge(self, component):
+        return self._node(component.source), self._node(component.drain)
+
+    @property
+    def n_segments(self):
+        return len(self.segments)
+
+    def segment_index(self, station, line, direction) -> int:
+        return self._segment_index[station, line, direction]
+
+    def segment_v_station(self, k):
+        return 2 * np.asarray(k)
+
+    def segment_v_diode(self, k):
+        return 2 * np.asarray(k) + 1
+
+    def incidence(self, edges, n_nodes=None):
+        '''
+        Returns the sparse node-incidence matrix of a list of (source, drain) edges, with +1 at the source
+        and -1 at the drain of every edge.
+        '''
+        n_nodes = n_nodes or self.n_nodes
+        edges = np.asarray(edges, dtype=int).reshape(-1, 2)
+        rows = np.repeat(np.arange(len(edges)), 2)
+        data = np.tile([1., -1.], len(edges))
+        return sp.csr_matrix((data, (rows, edges.ravel())), shape=(len(edges), n_nodes))
+
+    def od_nodes(self, o:int, d:int):
+        '''
+        Returns the mask of the nodes that lie on a path from station index o to station index d, i.e.
+        that current leaving o can reach and that can reach d, through resistors in either direction
+        and through diodes from source to drain. The trip's current only flows along such paths, since
+        circulating through resistors would only waste energy, so the other nodes carry no current and
+        can be left out of its circuit.
+        '''
+        origin, destination = self.n_nodes, self.n_nodes + 1
+        v_diode = self.segment_v_diode(self.station_segments[o])
+        v_station = self.segment_v_station(self.station_segments[d])
+        edges = np.vstack([
+            self.graph_edges,
+            np.column_stack([np.full(len(v_diode), origin), v_diode]),
+            np.column_stack([v_station, np.full(len(v_station), destination)]),
+        ])
+        n = self.n_nodes + 2
+        graph = sp.csr_matrix((np.ones(len(edges)), (edges[:, 0], edges[:, 1])), shape=(n, n))
+        reached = np.zeros((2, n), dtype=bool)
+        reached[0, csgraph.breadth_first_order(graph, origin, return_predecessors=False)] = True
+        reached[1, csgraph.breadth_first_order(graph.T.tocsr(), destination, return_predecessors=False)] = True
+        return reached.all(axis=0)[:self.n_nodes]
+
+    def segment_currents(self, v_resistors):
+        '''
+        Returns the current of every segment, given the voltages of the resistors.
+        '''
+        return self.segment_C * np.asarray(v_resistors)[np.maximum(self.segment_resistor, 0)]
+
+    def total_segment_currents(self):
+        '''
+        Returns the total current cached by the travel time resistor of every segment, 0 if it has none.
+        '''
+        totals = np.array([r.total_current for r in self.resistors], dtype=float)
+        return np.where(self.segment_resistor >= 0, totals[np.maximum(self.segment_resistor, 0)], 0.)
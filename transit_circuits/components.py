@@ -1,18 +1,105 @@
+from cvxpy.lin_ops.lin_utils import get_id
 import cvxpy as cp
 import numpy as np
 
+class Node():
+    '''
+    A node of the circuit. Creating a cvxpy Variable is slow, and networks solved without cvxpy never
+    need one, so the node's Variable is only created the first time an expression uses it. It takes the
+    node's id, which is drawn from the same counter as the ids of cvxpy Variables.
+    Attributes:
+    - id: the id of the node, and of its Variable.
+    - variable: the cvxpy Variable of the node.
+    - value: the value of the node's Variable.
+    '''
+    __slots__ = ('id', '_variable')
+
+    def __init__(self):
+        self.id = get_id()
+        self._variable = None
+
+    @property
+    def variable(self) -> cp.Variable:
+        if self._variable is None:
+            self._variable = cp.Variable(var_id=self.id)
+        return self._variable
+
+    @property
+    def value(self):
+        return None if self._variable is None else self._variable.value
+
+    @value.setter
+    def value(self, value):
+        self.variable.value = value
+
+def as_expression(v):
+    '''
+    Returns the Variable of a Node, and anything else, e.g. a cvxpy expression, as it is.
+    '''
+    return v.variable if isinstance(v, Node) else v
+
 class Component():
+    '''
+    Base class of the circuit components. Every solve is cached into the component's history, which is
+    stored in a buffer that grows by doubling, along with running aggregates.
+    Attributes:
+    - history: the voltages cached so far, a view into the history buffer.
+    - last_voltage: the voltage of the last solve.
+    - n_cached: the number of solves cached so far.
+    - keep_history: whether to store every voltage in the history. If False, only the running
+        aggregates are kept.
+    The cvxpy expressions of a component, such as its voltage, are only built the first time they are
+    used, since networks solved without cvxpy never need them.
+    '''
+    MIN_CAPACITY = 16
+
     def __init__(self, source, drain):
         self.source = source
         self.drain = drain
-        self.voltage = self.source - self.drain
-        self.history = np.array([])
-    
-    def cache(self):
-        self.history = np.append(self.history, self.voltage.value)
-    
+        self._voltage = None
+        self.keep_history = True
+        self.reset()
+
+    @property
+    def voltage(self):
+        if self._voltage is None:
+            self._voltage = as_expression(self.source) - as_expression(self.drain)
+        return self._voltage
+
+    @property
+    def history(self):
+        return self._history[:self._n_history]
+
+    def reserve(self, n:int):
+        '''
+        Makes room in the history buffer for n more voltages.
+        '''
+        if self._n_history + n > len(self._history):
+            capacity = max(self.MIN_CAPACITY, 2 * len(self._history), self._n_history + n)
+            history = np.empty(capacity)
+            history[:self._n_history] = self.history
+            self._history = history
+
+    def cache(self, voltage=None):
+        '''
+        Appends the component's voltage to its history. The voltage is read from the cvxpy expression
+        unless it is given, as it is by solvers that bypass cvxpy.
+        '''
+        if voltage is None:
+            voltage = self.voltage.value
+        self.last_voltage = float(voltage)
+        self.n_cached += 1
+
+        if self.keep_history:
+            self.reserve(1)
+            self._history[self._n_history] = self.last_voltage
+            self._n_history += 1
+
     def reset(self):
-        self.history = np.array([])
+        self._history = np.empty(0)
+        self._n_history = 0
+        self.last_voltage = None
+        self.n_cached = 0
 
 class Resistor(Component):
     def __init__(self, C:float|cp.Variable, source:cp.Variable, drain:cp.Variable):
@@ -25,21 +112,45 @@ class Resistor(Component):
         '''
         super().__init__(source, drain)
         self._update_C(C)
-        self.total_current = 0
     
-    def cache(self):
-        super().cache()
-        self.total_current = self.C * np.sum(self.history)
+    @property
+    def conductance(self):
+        '''
+        The numeric value of the conductance, also when it is a cvxpy Variable or Parameter.
+        '''
+        return self.C.value if isinstance(self.C, cp.Expression) else self.C
+
+    def cache(self, voltage=None):
+        super().cache(voltage)
+        self.total_current += self.conductance * self.last_voltage
+
+    def reset(self):
+        super().reset()
+        self.total_current = 0
 
     def _update_C(self, C):
+        if isinstance(getattr(self, 'C', None), cp.Parameter) and not isinstance(C, cp.Expression):
+            # The expressions already depend on the parameter, so only its value changes.
+            self.C.value = C
+            self.R = 1/C
+            return
         self.C = C
         self.R = 1/C
         self.constraint = None
         self.is_variable = isinstance(C, cp.Variable)
         if self.is_variable:
             self.constraint = C >= 0
-        self.energy = 0.5 * self.C * cp.power(self.voltage, 2)
-        self.current = self.C * self.voltage
+        self._energy = None
+
+    @property
+    def energy(self):
+        if self._energy is None:
+            self._energy = 0.5 * self.C * cp.power(self.voltage, 2)
+        return self._energy
+
+    @property
+    def current(self):
+        return self.C * self.voltage
 
 class TTResistor(Resistor):
     def __init__(self, travel_time_m, source, drain):
@@ -55,6 +166,10 @@ class TTResistor(Resistor):
         C = 1 / travel_time_m
         super().__init__(C, source, drain)
 
+    def update_travel_time(self, travel_time_m):
+        C = 1 / travel_time_m
+        self._update_C(C)
+
 class TransferResistor(Resistor):
     def __init__(self, freq_vpm, source, drain):
         '''
@@ -78,12 +193,21 @@ class TransferResistor(Resistor):
 class Diode(Component):
     def __init__(self, source, drain):
         super().__init__(source, drain)
-        # self.constraint = self.source - self.drain >= 0
-        self.constraint = self.voltage <= 0
+        self._constraint = None
+
+    @property
+    def constraint(self):
+        if self._constraint is None:
+            # self.constraint = self.source - self.drain >= 0
+            self._constraint = self.voltage <= 0
+        return self._constraint
 
 class CurrentSource(Component):
     def __init__(self, I, source, drain):
         super().__init__(source, drain)
         self.I = I
+
+    @property
+    def energy(self):
         # self.energy = self.I * (self.drain - self.source)
-        self.energy = self.I * (self.source - self.drain)
\ No newline at end of file
+        return self.I * (as_expression(self.source) - as_expression(self.drain))
\ No newline at end of file
@@ -0,0 +1,140 @@
+import numpy as np
+
+class FlowTensor():
+    '''
+    The currents of every line segment for every OD pair, indexed by (origin index, destination index,
+    segment index). With the 'dense' layout they are stored in a single NumPy array, and with the
+    'sparse' layout only the segments carrying current are stored for each OD pair, which suits OD
+    pairs that only touch a few segments.
+    Attributes:
+    - shape: (number of stations, number of stations, number of segments).
+    - dtype: the dtype the currents are stored with.
+    - layout: 'dense' or 'sparse'.
+    - saved: boolean matrix flagging the OD pairs whose currents have been saved.
+    '''
+    LAYOUTS = ('dense', 'sparse')
+
+    def __init__(self, n_stations:int, n_segments:int, dtype=np.float64, layout='dense', tol=1e-9):
+        '''
+        Constructor for a FlowTensor.
+        Parameters:
+        - n_stations: the number of stations.
+        - n_segments: the number of line segments.
+        - dtype: the dtype to store the currents with, e.g. np.float32 or np.float64.
+        - layout: 'dense' or 'sparse'.
+        - tol: with the sparse layout, currents whose magnitude is at most tol are not stored.
+        '''
+        if layout not in self.LAYOUTS:
+            raise ValueError(f"Unknown layout {layout}, use one of {self.LAYOUTS}.")
+        self.shape = (n_stations, n_stations, n_segments)
+        self.dtype = np.dtype(dtype)
+        self.layout = layout
+        self.tol = tol
+        self.saved = np.zeros((n_stations, n_stations), dtype=bool)
+
+        if layout == 'dense':
+            self._currents = np.zeros(self.shape, dtype=self.dtype)
+        else:
+            self._currents = {}
+
+    def set_od(self, o:int, d:int, currents):
+        '''
+        Saves the currents of every segment for an OD pair, in a single vectorized write.
+        '''
+        currents = np.asarray(currents, dtype=self.dtype)
+        self.saved[o, d] = True
+        if self.layout == 'dense':
+            self._currents[o, d] = currents
+            return
+        idx = np.flatnonzero(np.abs(currents) > self.tol)
+        self._currents[o, d] = (idx.astype(np.int32), currents[idx])
+
+    def get_od(self, o:int, d:int):
+        '''
+        Returns the currents of every segment for an OD pair, zero if it has not been saved.
+        '''
+        if self.layout == 'dense':
+            return self._currents[o, d]
+        currents = np.zeros(self.shape[2], dtype=self.dtype)
+        if (o, d) in self._currents:
+            idx, values = self._currents[o, d]
+            currents[idx] = values
+        return currents
+
+    def get(self, o:int, d:int, k:int):
+        '''
+        Returns the current of segment k for an OD pair.
+        '''
+        return self.get_od(o, d)[k]
+
+    def total(self, origins=None, destinations=None):
+        '''
+        Returns the currents of every segment summed over the given origins and destinations, all of
+        them by default.
+        '''
+        origins = np.arange(self.shape[0]) if origins is None else np.asarray(origins)
+        destinations = np.arange(self.shape[1]) if destinations is None else np.asarray(destinations)
+        if self.layout == 'dense':
+            return self._currents[np.ix_(origins, destinations)].sum(axis=(0, 1))
+
+        total = np.zeros(self.shape[2], dtype=self.dtype)
+        origins, destinations = set(origins.tolist()), set(destinations.tolist())
+        for (o, d), (idx, values) in self._currents.items():
+            if o in origins and d in destinations:
+                total[idx] += values
+        return total
+
+    def to_arrays(self) -> dict:
+        '''
+        Returns the tensor as a dict of arrays, e.g. to save with np.savez, which from_arrays restores.
+        The sparse layout is stored like a CSR matrix, with a row of segment currents per saved OD pair.
+        '''
+        arrays = {'shape': np.array(self.shape), 'layout': np.array(self.layout), 'tol': np.array(self.tol), 'saved': self.saved}
+        if self.layout == 'dense':
+            arrays['currents'] = self._currents
+            return arrays
+
+        pairs = list(self._currents)
+        idx = [self._currents[od][0] for od in pairs]
+        values = [self._currents[od][1] for od in pairs]
+        arrays['pairs'] = np.array(pairs, dtype=np.int64).reshape(-1, 2)
+        arrays['indptr'] = np.concatenate([[0], np.cumsum([len(i) for i in idx])]).astype(np.int64)
+        arrays['indices'] = np.concatenate(idx) if idx else np.zeros(0, dtype=np.int32)
+        arrays['values'] = np.concatenate(values) if values else np.zeros(0, dtype=self.dtype)
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays:dict):
+        '''
+        Restores a FlowTensor from the arrays of to_arrays, keeping the dtype they were saved with.
+        '''
+        n_stations, _, n_segments = (int(n) for n in arrays['shape'])
+        layout = str(arrays['layout'])
+        data = arrays['currents'] if layout == 'dense' else arrays['values']
+        tensor = cls(n_stations, n_segments, data.dtype, 'sparse', float(arrays['tol']))
+        tensor.layout = layout
+        tensor.saved = np.asarray(arrays['saved'], dtype=bool)
+        if layout == 'dense':
+            tensor._currents = np.asarray(data)
+            return tensor
+
+        indptr, indices = arrays['indptr'], arrays['indices']
+        tensor._currents = {
+            (int(o), int(d)): (indices[indptr[i]:indptr[i+1]], data[indptr[i]:indptr[i+1]])
+            for i, (o, d) in enumerate(arrays['pairs'])
+        }
+        return tensor
+
+    def to_dense(self):
+        if self.layout == 'dense':
+            return self._currents
+        currents = np.zeros(self.shape, dtype=self.dtype)
+        for (o, d), (idx, values) in self._currents.items():
+            currents[o, d, idx] = values
+        return currents
+
+    @property
+    def nbytes(self):
+        if self.layout == 'dense':
+            return self._currents.nbytes
+        return sum(idx.nbytes + values.nbytes for idx, values in self._currents.values())
@@ -0,0 +1,130 @@
+from transit_circuits.transit_network import Line, Station
+
+import scipy.sparse as sp
+import scipy.sparse.csgraph
+import numpy as np
+
+def _make_network(xy, candidate_lines, n_lines, transfer_density, avg_speed_kph, frequency_vph, rng):
+    '''
+    Builds the stations, lines and distance matrix of a synthetic network.
+    Parameters:
+    - xy: array with the coordinates of every candidate station, in kilometers.
+    - candidate_lines: the candidate lines, as lists of station indices in order of service.
+    - n_lines: the number of candidate lines to keep, spread evenly over the candidates.
+    - transfer_density: the probability that a line stops at a station it shares with another line.
+        The other stops are always served, as are the first and last stops of every line, and stops
+        are only dropped if every station stays connected to every other one.
+    - avg_speed_kph, frequency_vph: the speed and frequency of every line.
+    - rng: the np.random.Generator used to drop transfer stops.
+    Returns:
+    - D, stations, lines: the distance matrix, stations and lines, as the fixtures in utils return them.
+        Only the stations served by some line are kept, and their ids are their indices.
+    '''
+    keep = np.unique(np.linspace(0, len(candidate_lines) - 1, n_lines).round().astype(int))
+    candidate_lines = [candidate_lines[i] for i in keep]
+    served = np.unique(np.concatenate(candidate_lines))
+    index = {s: i for i, s in enumerate(served)}
+    n_served = np.bincount(np.concatenate(candidate_lines), minlength=len(xy))
+
+    # The stops are the edges of a bipartite graph of stations and lines, which must stay connected.
+    stops = {(l, s) for l, line in enumerate(candidate_lines) for s in line}
+    n = len(served) + len(candidate_lines)
+    def connected(stops):
+        rows = [index[s] for _, s in stops]
+        cols = [len(served) + l for l, _ in stops]
+        graph = sp.csr_matrix((np.ones(len(stops)), (rows, cols)), shape=(n, n))
+        return sp.csgraph.connected_components(graph, directed=False)[0] == 1
+
+    droppable = [
+        (l, s) for l, line in enumerate(candidate_lines) for i, s in enumerate(line)
+        if 0 < i < len(line) - 1 and n_served[s] > 1
+    ]
+    for l, s in droppable:
+        if rng.random() >= transfer_density and connected(stops - {(l, s)}):
+            stops.remove((l, s))
+    stops = [[s for s in line if (l, s) in stops] for l, line in enumerate(candidate_lines)]
+
+    stations = [Station(i, *xy[s]) for i, s in enumerate(served)]
+
+    D = np.full((len(served), len(served)), -1.)
+    np.fill_diagonal(D, 0)
+    lines = []
+    for line_id, line_stops in enumerate(stops):
+        for a, b in zip(line_stops[:-1], line_stops[1:]):
+            D[index[a], index[b]] = D[index[b], index[a]] = np.linalg.norm(xy[a] - xy[b])
+        lines.append(Line(
+            line_id, [stations[index[s]] for s in line_stops],
+            avg_speed_kph=avg_speed_kph, frequency_vph=frequency_vph,
+        ))
+    return D, stations, lines
+
+def make_grid_network(n_rows:int, n_cols:int, n_lines:int=None, transfer_density=1.0, spacing_km=1.0,
+                      avg_speed_kph=40, frequency_vph=30, seed=None):
+    '''
+    Generates an n_rows x n_cols grid network, whose lines run along its rows and columns.
+    Parameters:
+    - n_rows, n_cols: the size of the grid.
+    - n_lines: the number of lines, at most n_rows + n_cols, which is the default. The kept lines
+        alternate between rows and columns.
+    - transfer_density: the probability that a line stops at a station where it crosses another line.
+    - spacing_km: the distance between neighboring stations.
+    - avg_speed_kph, frequency_vph: the speed and frequency of every line.
+    - seed: the seed of the stops that are dropped.
+    Returns:
+    - D, stations, lines, like utils.make_grid.
+    '''
+    ids = np.arange(n_rows * n_cols).reshape(n_rows, n_cols)
+    xy = spacing_km * np.column_stack([(ids % n_cols).ravel(), (ids // n_cols).ravel()]).astype(float)
+    rows = [list(ids[r]) for r in range(n_rows)]
+    cols = [list(ids[:, c]) for c in range(n_cols)]
+    # Interleave rows and columns, so that keeping fewer lines keeps both.
+    candidates = [l for pair in zip(rows, cols) for l in pair] + rows[n_cols:] + cols[n_rows:]
+    n_lines = n_lines or len(candidates)
+    rng = np.random.default_rng(seed)
+    return _make_network(xy, candidates, n_lines, transfer_density, avg_speed_kph, frequency_vph, rng)
+
+def make_radial_network(n_rings:int, n_spokes:int, n_lines:int=None, transfer_density=1.0, spacing_km=1.0,
+                        avg_speed_kph=40, frequency_vph=30, seed=None):
+    '''
+    Generates a radial network of a center station surrounded by n_rings rings of n_spokes stations.
+    Its lines are spokes from the outer ring to the center, and rings, which run once around a ring
+    without closing it.
+    Parameters:
+    - n_rings, n_spokes: the number of rings, and of stations on every ring.
+    - n_lines: the number of lines, at most n_spokes + n_rings, which is the default. The kept lines
+        alternate between spokes and rings.
+    - transfer_density: the probability that a line stops at a station where it crosses another line.
+    - spacing_km: the distance between consecutive rings.
+    - avg_speed_kph, frequency_vph: the speed and frequency of every line.
+    - seed: the seed of the stops that are dropped.
+    Returns:
+    - D, stations, lines, like utils.make_grid.
+    '''
+    angles = 2 * np.pi * np.arange(n_spokes) / n_spokes
+    radii = spacing_km * np.arange(1, n_rings + 1)
+    xy = np.vstack([
+        [[0., 0.]],
+        np.column_stack([np.outer(radii, np.cos(angles)).ravel(), np.outer(radii, np.sin(angles)).ravel()]),
+    ])
+    ids = 1 + np.arange(n_rings * n_spokes).reshape(n_rings, n_spokes)
+    spokes = [list(ids[::-1, s]) + [0] for s in range(n_spokes)]
+    rings = [list(ids[r]) for r in range(n_rings)]
+    candidates = [l for pair in zip(spokes, rings) for l in pair] + spokes[n_rings:] + rings[n_spokes:]
+    n_lines = n_lines or len(candidates)
+    rng = np.random.default_rng(seed)
+    return _make_network(xy, candidates, n_lines, transfer_density, avg_speed_kph, frequency_vph, rng)
+
+def make_random_OD(n_stations:int, od_density=1.0, max_flow=100, seed=None):
+    '''
+    Generates a random OD matrix, in the scipy.sparse format TransitNetwork.calculate_flows accepts.
+    Parameters:
+    - n_stations: the number of stations.
+    - od_density: the fraction of the off-diagonal OD pairs with demand.
+    - max_flow: the flows are drawn uniformly between 1 and max_flow.
+    - seed: the seed of the OD pairs and flows.
+    '''
+    rng = np.random.default_rng(seed)
+    o, d = np.nonzero(~np.eye(n_stations, dtype=bool))
+    picked = rng.random(len(o)) < od_density
+    flows = rng.uniform(1, max_flow, picked.sum())
+    return sp.csr_matrix((flows, (o[picked], d[picked])), shape=(n_stations, n_stations))
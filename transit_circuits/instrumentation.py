@@ -0,0 +1,72 @@
+from collections import namedtuple
+
+import numpy as np
+
+PHASES = ('build_s', 'compile_s', 'solve_s', 'cache_s', 'save_s')
+
+class ODStats(namedtuple('ODStats', ['origin', 'destination', 'flow', 'engine', 'status', 'n_iter'] + list(PHASES),
+                         defaults=(None,) * (3 + len(PHASES)))):
+    '''
+    The timings and solver statistics of one OD pair of TransitNetwork.calculate_flows.
+    Attributes:
+    - origin, destination: the station indices of the OD pair.
+    - flow: the flow of the OD pair.
+    - engine: the engine it was solved with.
+    - status: the solver status, 'cached' if it was read from the unit-flow or disk cache or a checkpoint,
+        or None if it was solved in a batch, per destination or on a worker, where per-OD timings are
+        not available.
+    - n_iter: the number of solver iterations.
+    - build_s: the time to build the circuit, i.e. _build_subcircuit, setting the parameters of the
+        parametric problem or assembling, pruning and reducing the sparse QP, along with expanding its
+        solution to every node.
+    - compile_s: the time cvxpy spent compiling the problem.
+    - solve_s: the time spent in the solver.
+    - cache_s: the time to cache the component voltages.
+    - save_s: the time to save the disaggregated currents.
+    Phases that do not apply to the engine are None.
+    '''
+
+class SolveStats():
+    '''
+    A callback for TransitNetwork.calculate_flows that collects the ODStats of every OD pair, and
+    summarizes them per engine and status.
+    Attributes:
+    - records: the ODStats of every OD pair, in the order they were solved.
+    '''
+    def __init__(self):
+        self.records = []
+
+    def __call__(self, record:ODStats):
+        self.records.append(record)
+
+    def __len__(self):
+        return len(self.records)
+
+    def totals(self) -> dict:
+        '''
+        Returns the total time of every phase, summed over the OD pairs that have it.
+        '''
+        return {phase: sum(getattr(r, phase) or 0. for r in self.records) for phase in PHASES}
+
+    def summary(self) -> str:
+        '''
+        Returns a table with, for every engine and status, the number of OD pairs, the mean iteration
+        count and the mean time of every phase in milliseconds.
+        '''
+        groups = {}
+        for r in self.records:
+            groups.setdefault((r.engine, r.status), []).append(r)
+
+        mean = lambda values: np.mean(values) if values else np.nan
+        header = ['engine', 'status', 'n_od', 'n_iter'] + [phase.replace('_s', '_ms') for phase in PHASES]
+        rows = [header]
+        for (engine, status), records in groups.items():
+            row = [str(engine), str(status), str(len(records))]
+            row.append(f"{mean([r.n_iter for r in records if r.n_iter is not None]):.1f}")
+            for phase in PHASES:
+                times = [getattr(r, phase) for r in records if getattr(r, phase) is not None]
+                row.append(f"{1e3 * mean(times):.3f}")
+            rows.append(row)
+
+        widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+        return '\n'.join('  '.join(cell.rjust(w) for cell, w in zip(row, widths)) for row in rows)
@@ -1,5 +1,26 @@
-from transit_circuits.components import Resistor, Diode, CurrentSource
+from transit_circuits.components import Resistor, Diode, CurrentSource, as_expression
+from transit_circuits.active_set import ActiveSetSolver
+import scipy.sparse as sp
 import cvxpy as cp
+import numpy as np
+
+from time import perf_counter
+
+# The statuses of a successful solve, as cvxpy, Clarabel, and OSQP or the ActiveSetSolver report them.
+SOLVED_STATUSES = (cp.OPTIMAL, 'Solved', 'solved')
+
+class UnsolvedError(ValueError):
+    '''
+    Raised when a solver stops without solving a circuit, e.g. at its iteration limit, before its
+    voltages are cached anywhere.
+    '''
+
+def check_solved(status, what='the circuit'):
+    '''
+    Raises an UnsolvedError if a solver status is not one of SOLVED_STATUSES.
+    '''
+    if status not in SOLVED_STATUSES:
+        raise UnsolvedError(f"The solver did not solve {what}: {status}.")
 
 class Problem():
 
@@ -11,6 +32,8 @@ class Problem():
         self.resistors = []
         self.diodes = []
         self.current_sources = []
+        self.grounds = []
+        self.idle = []
     
     def _add_objective_term(self, obj_term):
         self.objective_terms.append(obj_term)
@@ -36,14 +59,226 @@ class Problem():
             self._add_objective_term(cs.energy)
             self.current_sources.append(cs)
     
-    def _cache_component_voltages(self):
+    def add_idle(self, *components):
+        '''
+        Adds components that are left out of the circuit because no current can flow through them. Their
+        voltage is cached as zero after every solve, so that their history stays aligned with the others.
+        '''
+        self.idle += components
+
+    def add_ground(self, *V:cp.Variable):
+        for v in V:
+            self._add_constraint(as_expression(v) == 0)
+            self.grounds.append(v)
+
+    def _solve_active_set(self, active_set_solver=None, stats=None, key=None):
+        '''
+        Solves the circuit with an ActiveSetSolver instead of cvxpy, and writes the node voltages back
+        into the value of the node Variables. Only circuits of fixed resistors, diodes and current
+        sources, with at least one ground, can be solved this way. The diodes are matched with those of
+        the solver's previous solve by identity, so circuits sharing the network's diodes warm-start
+        each other, whichever of them they leave out.
+        Returns:
+        - the objective value, or None if the active set did not settle.
+        '''
+        if any(r.is_variable for r in self.resistors):
+            raise ValueError("The active set solver does not support variable resistors.")
+        if not self.grounds:
+            raise ValueError("The active set solver needs a ground, see add_ground.")
+        if len(self.constraints) != len(self.diodes) + len(self.grounds):
+            raise ValueError("The active set solver only supports diode and ground constraints.")
+
+        nodes = {}
+        node = lambda v: nodes.setdefault(v.id, (len(nodes), v))[0]
+        incidence = lambda components: np.array([(node(c.source), node(c.drain)) for c in components], dtype=int).reshape(-1, 2)
+        R = incidence(self.resistors)
+        D = incidence(self.diodes)
+        S = incidence(self.current_sources)
+        ground = [node(v) for v in self.grounds]
+        n = len(nodes)
+
+        edge_matrix = lambda edges, data: sp.csr_matrix(
+            (np.column_stack([data, -np.asarray(data)]).ravel(), (np.repeat(np.arange(len(edges)), 2), edges.ravel())),
+            shape=(len(edges), n))
+        A_R = edge_matrix(R, np.ones(len(R)))
+        C = np.array([r.conductance for r in self.resistors], dtype=float)
+        P = A_R.T @ sp.diags(C) @ A_R
+        I = np.array([cs.I.value if isinstance(cs.I, cp.Expression) else cs.I for cs in self.current_sources], dtype=float)
+        q = edge_matrix(S, I).sum(axis=0).A1
+        A = edge_matrix(D, np.ones(len(D)))
+
+        solver = active_set_solver or ActiveSetSolver()
+        t = perf_counter()
+        v, status = solver.solve(P, q, A, ground, key, ids=np.array([id(d) for d in self.diodes], dtype=np.int64))
+        if stats is not None:
+            stats.update(solve_s=perf_counter() - t, n_iter=solver.n_iter, status=status)
+        if status != 'solved':
+            return None
+        for i, var in nodes.values():
+            var.value = v[i]
+        return 0.5 * v @ P @ v + q @ v
+
+    def _cache_component_voltages(self, stats=None):
+        t = None if stats is None else perf_counter()
         [r.cache() for r in self.resistors]
         [d.cache() for d in self.diodes]
-        [c.cache() for c in self.diodes]
+        [c.cache() for c in self.current_sources]
+        [c.cache(0.) for c in self.idle]
+        if stats is not None:
+            stats['cache_s'] = perf_counter() - t
+
+    def _solver_stats(self, stats):
+        '''
+        Records the compilation time, solver time, iteration count and status of the last cvxpy solve.
+        '''
+        if stats is not None:
+            solver_stats = self.problem.solver_stats
+            stats.update(
+                compile_s=self.problem.compilation_time, solve_s=solver_stats.solve_time,
+                n_iter=solver_stats.num_iters, status=self.problem.status,
+            )
     
-    def solve(self, solver=None):
+    def solve(self, solver=None, active_set_solver=None, stats:dict=None, key=None):
+        '''
+        Solves the circuit and caches the component voltages. Raises an UnsolvedError, and caches
+        nothing, if the solver does not solve it.
+        Parameters:
+        - solver: the cvxpy solver to use, or 'ACTIVE_SET' to bypass cvxpy with an ActiveSetSolver, which
+            falls back to Clarabel if the active set does not settle.
+        - active_set_solver: with 'ACTIVE_SET', the ActiveSetSolver to use, which is warm-started from
+            the active set of its previous solve.
+        - key: with 'ACTIVE_SET', the key of the warm start, see ActiveSetSolver.solve.
+        - stats: if given, a dict that the compile, solve and cache times, the iteration count and the
+            status of the solve are written to, see instrumentation.ODStats.
+        '''
+        rv = None
+        if solver == 'ACTIVE_SET':
+            rv = self._solve_active_set(active_set_solver, stats, key)
+            solver = cp.CLARABEL
+        if rv is None:
+            self.problem = cp.Problem(cp.Minimize(self.objective), self.constraints)
+            rv = self.problem.solve(solver)
+            self._solver_stats(stats)
+            check_solved(self.problem.status)
+        self._cache_component_voltages(stats)
+        return rv
+        
+
+class ParametricProblem(Problem):
+    '''
+    A Problem over a whole transit network that is compiled once as a DPP-compliant cvxpy problem.
+    The conductances, the origin, destination and flow of the trip are cp.Parameters, so solving for a
+    new OD pair, or after a change of frequency or speed, only changes parameter values and cvxpy
+    reuses its canonicalization.
+    Attributes:
+    - conductance: Parameter with the conductance of every network resistor, in the order they were added.
+    - origin_conductance: Parameter with the conductance of every origin resistor, which is zero for
+        every station but the trip's origin.
+    - destination: one-hot Parameter over the stations, selecting which destination node is the sink.
+    - flow: Parameter with the flow of the current trip.
+    - v_origin, v_destination: the terminals of the trip's current source.
+    - v_destinations: the destination node of every station, in station order.
+    - terminal_resistors, terminal_diodes: the origin resistors and destination diodes of every station,
+        in station order.
+    '''
+
+    def __init__(self, n_stations:int, n_segments:int):
+        super().__init__()
+        self.conductance = None
+        self.origin_conductance = cp.Parameter(n_segments, nonneg=True, value=np.zeros(n_segments))
+        self.destination = cp.Parameter(n_stations, nonneg=True, value=np.zeros(n_stations))
+        self.flow = cp.Parameter(nonneg=True, value=0.)
+        self.v_origin = cp.Variable()
+        self.v_destination = cp.Variable()
+        self.v_destinations = []
+
+        self.terminal_resistors = []
+        self.terminal_diodes = []
+        self._terminal_rows = []
+        self.problem = None
+
+    def add_network_resistors(self, resistors:list[Resistor]):
+        '''
+        Adds the network resistors with their conductance taken from the conductance parameter, so that
+        it can be updated without compiling the problem again. Their voltages are cached after every solve.
+        '''
+        self.conductance = cp.Parameter(len(resistors), nonneg=True, value=[r.conductance for r in resistors])
+        voltages = cp.hstack([r.voltage for r in resistors])
+        self._add_objective_term(0.5 * cp.sum(cp.multiply(self.conductance, cp.square(voltages))))
+        self.resistors += resistors
+
+    def add_station_terminals(self, v_diodes:list, destination_diodes:list[Diode], v_destination):
+        '''
+        Adds the origin resistors and destination diodes of the next station. The origin resistors'
+        conductance is taken from the origin_conductance parameter, so they take part in the optimization
+        but are not cached, as their conductance changes from one trip to the next.
+        Parameters:
+        - v_diodes: the station's v_diode nodes, which the origin resistors connect v_origin to.
+        - destination_diodes: diodes from the station's v_station nodes to v_destination.
+        - v_destination: the station's destination node.
+        '''
+        offset = sum(len(rows) for rows in self._terminal_rows)
+        rows = list(range(offset, offset + len(v_diodes)))
+        origin_resistors = [Resistor(self.origin_conductance[k], self.v_origin, v) for k, v in zip(rows, v_diodes)]
+        for r in origin_resistors:
+            self._add_objective_term(r.energy)
+        for d in destination_diodes:
+            self._add_constraint(d.constraint)
+        self.terminal_resistors.append(origin_resistors)
+        self.terminal_diodes.append(destination_diodes)
+        self._terminal_rows.append(rows)
+        self.v_destinations.append(v_destination)
+
+    def update_conductance(self, rows, C):
+        '''
+        Sets the conductance of the network resistors in the given rows.
+        '''
+        conductance = np.array(self.conductance.value)
+        conductance[rows] = C
+        self.conductance.value = conductance
+
+    def cache_trip(self, trip, origin_idx:int, destination_idx:int):
+        '''
+        Caches the voltages of the current solution into the components of a Trip.
+        '''
+        for r, r_p in zip(trip._origin_resistors, self.terminal_resistors[origin_idx]):
+            r.cache(r_p.voltage.value)
+        for d, d_p in zip(trip._destination_diodes, self.terminal_diodes[destination_idx]):
+            d.cache(d_p.voltage.value)
+        trip._current_source.cache(self.v_destination.value - self.v_origin.value)
+
+    def set_trip(self, origin_idx:int, destination_idx:int, flow:float, origin_C):
+        '''
+        Sets the parameters of a trip.
+        Parameters:
+        - origin_idx, destination_idx: the station indices of the trip's origin and destination.
+        - flow: the flow of the trip.
+        - origin_C: the conductance of the origin resistors of the origin station.
+        '''
+        origin_conductance = np.zeros(self.origin_conductance.shape)
+        origin_conductance[self._terminal_rows[origin_idx]] = origin_C
+        destination = np.zeros(self.destination.shape)
+        destination[destination_idx] = 1
+
+        self.origin_conductance.value = origin_conductance
+        self.destination.value = destination
+        self.flow.value = flow
+
+    def _compile(self):
+        if self.problem is not None:
+            return
+        self._add_objective_term(CurrentSource(self.flow, self.v_destination, self.v_origin).energy)
+        self._add_constraint(self.v_origin == 0)
+        self._add_constraint(self.v_destination == self.destination @ cp.hstack(self.v_destinations))
+
         self.problem = cp.Problem(cp.Minimize(self.objective), self.constraints)
+        if not self.problem.is_dpp():
+            raise ValueError("The parametric circuit is not DPP-compliant.")
+
+    def solve(self, solver=None, stats:dict=None):
+        self._compile()
         rv = self.problem.solve(solver)
-        self._cache_component_voltages()
+        self._solver_stats(stats)
+        check_solved(self.problem.status)
+        self._cache_component_voltages(stats)
         return rv
-        
\ No newline at end of file
@@ -0,0 +1,55 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+_network = None
+
+def _init_worker(transit_network):
+    '''
+    Initializes a worker process with its own copy of the transit network.
+    '''
+    global _network
+    _network = transit_network
+
+def _solve_batch(batch, engine, solver=None):
+    '''
+    Solves a batch of OD pairs on the worker's network.
+    Parameters:
+    - batch: list of (origin index, destination index, flow) tuples.
+    - engine, solver: the engine and solver passed on to TransitNetwork._solve_od.
+    Returns:
+    - a list with the ODSolution of every OD pair.
+    '''
+    components = _network.compile()
+    # Only the last voltage of each component is needed, so keep the worker's memory flat.
+    for c in components.resistors + components.diodes:
+        c.keep_history = False
+
+    results = []
+    for o, d, flow in batch:
+        origin = _network.stations[o]
+        destination = _network.stations[d]
+        _network._solve_od(origin, destination, flow, engine, solver)
+        results.append(_network._get_od_solution(origin, destination, components))
+    return results
+
+def solve_parallel(transit_network, tasks, workers, engine='cvxpy', batch_size=None, solver=None):
+    '''
+    Solves OD pairs on a pool of worker processes, each holding its own copy of the network.
+    Parameters:
+    - transit_network: the TransitNetwork to solve.
+    - tasks: list of (origin index, destination index, flow) tuples.
+    - workers: the number of worker processes.
+    - engine: the engine each worker solves with.
+    - solver: the solver of the engine, see TransitNetwork.calculate_flows.
+    - batch_size: the number of OD pairs sent to a worker at a time. Defaults to splitting the
+        tasks into four batches per worker.
+    Returns:
+    - a generator of (task, ODSolution) pairs in the order of tasks.
+    '''
+    batch_size = batch_size or max(1, int(np.ceil(len(tasks) / (4 * workers))))
+    batches = [tasks[i:i+batch_size] for i in range(0, len(tasks), batch_size)]
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(transit_network,)) as pool:
+        for batch, results in zip(batches, pool.map(_solve_batch, batches, [engine] * len(batches), [solver] * len(batches))):
+            yield from zip(batch, results)
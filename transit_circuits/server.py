@@ -0,0 +1,254 @@
+'''
+A long-running query service that loads a transit network once, keeps it compiled and answers
+queries over HTTP, so that interactive what-if queries do not pay for imports, network construction
+and compilation every time. Run it with
+    python -m transit_circuits.server --state network.npz --port 8000
+or on a synthetic network with e.g. --kind grid --size 10x10, and query it with
+    curl -X POST localhost:8000/flows -d '{"od": [[0, 5, 100.0], [5, 0, 50.0]]}'
+    curl -X POST localhost:8000/frequency -d '{"line": 0, "frequency_vph": 12}'
+    curl 'localhost:8000/segment_flow?station=3&line=0&direction=1'
+    curl localhost:8000/health
+Stations are given by index and lines by id.
+'''
+from transit_circuits.transit_network import TransitNetwork
+from transit_circuits.generators import make_grid_network, make_radial_network
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+from contextlib import contextmanager
+from time import perf_counter
+import threading
+import argparse
+import json
+
+GENERATORS = {'grid': make_grid_network, 'radial': make_radial_network}
+
+class ServiceBusy(Exception):
+    '''
+    Raised when a NetworkService already has max_pending requests waiting for the network.
+    '''
+
+class NetworkService():
+    '''
+    Holds a compiled TransitNetwork and answers flow and frequency queries on it. Solves and updates
+    change the state of the network's components, so they are serialized by a lock, and at most
+    max_pending of them wait for it at a time, the others are turned away with ServiceBusy. Segment
+    flows are read from the flows of the last solve, which are never changed in place, so reads do
+    not wait for the lock unless a frequency was updated since, in which case the last OD matrix is
+    solved again first.
+    Attributes:
+    - network: the TransitNetwork.
+    - engine, solver: the engine and solver of calculate_flows.
+    - version: the number of solves and updates so far, returned with every answer.
+    '''
+    def __init__(self, network:TransitNetwork, engine='sparse', solver=None, max_pending=8):
+        self.network = network
+        self.engine = engine
+        self.solver = solver
+        self.version = 0
+        self._lines = {line.id: line for line in network.lines}
+        self._lock = threading.Lock()
+        self._admission = threading.BoundedSemaphore(max_pending)
+        self._od = None
+        # The version and segment flows of the last solve.
+        self._flows = None
+
+        network.compile()
+        if engine == 'sparse':
+            network._get_sparse_circuit(solver)
+        elif engine == 'parametric':
+            network._get_parametric_problem()
+
+    @contextmanager
+    def _exclusive(self):
+        if not self._admission.acquire(blocking=False):
+            raise ServiceBusy("Too many pending requests.")
+        try:
+            with self._lock:
+                yield
+        finally:
+            self._admission.release()
+
+    def _line(self, line_id):
+        if line_id not in self._lines:
+            raise ValueError(f"Unknown line {line_id}.")
+        return self._lines[line_id]
+
+    def _solve(self, od):
+        '''
+        Solves an OD matrix from scratch, with the lock held. Repeated OD pairs are scaled from the
+        network's unit-flow cache until a frequency changes.
+        '''
+        start = perf_counter()
+        self.network.reset()
+        self.network.calculate_flows(od, engine=self.engine, solver=self.solver, use_cache=True, keep_history=False,
+                                     progress=False)
+        self.version += 1
+        self._od = od
+        self._flows = self.version, self.network.compile().total_segment_currents()
+        return perf_counter() - start
+
+    def flows(self, od) -> dict:
+        '''
+        Solves an OD matrix, replacing the flows of the previous one.
+        Parameters:
+        - od: list of (origin index, destination index, flow) tuples.
+        Returns:
+        - a dict with the version, the number of OD pairs, the solve time in seconds and the flow of
+            every segment, indexed as CompiledNetwork.segments.
+        '''
+        od = [(int(o), int(d), float(flow)) for o, d, flow in od]
+        n_stations = len(self.network.stations)
+        if any(not (0 <= o < n_stations and 0 <= d < n_stations) for o, d, _ in od):
+            raise ValueError("Station index out of range.")
+        with self._exclusive():
+            solve_s = self._solve(od)
+            version, segment_flows = self._flows
+        return {'version': version, 'n_od': len(od), 'solve_s': solve_s, 'segment_flows': segment_flows.tolist()}
+
+    def update_frequency(self, line_id, frequency_vph:float) -> dict:
+        '''
+        Updates the frequency of a line. The segment flows are solved again on the next read.
+        Returns:
+        - a dict with the version.
+        '''
+        line = self._line(line_id)
+        if not frequency_vph > 0:
+            raise ValueError("The frequency must be positive.")
+        with self._exclusive():
+            self.network.update_frequency(line, float(frequency_vph))
+            self.version += 1
+            return {'version': self.version}
+
+    def segment_flow(self, station:int=None, line_id=None, direction:int=None) -> dict:
+        '''
+        Returns the flow of a segment, given by its station index, line id and direction, or of every
+        segment if none is given, as a dict with the version and 'flow' or 'segment_flows'.
+        '''
+        if self._flows is None:
+            raise ValueError("No OD matrix has been solved yet.")
+        version, segment_flows = self._flows
+        if version != self.version:
+            with self._exclusive():
+                if self._flows[0] != self.version:
+                    self._solve(self._od)
+                version, segment_flows = self._flows
+
+        if station is None:
+            return {'version': version, 'segment_flows': segment_flows.tolist()}
+        if not 0 <= station < len(self.network.stations):
+            raise ValueError("Station index out of range.")
+        try:
+            k = self.network.get_segment_index(self.network.stations[station], self._line(line_id), direction)
+        except KeyError:
+            raise ValueError(f"Line {line_id} does not serve station {station} in direction {direction}.")
+        return {'version': version, 'flow': float(segment_flows[k])}
+
+    def health(self) -> dict:
+        return {
+            'version': self.version,
+            'n_stations': len(self.network.stations),
+            'n_lines': len(self.network.lines),
+            'n_segments': self.network.compile().n_segments,
+            'engine': self.engine,
+        }
+
+class _Handler(BaseHTTPRequestHandler):
+    # Keep connections alive between requests, without waiting for delayed ACKs on small replies.
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def _reply(self, status:int, body:dict):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self, route):
+        try:
+            self._reply(200, route())
+        except ServiceBusy as e:
+            self._reply(503, {'error': str(e)})
+        except (ValueError, KeyError, TypeError) as e:
+            self._reply(400, {'error': str(e)})
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        service = self.server.service
+        if url.path == '/health':
+            self._handle(service.health)
+        elif url.path == '/segment_flow':
+            def route():
+                if 'station' not in query:
+                    return service.segment_flow()
+                return service.segment_flow(int(query['station']), int(query['line']), int(query['direction']))
+            self._handle(route)
+        else:
+            self._reply(404, {'error': f"Unknown path {url.path}."})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        service = self.server.service
+        def payload():
+            try:
+                return json.loads(body or b'{}')
+            except json.JSONDecodeError as e:
+                raise ValueError(f"Invalid JSON: {e}")
+        if self.path == '/flows':
+            self._handle(lambda: service.flows(payload()['od']))
+        elif self.path == '/frequency':
+            self._handle(lambda: service.update_frequency(payload()['line'], payload()['frequency_vph']))
+        else:
+            self._reply(404, {'error': f"Unknown path {self.path}."})
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+def make_server(service:NetworkService, host='127.0.0.1', port=0, verbose=False) -> ThreadingHTTPServer:
+    '''
+    Returns an HTTP server for a NetworkService, which handles every connection on its own thread.
+    Call serve_forever to start it, e.g. on a background thread, and shutdown to stop it.
+    Parameters:
+    - host, port: the address to listen on. Port 0 picks a free port, see server.server_address.
+    - verbose: whether to log every request.
+    '''
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    server.service = service
+    server.verbose = verbose
+    return server
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--state', help="a network saved with TransitNetwork.save_state as .npz")
+    parser.add_argument('--kind', choices=list(GENERATORS), default='grid', help="the synthetic network without --state")
+    parser.add_argument('--size', default='5x5', help="the size of the synthetic network, as ROWSxCOLUMNS or RINGSxSPOKES")
+    parser.add_argument('--engine', choices=('cvxpy', 'parametric', 'sparse'), default='sparse')
+    parser.add_argument('--solver', default=None)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-pending', type=int, default=8)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    if args.state:
+        network = TransitNetwork.load_state(args.state)
+    else:
+        network = TransitNetwork(*GENERATORS[args.kind](*(int(n) for n in args.size.split('x'))))
+    service = NetworkService(network, args.engine, args.solver, args.max_pending)
+    server = make_server(service, args.host, args.port, args.verbose)
+    print(f"Serving {len(network.stations)} stations and {len(network.lines)} lines on "
+          f"http://{args.host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+from collections import namedtuple, OrderedDict
+
+import numpy as np
+
+import hashlib
+import os
+
+class ODSolution(namedtuple('ODSolution', ['v_resistors', 'v_diodes', 'v_origin_resistors', 'v_destination_diodes', 'v_current_source'])):
+    '''
+    The component voltages of a solved OD pair.
+    Attributes:
+    - v_resistors, v_diodes: voltages of the network resistors and diodes, in the order of
+        CompiledNetwork.resistors and CompiledNetwork.diodes.
+    - v_origin_resistors, v_destination_diodes, v_current_source: voltages of the trip's components.
+    '''
+    def scale(self, factor):
+        return ODSolution(*(factor * np.asarray(v) for v in self))
+
+    def travel_time(self):
+        '''
+        The total travel time of the trip's riders, in rider-minutes. The voltage of a resistor is its
+        current times its resistance, i.e. the riders through it times the minutes they spend in it,
+        and diodes take no time, so this is the sum of the resistor voltages.
+        '''
+        return float(np.abs(self.v_resistors).sum() + np.abs(self.v_origin_resistors).sum())
+
+class ODFlow(namedtuple('ODFlow', ['origin', 'destination', 'flow', 'segment_currents', 'travel_time', 'status'])):
+    '''
+    The compact result of one OD pair, as yielded by TransitNetwork.iter_flows.
+    Attributes:
+    - origin, destination: the station indices of the OD pair.
+    - flow: the flow of the OD pair.
+    - segment_currents: the current of every line segment, indexed like CompiledNetwork.segments.
+    - travel_time: the total travel time of the OD pair's riders, see ODSolution.travel_time.
+    - status: the solver status, 'cached' if it was read from the disk cache, or None if it was
+        solved in a batch or on a worker.
+    '''
+
+class UnitFlowCache():
+    '''
+    A cache of OD solutions at unit flow. For a fixed OD pair the circuit energy is quadratic and the
+    only fixed node is v_origin == 0, so every voltage scales linearly with the trip's flow, and the
+    solution for any flow is a scaled copy of the unit-flow solution.
+    The cache is tied to a network state (frequencies, speeds and topology of the lines), and is
+    cleared whenever it is accessed with a different state.
+    '''
+    def __init__(self):
+        self._solutions = {}
+        self._state = None
+
+    def __len__(self):
+        return len(self._solutions)
+
+    def _validate(self, state):
+        if state != self._state:
+            self.clear()
+            self._state = state
+
+    def clear(self):
+        self._solutions = {}
+
+    def get(self, state, o:int, d:int, flow:float):
+        '''
+        Returns the cached solution of the OD pair scaled to the given flow, or None if it is not cached.
+        '''
+        self._validate(state)
+        solution = self._solutions.get((o, d))
+        if solution is None:
+            return None
+        return solution.scale(flow)
+
+    def put(self, state, o:int, d:int, flow:float, solution:ODSolution):
+        '''
+        Stores a solution of the OD pair, solved with the given flow, as a unit-flow solution.
+        Solutions with no flow carry no information and are ignored.
+        '''
+        self._validate(state)
+        if flow == 0:
+            return
+        self._solutions[(o, d)] = solution.scale(1 / flow)
+
+class DiskCache():
+    '''
+    A persistent cache of OD solutions at unit flow, stored as one .npz file per OD pair in a directory,
+    so that solutions outlive the process and are shared by every network with the same state.
+    Every file is named after the hash of the network state and the OD pair, i.e. the content it
+    depends on, so a state that changes and changes back finds its solutions again. Once the files
+    exceed max_bytes, the least recently used are deleted.
+    Attributes:
+    - directory: the directory of the cache files, created if it does not exist.
+    - max_bytes: the maximum total size of the cache files.
+    - hits, misses: the number of lookups that found or did not find a solution.
+    '''
+    def __init__(self, directory, max_bytes=2**30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+        # The files in order of last use, with their size, as left by previous processes.
+        files = [f for f in os.scandir(directory) if f.is_file() and f.name.endswith('.npz')]
+        files.sort(key=lambda f: f.stat().st_mtime)
+        self._files = OrderedDict((f.name, f.stat().st_size) for f in files)
+        self._size = sum(self._files.values())
+
+    def __len__(self):
+        return len(self._files)
+
+    @staticmethod
+    def network_key(*parts) -> str:
+        '''
+        Returns the hash of the parts of a network state, arrays or anything with a stable repr.
+        '''
+        h = hashlib.sha256()
+        for part in parts:
+            if isinstance(part, np.ndarray):
+                h.update(str((part.dtype, part.shape)).encode())
+                h.update(np.ascontiguousarray(part).tobytes())
+            else:
+                h.update(repr(part).encode())
+        return h.hexdigest()
+
+    def _name(self, network_key:str, o:int, d:int):
+        return hashlib.sha256(f"{network_key}:{o}:{d}".encode()).hexdigest() + '.npz'
+
+    def get(self, network_key:str, o:int, d:int, flow:float):
+        '''
+        Returns the cached solution of the OD pair scaled to the given flow, or None if it is not cached.
+        '''
+        name = self._name(network_key, o, d)
+        path = os.path.join(self.directory, name)
+        try:
+            with np.load(path) as data:
+                solution = ODSolution(*(data[field] for field in ODSolution._fields))
+            os.utime(path)
+        except (FileNotFoundError, OSError, KeyError, ValueError):
+            # Missing, evicted by another process, or partially written.
+            self._files.pop(name, None)
+            self.misses += 1
+            return None
+
+        if name not in self._files:
+            self._files[name] = os.path.getsize(path)
+            self._size += self._files[name]
+        self._files.move_to_end(name)
+        self.hits += 1
+        return solution.scale(flow)
+
+    def put(self, network_key:str, o:int, d:int, flow:float, solution:ODSolution):
+        '''
+        Stores a solution of the OD pair, solved with the given flow, as a unit-flow solution, and evicts
+        the least recently used solutions beyond max_bytes. Solutions with no flow are ignored.
+        '''
+        if flow == 0:
+            return
+        name = self._name(network_key, o, d)
+        path = os.path.join(self.directory, name)
+        # Write to a temporary file and rename it, so that readers never see a partial file.
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as file:
+            np.savez(file, **solution.scale(1 / flow)._asdict())
+        os.replace(tmp, path)
+
+        size = os.path.getsize(path)
+        self._size += size - self._files.pop(name, 0)
+        self._files[name] = size
+        self._evict()
+
+    def _evict(self):
+        while self._size > self.max_bytes and len(self._files) > 1:
+            name, size = self._files.popitem(last=False)
+            self._size -= size
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        '''
+        Deletes every cache file.
+        '''
+        for name in self._files:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+        self._files = OrderedDict()
+        self._size = 0
@@ -0,0 +1,555 @@
+from transit_circuits.solution_cache import ODSolution
+from transit_circuits.active_set import ActiveSetSolver, diode_edges, merge_shorted_nodes
+from transit_circuits.optimization import SOLVED_STATUSES
+
+import scipy.sparse as sp
+import scipy.sparse.linalg as spla
+import scipy.sparse.csgraph as csgraph
+import numpy as np
+import clarabel
+import osqp
+
+from time import perf_counter
+
+class SparseCircuit():
+    '''
+    The circuit of a transit network assembled directly as scipy.sparse matrices, which bypasses cvxpy
+    expression trees altogether. For a trip from o to d with flow I, the node voltages v solve the QP
+        minimize    0.5 v' A_R' G A_R v + I (v_destination - v_origin)
+        subject to  A_D v <= 0, v_origin = 0
+    where A_R is the node-incidence matrix of the resistors, G their diagonal conductance matrix and
+    A_D the node-incidence matrix of the diodes.
+    Attributes:
+    - network: the CompiledNetwork the matrices are built from.
+    - resistors, diodes: the network components, in the order of the rows of A_R and A_D.
+    - A_R, G, A_D: the incidence, conductance and diode matrices of the network components.
+    - L: the Laplacian A_R' G A_R of the network components.
+    - origin, destination: the indices of the trip's terminal nodes.
+    - active_set: the ActiveSetSolver used by the 'ACTIVE_SET' solver, which keeps a warm start for
+        every destination.
+    - n_iter: the number of iterations of the last solve.
+    - duals: the dual multipliers of the constraints of the last QP solved, i.e. the currents of its diodes.
+    - conducting: the conducting diodes of the last trip solved, a mask over the rows of A_D followed by
+        the destination diode of every segment, see _conducting.
+    - prune: whether solve only passes the solver the nodes on a path from the origin to the destination,
+        see CompiledNetwork.od_nodes.
+    - n_pruned: the number of nodes left out of the last solve.
+    - reduce: whether solve collapses the chains of pass-through segments into equivalent resistors.
+    - n_reduced: the number of nodes eliminated by the reduction in the last solve.
+    '''
+    SOLVERS = ('CLARABEL', 'OSQP', 'ACTIVE_SET')
+
+    def __init__(self, transit_network, solver='CLARABEL', prune=True, reduce=True):
+        '''
+        Constructor for a SparseCircuit.
+        Parameters:
+        - transit_network: the TransitNetwork whose topology the matrices are built from.
+        - solver: the QP solver to use, 'CLARABEL', 'OSQP', or 'ACTIVE_SET', which iterates on the set
+            of conducting diodes with sparse linear solves and falls back to Clarabel if it does not settle.
+        - prune: whether to leave the nodes that cannot carry the trip's current out of every solve.
+        - reduce: whether to solve for the nodes of pass-through segments in closed form, see solve.
+        '''
+        if solver not in self.SOLVERS:
+            raise ValueError(f"Unknown solver {solver}, use one of {self.SOLVERS}.")
+        self.solver = solver
+        self.active_set = ActiveSetSolver()
+        self.n_iter = None
+        self.duals = None
+        self.conducting = None
+        self.prune = prune
+        self.n_pruned = 0
+        self.reduce = reduce
+        self.n_reduced = 0
+
+        self.network = transit_network.compile()
+        self.resistors = self.network.resistors
+        self.diodes = self.network.diodes
+
+        self.origin = self.network.n_nodes
+        self.destination = self.origin + 1
+        self.n = self.origin + 2
+
+        self.A_R = self.network.incidence(self.network.resistor_edges, self.n)
+        self.G = sp.diags(self.network.resistor_C)
+        self.A_D = self.network.incidence(self.network.diode_edges, self.n)
+        self.L = (self.A_R.T @ self.G @ self.A_R).tocsc()
+
+    def update_conductance(self, rows, old_C):
+        '''
+        Updates G and L in place after the conductance of some resistors changed in the network, by
+        adding the low-rank change A_R[rows]' (C - old_C) A_R[rows] to the Laplacian.
+        Parameters:
+        - rows: the rows of the changed resistors.
+        - old_C: their conductance before the change.
+        '''
+        delta = self.network.resistor_C[rows] - old_C
+        A = self.A_R[rows]
+        self.G = sp.diags(self.network.resistor_C)
+        self.L = (self.L + A.T @ sp.diags(delta) @ A).tocsc()
+
+    def _origin_incidence(self, o):
+        v_diode = self.network.segment_v_diode(self.network.station_segments[o])
+        edges = np.column_stack([np.full(len(v_diode), self.origin), v_diode])
+        return self.network.incidence(edges, self.n)
+
+    def _destination_incidence(self, d):
+        v_station = self.network.segment_v_station(self.network.station_segments[d])
+        edges = np.column_stack([v_station, np.full(len(v_station), self.destination)])
+        return self.network.incidence(edges, self.n)
+
+    def _assemble(self, o, d, flow):
+        '''
+        Assembles the QP of a trip from station index o to station index d as (P, q, A, eq), where the
+        rows of A flagged in eq are equality constraints A x = 0 and the others inequalities A x <= 0.
+        '''
+        A_o = self._origin_incidence(o)
+        P = self.L + A_o.T @ sp.diags(self.network.station_origin_C[o]) @ A_o
+
+        q = np.zeros(self.n)
+        q[self.destination] = flow
+        q[self.origin] = -flow
+
+        ground = sp.csr_matrix(([1.], ([0], [self.origin])), shape=(1, self.n))
+        A = sp.vstack([ground, self.A_D, self._destination_incidence(d)])
+        eq = np.zeros(A.shape[0], dtype=bool)
+        eq[0] = True
+        return P.tocsc(), q, A.tocsc(), eq
+
+    def _constraint_ids(self, d):
+        '''
+        Returns an identifier of every row of the constraints of _assemble that is the same in the QPs of
+        every trip: -1 for the ground, the row in A_D for the network diodes, and the number of diodes
+        plus the segment for the destination diodes.
+        '''
+        return np.concatenate([[-1], np.arange(len(self.diodes)), len(self.diodes) + self.network.station_segments[d]])
+
+    def _solve_qp(self, P, q, A, eq, key=None, ids=None):
+        if self.solver == 'ACTIVE_SET':
+            # The equality rows are the grounds, which only have a single entry.
+            ground = sp.csr_matrix(A[eq]).indices
+            v, status = self.active_set.solve(P, q, A[~eq], ground, key, None if ids is None else ids[~eq])
+            self.n_iter = self.active_set.n_iter
+            if status == 'solved':
+                self.duals = np.zeros(A.shape[0])
+                self.duals[~eq] = self.active_set.currents
+                return v, status
+
+        if self.solver == 'OSQP':
+            l = np.where(eq, 0, -np.inf)
+            u = np.zeros(A.shape[0])
+            solver = osqp.OSQP()
+            solver.setup(P=sp.triu(P, format='csc'), q=q, A=A, l=l, u=u, verbose=False,
+                         eps_abs=1e-9, eps_rel=1e-9, polishing=True)
+            result = solver.solve()
+            self.n_iter = result.info.iter
+            self.duals = result.y
+            return result.x, result.info.status
+
+        # Clarabel takes the constraints as consecutive blocks of cones.
+        cones = []
+        breaks = np.flatnonzero(np.diff(eq)) + 1
+        for block in np.split(eq, breaks):
+            cone = clarabel.ZeroConeT if block[0] else clarabel.NonnegativeConeT
+            cones.append(cone(len(block)))
+
+        settings = clarabel.DefaultSettings()
+        settings.verbose = False
+        solver = clarabel.DefaultSolver(sp.triu(P, format='csc'), q, A, np.zeros(A.shape[0]), cones, settings)
+        solution = solver.solve()
+        self.n_iter = solution.iterations
+        self.duals = np.array(solution.z)
+        return np.array(solution.x), str(solution.status)
+
+    def _conducting(self, v, q, A, eq):
+        '''
+        Returns the mask of the inequality constraints of the QP solved last that are active, i.e. of its
+        conducting diodes, from its dual multipliers. A diode conducts if its current, relative to the
+        currents injected, exceeds its reverse voltage, relative to the voltages. At a solution, one of
+        the two is zero, up to the solver's accuracy, which is relative to the same scales, so the
+        decision does not depend on the flow. Diodes with neither current nor voltage do not conduct.
+        '''
+        tiny = np.finfo(float).tiny
+        reverse = -(sp.csr_matrix(A)[~eq] @ v)
+        return self.duals[~eq] / max(np.abs(q).max(), tiny) > reverse / max(np.abs(v).max(), tiny)
+
+    def solve(self, o:int, d:int, flow:float, stats:dict=None):
+        '''
+        Solves for the node voltages of a trip.
+
+        Current can only ride through a pass-through segment whose station is neither the trip's origin
+        nor its destination, so its travel direction diode conducts and its two nodes are one. With
+        reduce, these nodes are merged and every chain of them is eliminated from the QP, which leaves a
+        single equivalent resistor between the ends of the chain, and their voltages are recovered from
+        those of the ends once the reduced QP is solved.
+        Parameters:
+        - o: index of the origin station.
+        - d: index of the destination station.
+        - flow: the flow of the trip.
+        - stats: if given, a dict that the time spent in the solver, the time spent building the QP and
+            recovering every node voltage from its solution, the iteration count and the status are
+            written to, see instrumentation.ODStats.
+        Returns:
+        - v: the node voltages, indexed like the columns of A_R.
+        - status: the solver status.
+        '''
+        start = None if stats is None else perf_counter()
+        qp = self._assemble(o, d, flow)
+        ids = self._constraint_ids(d)
+        nodes = np.arange(self.n)
+        if self.prune:
+            keep = np.concatenate([self.network.od_nodes(o, d), [True, True]])
+            qp, ids = self._prune_qp(*qp, keep, ids)
+            nodes = np.flatnonzero(keep)
+        reduction = None
+        # The diodes left out by pruning carry no current, and those merged by the reduction conduct.
+        self.conducting = np.zeros(len(self.diodes) + self.network.n_segments, dtype=bool)
+        if self.reduce:
+            kept = ids
+            qp, ids, reduction = self._reduce_qp(*qp, nodes, o, d, ids)
+            self.conducting[np.setdiff1d(kept[kept >= 0], ids)] = True
+
+        if stats is not None:
+            build_s = perf_counter() - start
+            start = perf_counter()
+        v, status = self._solve_qp(*qp, key=d, ids=ids)
+        if stats is not None:
+            solve_s = perf_counter() - start
+            start = perf_counter()
+        eq = qp[3]
+        self.conducting[ids[~eq]] = self._conducting(v, *qp[1:])
+        if reduction is not None:
+            v = self._expand_reduced(v, *reduction)
+        if self.prune:
+            v = self._fill_pruned(v, keep)
+        if stats is not None:
+            stats.update(build_s=build_s + perf_counter() - start, solve_s=solve_s, n_iter=self.n_iter, status=status)
+        return v, status
+
+    def _prune_qp(self, P, q, A, eq, keep, ids):
+        '''
+        Restricts a QP to the kept nodes. The constraints on pruned nodes are dropped, as the voltages of
+        pruned nodes are free to satisfy them.
+        Returns:
+        - the pruned QP (P, q, A, eq).
+        - the identifiers of its constraints, from those of the QP's constraints, ids.
+        '''
+        self.n_pruned = int((~keep).sum())
+        nodes = np.flatnonzero(keep)
+        A = sp.csr_matrix(A)
+        rows = abs(A) @ (~keep).astype(float) == 0
+        return (P[nodes][:, nodes], q[nodes], A[rows][:, nodes].tocsc(), eq[rows]), ids[rows]
+
+    def _reduce_qp(self, P, q, A, eq, nodes, o, d, ids):
+        '''
+        Eliminates the pass-through segments from a QP over the given nodes, by merging the two nodes of
+        every segment and taking the Schur complement of the merged nodes in P. Their constraints are
+        only the diodes they merge, and their linear terms are zero, so the reduced QP is exact.
+        Returns:
+        - the reduced QP (P, q, A, eq).
+        - the identifiers of its constraints, from those of the QP's constraints, ids.
+        - (W, boundary, interior, X): the matrix mapping the merged nodes to the QP's nodes, the merged
+            nodes left in and eliminated from the reduced QP, and the matrix giving the voltages of the
+            eliminated nodes from those of the others.
+        '''
+        index = np.full(self.n, -1)
+        index[nodes] = np.arange(len(nodes))
+        segments = np.flatnonzero(self.network.pass_through)
+        segments = segments[~np.isin(self.network.segment_station[segments], [o, d])]
+        v_station = index[self.network.segment_v_station(segments)]
+        v_diode = index[self.network.segment_v_diode(segments)]
+        present = (v_station >= 0) & (v_diode >= 0)
+        v_station, v_diode = v_station[present], v_diode[present]
+        self.n_reduced = 2 * len(v_diode)
+        if not len(v_diode):
+            return (P, q, A, eq), ids, None
+
+        target = np.arange(len(nodes))
+        target[v_station] = v_diode
+        _, target = np.unique(target, return_inverse=True)
+        W = sp.csr_matrix((np.ones(len(nodes)), (np.arange(len(nodes)), target)))
+        is_interior = np.zeros(W.shape[1], dtype=bool)
+        is_interior[target[v_diode]] = True
+        interior, boundary = np.flatnonzero(is_interior), np.flatnonzero(~is_interior)
+
+        P = (W.T @ P @ W).tocsc()
+        P_I = P[:, interior].T.tocsc()
+        P_II = P_I[:, interior]
+        P_IB = P_I[:, boundary].tocoo()
+        # The chains are disjoint paths of merged nodes, each joined to the rest of the circuit at its
+        # ends, so a single solve per end gives the voltages of every chain in terms of those of that end.
+        n_chains, chain = csgraph.connected_components(P_II, directed=False)
+        pairs = np.unique(np.column_stack([chain[P_IB.row], P_IB.col]), axis=0)
+        side = np.arange(len(pairs)) - np.searchsorted(pairs[:, 0], pairs[:, 0])
+        lu = spla.splu(P_II)
+        rows, cols, data = [], [], []
+        for s in range(side.max() + 1):
+            end = np.full(n_chains, -1)
+            end[pairs[side == s, 0]] = pairs[side == s, 1]
+            picked = end[chain[P_IB.row]] == P_IB.col
+            x = -lu.solve(np.bincount(P_IB.row[picked], P_IB.data[picked], minlength=len(interior)))
+            has_end = np.flatnonzero(end[chain] >= 0)
+            rows.append(has_end)
+            cols.append(end[chain[has_end]])
+            data.append(x[has_end])
+        X = sp.csr_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+                          shape=(len(interior), len(boundary)))
+
+        P = (P[:, boundary].T.tocsc()[:, boundary] + P_IB.T @ X).tocsc()
+        A = sp.csr_matrix(A @ W)
+        # The merged diodes are left with empty rows.
+        A.eliminate_zeros()
+        rows = (A.getnnz(axis=1) > 0) & (abs(A) @ is_interior.astype(float) == 0)
+        return (P, (W.T @ q)[boundary], A[rows][:, boundary].tocsc(), eq[rows]), ids[rows], (W, boundary, interior, X)
+
+    def _expand_reduced(self, v_boundary, W, boundary, interior, X):
+        '''
+        Returns the voltages of the nodes of a QP from those of the nodes left by _reduce_qp.
+        '''
+        v = np.zeros(W.shape[1])
+        v[boundary] = v_boundary
+        v[interior] = X @ v_boundary
+        return W @ v
+
+    def _fill_pruned(self, v_kept, keep):
+        '''
+        Returns the voltages of every node from those of the kept nodes. A group of pruned nodes joined by
+        resistors is attached by resistors to at most one kept node, or it would lie on a path between
+        them, and it takes that node's voltage, so that no current flows through pruned resistors.
+        '''
+        v = np.zeros(self.n)
+        v[keep] = v_kept
+        edges = self.network.resistor_edges
+        edges = edges[~(keep[edges[:, 0]] & keep[edges[:, 1]])]
+        graph = sp.csr_matrix((np.ones(len(edges)), (edges[:, 0], edges[:, 1])), shape=(self.n, self.n))
+        _, labels = csgraph.connected_components(graph, directed=False)
+        group_v = np.zeros(labels.max() + 1)
+        group_v[labels[keep]] = v[keep]
+        v[~keep] = group_v[labels[~keep]]
+        return v
+
+    def solve_batch(self, trips:list):
+        '''
+        Solves a batch of independent trips in a single solver call, by stacking their QPs into one
+        block-diagonal QP. This pays the solver's setup and factorization once per batch rather than
+        once per trip.
+        Parameters:
+        - trips: list of (origin index, destination index, flow) tuples.
+        Returns:
+        - V: array with the node voltages of every trip, one row per trip.
+        - status: the solver status of the batch.
+        '''
+        blocks = [self._assemble(o, d, flow) for o, d, flow in trips]
+        P = sp.block_diag([b[0] for b in blocks], format='csc')
+        q = np.concatenate([b[1] for b in blocks])
+        A = sp.block_diag([b[2] for b in blocks], format='csc')
+        eq = np.concatenate([b[3] for b in blocks])
+
+        v, status = self._solve_qp(P, q, A, eq)
+        return v.reshape(len(trips), self.n), status
+
+    def _assemble_destination(self, d, origins, flows):
+        '''
+        Assembles the QP of the trips from several origins to station index d, with one origin node and
+        current source per origin and the destination node as their common, grounded sink. Every origin
+        resistor is in series with a diode towards its segment, so that the current of one origin cannot
+        ride through the origin node of another, which its own circuit does not have.
+        Returns:
+        - the QP (P, q, A, eq), over the nodes of the network, then the destination node, the origin
+            node of every origin and the internal nodes of their origin resistors.
+        - origin_nodes: the origin node of every origin.
+        '''
+        n_nodes = self.network.n_nodes
+        destination = n_nodes
+        origin_nodes = n_nodes + 1 + np.arange(len(origins))
+        segments = [self.network.station_segments[o] for o in origins]
+        n_internal = sum(len(k) for k in segments)
+        n = n_nodes + 1 + len(origins) + n_internal
+
+        internal = origin_nodes[-1] + 1 + np.arange(n_internal) if n_internal else np.zeros(0, dtype=int)
+        origin_edges = np.column_stack([np.repeat(origin_nodes, [len(k) for k in segments]), internal])
+        origin_C = np.concatenate([self.network.station_origin_C[o] for o in origins])
+        A_o = self.network.incidence(origin_edges, n)
+        P = sp.block_diag([self.L[:n_nodes, :n_nodes], sp.csc_matrix((n - n_nodes, n - n_nodes))])
+        P = P + A_o.T @ sp.diags(origin_C) @ A_o
+
+        q = np.zeros(n)
+        q[destination] = np.sum(flows)
+        q[origin_nodes] = -np.asarray(flows, dtype=float)
+
+        v_station = self.network.segment_v_station(self.network.station_segments[d])
+        ground = sp.csr_matrix(([1.], ([0], [destination])), shape=(1, n))
+        A = sp.vstack([
+            ground,
+            self.network.incidence(self.network.diode_edges, n),
+            self.network.incidence(np.column_stack([internal, self.network.segment_v_diode(np.concatenate(segments))]), n),
+            self.network.incidence(np.column_stack([v_station, np.full(len(v_station), destination)]), n),
+        ])
+        eq = np.zeros(A.shape[0], dtype=bool)
+        eq[0] = True
+        return (P.tocsc(), q, A.tocsc(), eq), origin_nodes
+
+    def solve_destination(self, d:int, origins, flows, tol=1e-6):
+        '''
+        Solves the trips from several origins to station index d in a single QP, with one current source
+        per origin and a common sink, and disaggregates its solution by origin.
+
+        The aggregated solution is the sum of the separate solutions of the trips if, and only if, the
+        separate solutions agree on which diodes conduct, since the circuit is linear once that is
+        fixed. Then the conducting diodes of the aggregated solution short their nodes together, and the
+        separate solutions follow from a single factorization of the resulting linear system, with one
+        back-substitution per origin. Every solution found that way is checked against the KKT
+        conditions of its own trip: its origin must be connected to the destination, no conducting
+        diode may carry its current backwards, and the blocking diodes must leave room for the voltages
+        of the nodes it does not reach. The check fails when a trip's current would ride against the
+        current of other trips, which the aggregated solution nets out. This happens when the lines form
+        loops that trips to the destination travel in both directions. It holds when the lines form a
+        tree. The trips that fail the check are solved separately, so the results are exact either way,
+        and so is every trip if the solver does not solve the aggregated QP.
+        Parameters:
+        - d: index of the destination station.
+        - origins: the indices of the origin stations.
+        - flows: the flow of every trip.
+        - tol: the relative tolerance of the check.
+        Returns:
+        - V: array with the node voltages of every trip, one row per origin, indexed like those of solve.
+        - aggregated: the mask of the trips whose solution was disaggregated, the others were solved
+            separately.
+        - statuses: the solver status of every trip, that of the aggregated QP for the disaggregated ones.
+        '''
+        flows = np.asarray(flows, dtype=float)
+        (P, q, A, eq), origin_nodes = self._assemble_destination(d, origins, flows)
+        n = len(q)
+        # The voltages are linear in the flows, and the solvers are more reliable with unit total flow.
+        v, status = self._solve_qp(P, q / flows.sum(), A, eq)
+        if status not in SOLVED_STATUSES:
+            single = np.zeros((len(origins), self.n))
+            statuses = [None] * len(origins)
+            for i in range(len(origins)):
+                single[i], statuses[i] = self.solve(origins[i], d, flows[i])
+            return single, np.zeros(len(origins), dtype=bool), statuses
+        conducting = self._conducting(v, q, A, eq)
+        v *= flows.sum()
+
+        destination = self.network.n_nodes
+        edges = diode_edges(A[~eq])
+        shorts = edges[conducting]
+        _, column, n_free = merge_shorted_nodes(n, shorts, [destination])
+        free = np.flatnonzero(column >= 0)
+        W = sp.csr_matrix((np.ones(len(free)), (free, column[free])), shape=(n, n_free))
+
+        # The same regularization as the active set solver, for nodes only connected through diodes.
+        P_reg = P + 1e-10 * max(P.diagonal().mean(), 1) * sp.eye(n)
+        Q = sp.csc_matrix((-flows, (origin_nodes, np.arange(len(origins)))), shape=(n, len(origins)))
+        U = spla.splu((W.T @ P_reg @ W).tocsc()).solve(-np.asarray((W.T @ Q).todense()).reshape(n_free, -1))
+        V = W @ U
+
+        # The diode currents lam of every trip solve A_c' lam = -(P v + q) on the conducting diodes A_c.
+        # Grounding one node of every group of shorted nodes, the destination in its group, gives the
+        # least norm currents lam = A_c y, which are the only ones unless the conducting diodes form loops.
+        A_c = self.network.incidence(shorts, n)
+        L_c = (A_c.T @ A_c).tocsc()
+        n_groups, labels = csgraph.connected_components(L_c, directed=False)
+        grounded = np.full(n_groups, -1)
+        grounded[labels[::-1]] = np.arange(n)[::-1]
+        grounded[labels[destination]] = destination
+        rest = np.setdiff1d(np.arange(n), grounded)
+        R = P @ V + Q.toarray()
+        Y = np.zeros_like(V)
+        if len(rest):
+            Y[rest] = spla.splu(L_c[rest][:, rest]).solve(-R[rest].reshape(len(rest), -1))
+        lam = A_c @ Y
+        aggregated = (lam >= -tol * flows).all(axis=0)
+
+        # The nodes joined to the destination by resistors and conducting diodes have the voltages of
+        # V, but every other group of nodes carries no current and only has a voltage up to a constant,
+        # which the blocking diodes must leave room for.
+        _, groups = csgraph.connected_components(abs(P) + L_c, directed=False)
+        aggregated &= groups[origin_nodes] == groups[destination]
+        blocking = edges[~conducting]
+        for i in np.flatnonzero(aggregated):
+            aggregated[i] = self._blocking_feasible(V[:, i], blocking, groups, groups[destination],
+                                                    tol * max(1, np.abs(V[:, i]).max()))
+
+        single = np.zeros((len(origins), self.n))
+        single[:, :self.network.n_nodes] = V[:self.network.n_nodes].T
+        single[:, self.origin] = V[origin_nodes, np.arange(len(origins))]
+        single[:, self.destination] = V[destination]
+        single -= single[:, [self.origin]]
+        statuses = [status] * len(origins)
+        for i in np.flatnonzero(~aggregated):
+            single[i], statuses[i] = self.solve(origins[i], d, flows[i])
+        return single, aggregated, statuses
+
+    def _blocking_feasible(self, v, blocking, groups, anchored, tol):
+        '''
+        Returns whether the voltages v, shifted by a constant on every group of nodes but the anchored
+        one, can satisfy the blocking diodes. Their constraints v_a + c_A <= v_b + c_B are difference
+        constraints between the groups, which are feasible if, and only if, the graph with an edge of
+        weight v_b - v_a from group B to group A has no negative cycle.
+        '''
+        a, b = groups[blocking[:, 0]], groups[blocking[:, 1]]
+        w = v[blocking[:, 1]] - v[blocking[:, 0]] + tol
+        if (w[(a == anchored) & (b == anchored)] < 0).any():
+            return False
+        across = a != b
+        if not across.any():
+            return True
+        a, b, w = a[across], b[across], w[across]
+        # Only the lightest of parallel edges matters, and a last node with an edge to every group
+        # reaches every cycle.
+        order = np.lexsort((w, a, b))
+        first = np.unique(np.column_stack([b, a])[order], axis=0, return_index=True)[1]
+        n_groups = groups.max() + 1
+        rows = np.concatenate([b[order][first], np.full(n_groups, n_groups)])
+        cols = np.concatenate([a[order][first], np.arange(n_groups)])
+        weights = np.concatenate([w[order][first], np.ones(n_groups)])
+        graph = sp.csr_matrix((weights, (rows, cols)), shape=(n_groups + 1, n_groups + 1))
+        try:
+            csgraph.bellman_ford(graph, indices=n_groups)
+        except csgraph.NegativeCycleError:
+            return False
+        return True
+
+    def voltage_sensitivities(self, v, o:int, d:int, dG, dG_origin, conducting):
+        '''
+        Differentiates the node voltages of a solved trip with respect to parameters of the conductances,
+        through the KKT conditions of its QP. The conducting diodes of the solution are taken to keep
+        conducting and the others to keep blocking, so the conducting diodes short their nodes together
+        and the KKT conditions reduce to a linear system over the merged nodes. It is factorized once for
+        all the parameters.
+        Parameters:
+        - v: the node voltages of the trip from station index o to station index d.
+        - dG: sparse matrix with the derivative of the conductance of every resistor, one row per parameter.
+        - dG_origin: array with the derivative of the origin conductances of station o, one row per parameter.
+        - conducting: the conducting diodes of the trip, i.e. the attribute conducting once it is solved.
+        Returns:
+        - dv: array with the derivative of the node voltages, one row per parameter.
+        '''
+        P, _, A, eq = self._assemble(o, d, 0.)
+        ground = sp.csr_matrix(A[eq]).indices
+        edges = diode_edges(A[~eq])
+        conducting = np.concatenate([conducting[:len(self.diodes)], conducting[len(self.diodes) + self.network.station_segments[d]]])
+        shorts = np.vstack([edges[conducting], np.column_stack([np.full(len(ground) - 1, ground[0]), ground[1:]])])
+        _, column, n_free = merge_shorted_nodes(self.n, shorts, ground)
+        free = np.flatnonzero(column >= 0)
+        W = sp.csr_matrix((np.ones(len(free)), (free, column[free])), shape=(self.n, n_free))
+
+        # The same regularization as the active set solver, for nodes only connected through diodes.
+        P = P + 1e-10 * max(P.diagonal().mean(), 1) * sp.eye(self.n)
+        A_o = self._origin_incidence(o)
+        dPv = self.A_R.T @ sp.csr_matrix(dG).multiply(self.A_R @ v).T + A_o.T @ (np.atleast_2d(dG_origin) * (A_o @ v)).T
+        du = spla.splu((W.T @ P @ W).tocsc()).solve(-np.asarray(W.T @ dPv).reshape(n_free, -1))
+        return (W @ du).T
+
+    def get_od_solution(self, v, o:int, d:int) -> ODSolution:
+        '''
+        Returns the component voltages of a trip's solution, in the order of resistors and diodes, and
+        of the components of a Trip from station index o to station index d.
+        '''
+        return ODSolution(
+            self.A_R @ v,
+            self.A_D @ v,
+            v[self.origin] - v[self.network.segment_v_diode(self.network.station_segments[o])],
+            v[self.network.segment_v_station(self.network.station_segments[d])] - v[self.destination],
+            v[self.destination] - v[self.origin],
+        )
@@ -1,5 +1,13 @@
-from transit_circuits.components import TTResistor, TransferResistor, Diode, CurrentSource
-from transit_circuits.optimization import Problem
+from transit_circuits.components import Node, TTResistor, TransferResistor, Diode, CurrentSource
+from transit_circuits.optimization import Problem, ParametricProblem, UnsolvedError, check_solved
+from transit_circuits.active_set import ActiveSetSolver
+from transit_circuits.sparse_circuit import SparseCircuit
+from transit_circuits.compiled_network import CompiledNetwork
+from transit_circuits.parallel import solve_parallel
+from transit_circuits.solution_cache import ODSolution, ODFlow, UnitFlowCache, DiskCache
+from transit_circuits.checkpoint import Checkpoint, WorkQueue
+from transit_circuits.flow_tensor import FlowTensor
+from transit_circuits.instrumentation import ODStats
 
 import matplotlib.pyplot as plt
 import networkx as nx
@@ -8,6 +16,10 @@ import numpy as np
 
 from tqdm import tqdm
 
+from collections import defaultdict
+from itertools import groupby
+from time import perf_counter
+import scipy.sparse as sp
 import json
 
 class Line():
@@ -51,18 +63,25 @@ class Line():
         self.frequency_vpm = frequency_vph/60
         for s in self.stations:
             s._update_frequency(self, self.frequency_vpm)
+
+    def _update_speed(self, avg_speed_kph):
+        self.avg_speed_kpm = avg_speed_kph / 60
+        for s in self.stations:
+            for direction in (-1, +1):
+                s.lines[self][direction]._update_speed()
     
     def get_headway(self):
         return 60/self.frequency_vpm
 
 class _LineSegment():
     def __init__(self, line:Line, D_km):
-        self.v_station = cp.Variable()
-        self.v_diode = cp.Variable()
+        self.v_station = Node()
+        self.v_diode = Node()
 
         self.td_diode = Diode(self.v_station, self.v_diode)
         
         self.line = line
+        self.D_km = D_km
         self.travel_time_m = D_km / line.avg_speed_kpm
 
         self.tt_resistor = None
@@ -71,6 +90,11 @@ class _LineSegment():
         self.v_next = v_next
         self.tt_resistor = TTResistor(self.travel_time_m, self.v_diode, self.v_next)
 
+    def _update_speed(self):
+        self.travel_time_m = self.D_km / self.line.avg_speed_kpm
+        if self.tt_resistor is not None:
+            self.tt_resistor.update_travel_time(self.travel_time_m)
+
 class Station():
     def __init__(self, id, x=None, y=None):
         self.lines={}
@@ -80,6 +104,12 @@ class Station():
         self.x = x
         self.y = y
 
+        # Components of the compact transfer model, see _add_compact_transfer_components.
+        self.compact_transfers = False
+        self._transfer_chain_diodes = []
+        self._boarding_diodes = {}
+        self._boarding_resistors = {}
+
     def _add_transfer_components(self, l1:Line):
         self._transfer_diodes[l1] = {
             +1:{l:{+1:{}, -1:{}} for l in self.lines if l != l1}, 
@@ -97,20 +127,68 @@ class Station():
                     component_dict[l2][direction][l1] = {+1:{}, -1:{}}
             for d_l1 in (-1,+1):
                 for d_l2 in (-1,+1):
-                    v_diode1 = cp.Variable()
-                    v_diode2 = cp.Variable()
+                    v_diode1 = Node()
+                    v_diode2 = Node()
                     self._transfer_diodes[l1][d_l1][l2][d_l2] = Diode(self.lines[l1][d_l1].v_station, v_diode1)
                     self._transfer_diodes[l2][d_l2][l1][d_l1] = Diode(self.lines[l2][d_l2].v_station, v_diode2)
                     self._transfer_resistors[l1][d_l1][l2][d_l2] = TransferResistor(l2.frequency_vpm, v_diode1, self.lines[l2][d_l2].v_diode)
                     self._transfer_resistors[l2][d_l2][l1][d_l1] = TransferResistor(l1.frequency_vpm, v_diode2, self.lines[l1][d_l1].v_diode)
 
-    def add_line(self, line, seg_next, seg_prev):
+    def _add_compact_transfer_components(self):
+        '''
+        Builds the transfer components of the station with the compact transfer model, whose size grows
+        linearly with the number of lines rather than with the number of pairs of lines.
+        Every line i alights through diodes to a node a_i, and every (line j, direction) is boarded
+        through a diode from a node e_j and a transfer resistor. Line i must reach e_j for every j != i
+        without passing through resistors, which a chain of prefix nodes (a_i -> P_i -> P_i+1 -> e_i+2 ...)
+        and a chain of suffix nodes (a_i -> S_i -> S_i-1 -> e_i-2 ...) of diodes achieve with O(lines)
+        components.
+        The transfer resistor of a (line, direction) is shared by every segment transferring to it, so
+        the currents are the same as with the full model as long as at most one arriving segment transfers
+        to each departing segment of the station, and differ when the flow of a trip merges there, by
+        up to 16% of the flow of an OD pair, see TransitNetwork.__init__.
+        '''
+        lines = list(self.lines)
+        self._transfer_chain_diodes = []
+        self._boarding_diodes = {}
+        self._boarding_resistors = {}
+        if len(lines) < 2:
+            return
+
+        n = len(lines)
+        a, P, S, e = ([Node() for _ in range(n)] for _ in range(4))
+        chain = self._transfer_chain_diodes
+        for i, line in enumerate(lines):
+            chain += [Diode(self.lines[line][direction].v_station, a[i]) for direction in (+1, -1)]
+            if i + 1 < n:
+                chain += [Diode(a[i], P[i]), Diode(P[i], e[i+1])]
+                if i + 2 < n:
+                    chain.append(Diode(P[i], P[i+1]))
+            if i > 0:
+                chain += [Diode(a[i], S[i]), Diode(S[i], e[i-1])]
+                if i > 1:
+                    chain.append(Diode(S[i], S[i-1]))
+
+        for j, line in enumerate(lines):
+            self._boarding_diodes[line] = {}
+            self._boarding_resistors[line] = {}
+            for direction in (+1, -1):
+                v_boarding = Node()
+                self._boarding_diodes[line][direction] = Diode(e[j], v_boarding)
+                self._boarding_resistors[line][direction] = TransferResistor(
+                    line.frequency_vpm, v_boarding, self.lines[line][direction].v_diode)
+
+    def add_line(self, line, seg_next, seg_prev, compact_transfers=False):
         self.lines[line] = {
             +1: seg_next,
             -1: seg_prev
         }
         
-        self._add_transfer_components(line)
+        self.compact_transfers = compact_transfers
+        if compact_transfers:
+            self._add_compact_transfer_components()
+        else:
+            self._add_transfer_components(line)
 
     def get_transfer_diodes(self, line1: Line, line2: Line) -> list[Diode]:
         return [
@@ -129,6 +207,10 @@ class Station():
         ]
     
     def _update_frequency(self, line, frequency_vpm):
+        if self.compact_transfers:
+            for r in self._boarding_resistors.get(line, {}).values():
+                r.update_frequency(line.frequency_vpm)
+            return
         for l in self.lines:
             if l == line: continue
             tr = self.get_transfer_resistors(l, line)
@@ -140,10 +222,11 @@ class Trip():
         self.origin = origin
         self.destination = destination
         self.flow = flow
-        self._current_source = CurrentSource(flow, source=cp.Variable(), drain=cp.Variable())
+        self._current_source = CurrentSource(flow, source=Node(), drain=Node())
         self._v_origin = self._current_source.drain
         self._v_destination = self._current_source.source
         self._origin_resistors = []
+        self._origin_lines = []
         self._destination_diodes = []
         
         for line in destination.lines:
@@ -152,14 +235,15 @@ class Trip():
         for line in self.origin.lines:
             self._origin_resistors.append(TransferResistor(line.frequency_vpm, self._v_origin, self.origin.lines[line][+1].v_diode))
             self._origin_resistors.append(TransferResistor(line.frequency_vpm, self._v_origin, self.origin.lines[line][-1].v_diode))
+            self._origin_lines += [line, line]
 
-    def _update_frequency(self):
-        self._origin_resistors = []
-        self._destination_diodes = []
-
-        for line in self.origin.lines:
-            self._origin_resistors.append(TransferResistor(line.frequency_vpm, self._v_origin, self.origin.lines[line][+1].v_diode))
-            self._origin_resistors.append(TransferResistor(line.frequency_vpm, self._v_origin, self.origin.lines[line][-1].v_diode))
+    def _update_frequency(self, line:Line):
+        '''
+        Updates, in place, the origin resistors boarding the given line.
+        '''
+        for r, l in zip(self._origin_resistors, self._origin_lines):
+            if l == line:
+                r.update_frequency(line.frequency_vpm)
 
 
 class TransitNetwork():
@@ -168,14 +252,45 @@ class TransitNetwork():
             if station.x and station.y:
                 self.stations_xy[station.x,station.y] = station
     
-    def __init__(self, D:np.array, stations:list[Station], lines:list[Line]):
+    def __init__(self, D:np.array, stations:list[Station], lines:list[Line], compact_transfers=False, disk_cache=None):
+        '''
+        Constructor for a transit network, which builds the line segments and transfer components of
+        every station.
+        Parameters:
+        - D: the matrix of distances between stations in kilometers, indexed by station id.
+        - stations: the list of Station objects.
+        - lines: the list of Line objects.
+        - compact_transfers: whether to model transfers with a single transfer node per station, whose
+            size grows linearly with the number of lines, rather than with components for every pair
+            of (line, direction) at the station. This is an approximation: the segments transferring to
+            a (line, direction) share its transfer resistor, so wherever the flow of a trip reaches it
+            from more than one segment, that flow is penalized as if it had merged, and spreads
+            differently over the network. The currents are only the same as with the full model when
+            no flow merges, e.g. on the cross of utils.make_cross. On utils.make_grid, and on
+            make_grid_network(4, 4) and make_radial_network(2, 6) with equal or mixed (6 to 60 vph)
+            frequencies, most OD pairs differ by more than 1%: the segment currents of an OD pair by up
+            to 16% of its flow, its travel time by up to 15%, and the total segment currents by up to
+            25% of the largest one. Use it to scan large networks, not for their final flows.
+        - disk_cache: a DiskCache, or the directory of one, that calculate_flows reads the OD solutions
+            of the network's current state from, and writes those it solves to.
+        '''
         self.D = D
+        self.compact_transfers = compact_transfers
+        if disk_cache is not None and not isinstance(disk_cache, DiskCache):
+            disk_cache = DiskCache(disk_cache)
+        self.disk_cache = disk_cache
         self.stations = stations
         self.stations_xy = {}
         self.lines = lines
-        self.trips = {o:{d:None for d in self.stations} for o in self.stations}
+        # Trips are only stored for the OD pairs that have been solved.
+        self.trips = defaultdict(dict)
         self._parse_station_coords()
-        self._disaggregated_currents = {}
+        self._disaggregated_currents = None
+        self._compiled = None
+        self._parametric_problem = None
+        self._sparse_circuit = None
+        self._active_set_solver = ActiveSetSolver()
+        self._unit_flow_cache = UnitFlowCache()
 
         for line in self.lines:
             for i, station in enumerate(line.stations):
@@ -193,102 +308,686 @@ class TransitNetwork():
                 seg_next = _LineSegment(line, D_next)
                 seg_prev = _LineSegment(line, D_prev)
                 
-                station.add_line(line, seg_next, seg_prev)
+                station.add_line(line, seg_next, seg_prev, compact_transfers)
                 
                 if i > 0:
                     prev_station.lines[line][+1]._make_resistor(seg_next.v_station)
                     seg_prev._make_resistor(prev_station.lines[line][-1].v_station)
 
-    def _build_subcircuit(self, origin:Station, destination:Station, flow:float, problem:Problem):
-        for s in self.stations:
-            for line1 in s.lines:
-                seg1 = s.lines[line1]
+    def compile(self) -> CompiledNetwork:
+        '''
+        Returns the CompiledNetwork view of the network, built once and rebuilt after frequency updates.
+        '''
+        if self._compiled is None:
+            self._compiled = CompiledNetwork(self)
+        return self._compiled
 
-                problem.add_diode(seg1[+1].td_diode)
-                problem.add_diode(seg1[-1].td_diode)
+    def get_segment_index(self, station:Station, line:Line, direction:int) -> int:
+        '''
+        Returns the index of the line segment leaving a station in the given direction of a line, as
+        used by the disaggregated currents.
+        '''
+        return self.compile().segment_index(station, line, direction)
 
-                R_next = seg1[+1].tt_resistor
-                R_prev = seg1[-1].tt_resistor
+    def _add_network_components(self, problem:Problem):
+        compiled = self.compile()
+        problem.add_diode(*compiled.diodes)
+        problem.add_resistor(*compiled.resistors)
 
-                if R_next is not None:
-                    problem.add_resistor(R_next)
-                if R_prev is not None:
-                    problem.add_resistor(R_prev)
+    def _build_subcircuit(self, origin:Station, destination:Station, flow:float, problem:Problem, prune=False):
+        '''
+        Adds the circuit of an OD pair to a problem: the network components and the components of a new Trip.
+        If prune, only the components on a path from the origin to the destination are added, see
+        CompiledNetwork.od_nodes, and the others are added as idle.
+        '''
+        t = Trip(origin, destination, flow)
+        self.trips[origin][destination] = t
+        if not prune:
+            self._add_network_components(problem)
+            problem.add_resistor(*t._origin_resistors)
+            problem.add_diode(*t._destination_diodes)
+        else:
+            compiled = self.compile()
+            o, d = self.stations.index(origin), self.stations.index(destination)
+            keep = compiled.od_nodes(o, d)
+            split = lambda components, kept: (
+                [c for c, k in zip(components, kept) if k], [c for c, k in zip(components, kept) if not k])
+            diodes, idle_diodes = split(compiled.diodes, keep[compiled.diode_edges].all(axis=1))
+            resistors, idle_resistors = split(compiled.resistors, keep[compiled.resistor_edges].all(axis=1))
+            origin_resistors, idle_origin = split(t._origin_resistors, keep[compiled.segment_v_diode(compiled.station_segments[o])])
+            destination_diodes, idle_destination = split(t._destination_diodes, keep[compiled.segment_v_station(compiled.station_segments[d])])
+            problem.add_diode(*diodes, *destination_diodes)
+            problem.add_resistor(*resistors, *origin_resistors)
+            problem.add_idle(*idle_diodes, *idle_resistors, *idle_origin, *idle_destination)
 
-                for line2 in s.lines:
-                    if line1 == line2:
-                        continue
-                    problem.add_diode(*s.get_transfer_diodes(line1, line2))
-                    problem.add_resistor(*s.get_transfer_resistors(line1, line2))
+        problem.add_current_source(t._current_source)
+        problem.add_ground(t._v_origin)
+
+    def _build_parametric_circuit(self, problem:ParametricProblem):
+        '''
+        Adds every network component to a ParametricProblem, along with the origin resistors and
+        destination diodes of every station. The origin resistors' conductance is a parameter of the
+        problem, so only those of the selected origin conduct.
+        '''
+        compiled = self.compile()
+        problem.add_diode(*compiled.diodes)
+        problem.add_network_resistors(compiled.resistors)
 
+        for segments in compiled.station_segments:
+            v_destination = cp.Variable()
+            v_diodes = [compiled.segments[k].v_diode for k in segments]
+            destination_diodes = [Diode(compiled.segments[k].v_station, v_destination) for k in segments]
+            problem.add_station_terminals(v_diodes, destination_diodes, v_destination)
+
+    def _get_parametric_problem(self):
+        if self._parametric_problem is None:
+            compiled = self.compile()
+            self._parametric_problem = ParametricProblem(len(self.stations), compiled.n_segments)
+            self._build_parametric_circuit(self._parametric_problem)
+        return self._parametric_problem
+
+    def _solve_parametric(self, origin:Station, destination:Station, flow:float, solver=None, stats=None):
+        start = None if stats is None else perf_counter()
+        p = self._get_parametric_problem()
+        o, d = self.stations.index(origin), self.stations.index(destination)
+        p.set_trip(o, d, flow, self.compile().station_origin_C[o])
+        if stats is not None:
+            stats['build_s'] = perf_counter() - start
+        p.solve(solver, stats)
+        start = None if stats is None else perf_counter()
         t = Trip(origin, destination, flow)
         self.trips[origin][destination] = t
+        p.cache_trip(t, o, d)
+        if stats is not None:
+            stats['cache_s'] += perf_counter() - start
+        return p
 
-        problem.add_resistor(*t._origin_resistors)
-        problem.add_diode(*t._destination_diodes)
-        problem.add_current_source(t._current_source)
-        problem._add_constraint(t._v_origin == 0)
+    def _get_sparse_circuit(self, solver=None):
+        solver = solver or 'CLARABEL'
+        if self._sparse_circuit is None or self._sparse_circuit.solver != solver:
+            self._sparse_circuit = SparseCircuit(self, solver)
+        return self._sparse_circuit
 
-    def _save_disaggregated(self, _save_disaggregated, origin, destination):
-        if not _save_disaggregated:
-            return
-        
-        self._disaggregated_currents[origin] = self._disaggregated_currents.get(origin, {})
-        self._disaggregated_currents[origin][destination] = self._disaggregated_currents[origin].get(destination, {})
-        disagg_od = self._disaggregated_currents[origin][destination]
+    def _solve_sparse(self, origin:Station, destination:Station, flow:float, solver=None, stats=None):
+        circuit = self._get_sparse_circuit(solver)
+        o, d = self.stations.index(origin), self.stations.index(destination)
+        v, status = circuit.solve(o, d, flow, stats)
+        check_solved(status, f"OD pair ({o}, {d})")
+        start = None if stats is None else perf_counter()
+        self._cache_od_solution(origin, destination, flow, circuit.get_od_solution(v, o, d), circuit)
+        if stats is not None:
+            stats['cache_s'] = perf_counter() - start
+        return circuit
 
-        for s in self.stations:
-            for line in s.lines:
-                seg = s.lines[line]
+    def _solve_sparse_batches(self, tasks, batch_size, solver=None):
+        '''
+        Solves OD pairs with the sparse engine in block-diagonal batches of batch_size pairs.
+        Returns:
+        - a generator of (task, ODSolution) pairs in the order of tasks.
+        '''
+        circuit = self._get_sparse_circuit(solver)
+        for i in range(0, len(tasks), batch_size):
+            batch = tasks[i:i+batch_size]
+            V, status = circuit.solve_batch(batch)
+            check_solved(status, f"the batch of OD pairs {batch[0][:2]} to {batch[-1][:2]}")
+            for (o, d, flow), v in zip(batch, V):
+                yield (o, d, flow), circuit.get_od_solution(v, o, d)
 
-                R_next = seg[+1].tt_resistor
-                R_prev = seg[-1].tt_resistor
+    def _solve_sparse_destinations(self, tasks, solver=None):
+        '''
+        Solves OD pairs with the sparse engine, in one solve per destination, see SparseCircuit.solve_destination.
+        Parameters:
+        - tasks: list of (origin index, destination index, flow) tuples, grouped by destination.
+        Returns:
+        - a generator of (task, ODSolution) pairs in the order of tasks.
+        '''
+        circuit = self._get_sparse_circuit(solver)
+        for d, group in groupby(tasks, key=lambda task: task[1]):
+            group = list(group)
+            V, _, statuses = circuit.solve_destination(d, [o for o, _, _ in group], [flow for _, _, flow in group])
+            for (o, d, flow), v, status in zip(group, V, statuses):
+                check_solved(status, f"OD pair ({o}, {d})")
+                yield (o, d, flow), circuit.get_od_solution(v, o, d)
 
-                if R_next is not None:
-                    I_next = R_next.history[-1] * R_next.C
-                else:
-                    I_next = 0
-                if R_prev is not None:
-                    I_prev = R_prev.history[-1] * R_prev.C
-                else:
-                    I_prev = 0
+    def _solve_od(self, origin:Station, destination:Station, flow:float, engine='cvxpy', solver=None, stats=None):
+        '''
+        Solves an OD pair with an engine and caches its component voltages. If stats is a dict, the
+        timings and solver statistics of the solve are written to it, see instrumentation.ODStats.
+        '''
+        if engine == 'parametric':
+            return self._solve_parametric(origin, destination, flow, solver, stats)
+        if engine == 'sparse':
+            return self._solve_sparse(origin, destination, flow, solver, stats)
+        start = None if stats is None else perf_counter()
+        previous = self.trips[origin].get(destination)
+        p = Problem()
+        self._build_subcircuit(origin, destination, flow, p, prune=True)
+        if stats is not None:
+            stats['build_s'] = perf_counter() - start
+        try:
+            p.solve(solver, self._active_set_solver, stats, key=destination)
+        except UnsolvedError:
+            # Leave the trips as they were.
+            if previous is None:
+                del self.trips[origin][destination]
+            else:
+                self.trips[origin][destination] = previous
+            raise
+        return p
+
+    def _get_od_solution(self, origin:Station, destination:Station, components) -> ODSolution:
+        '''
+        Returns the component voltages of the last solved OD pair.
+        '''
+        t = self.trips[origin][destination]
+        return ODSolution(
+            np.array([r.last_voltage for r in components.resistors]),
+            np.array([d.last_voltage for d in components.diodes]),
+            np.array([r.last_voltage for r in t._origin_resistors]),
+            np.array([d.last_voltage for d in t._destination_diodes]),
+            t._current_source.last_voltage,
+        )
+
+    def _cache_od_solution(self, origin:Station, destination:Station, flow:float, solution:ODSolution, components):
+        '''
+        Caches an OD pair's component voltages into the components, as if it had just been solved.
+        '''
+        for r, v in zip(components.resistors, solution.v_resistors):
+            r.cache(v)
+        for d, v in zip(components.diodes, solution.v_diodes):
+            d.cache(v)
+
+        t = Trip(origin, destination, flow)
+        self.trips[origin][destination] = t
+        for r, v in zip(t._origin_resistors, solution.v_origin_resistors):
+            r.cache(v)
+        for d, v in zip(t._destination_diodes, solution.v_destination_diodes):
+            d.cache(v)
+        t._current_source.cache(solution.v_current_source)
+
+    def _state(self):
+        '''
+        The frequency, speed and topology state of the network, that determines its OD solutions.
+        '''
+        return tuple(
+            (line.id, line.frequency_vpm, line.avg_speed_kpm, tuple(s.id for s in line.stations))
+            for line in self.lines
+        )
+
+    def _network_key(self):
+        '''
+        The hash of everything that determines the network's OD solutions, that keys the disk cache.
+        '''
+        return DiskCache.network_key(
+            self._state(), tuple(s.id for s in self.stations), self.compact_transfers, np.asarray(self.D, dtype=float),
+        )
+
+    def _save_disaggregated(self, o:int, d:int, solution:ODSolution, dtype=np.float64, layout='dense'):
+        compiled = self.compile()
+        if self._disaggregated_currents is None:
+            self._disaggregated_currents = FlowTensor(len(self.stations), compiled.n_segments, dtype, layout)
+        self._disaggregated_currents.set_od(o, d, compiled.segment_currents(solution.v_resistors))
+
+    def _od_flows(self, OD_trips, origins=None, destinations=None, min_flow=0) -> dict:
+        '''
+        Reads the OD flows in any of the formats accepted by calculate_flows.
+        Returns:
+        - a dict of flows indexed by (origin, destination) Station pairs, without the pairs that are
+            filtered out or whose flow is at most min_flow.
+        '''
+        if isinstance(OD_trips, dict):
+            triples = ((o, d, flow) for o, flows_o in OD_trips.items() for d, flow in flows_o.items())
+        elif sp.issparse(OD_trips):
+            coo = sp.coo_matrix(OD_trips)
+            triples = zip(coo.row.tolist(), coo.col.tolist(), coo.data.tolist())
+        elif isinstance(OD_trips, np.ndarray):
+            o_idx, d_idx = np.nonzero(OD_trips)
+            triples = zip(o_idx.tolist(), d_idx.tolist(), OD_trips[o_idx, d_idx].tolist())
+        else:
+            triples = OD_trips
+
+        station = lambda s: s if isinstance(s, Station) else self.stations[s]
+        origins = None if origins is None else set(origins)
+        destinations = None if destinations is None else set(destinations)
+
+        flows = {}
+        for o, d, flow in triples:
+            origin, destination = station(o), station(d)
+            if origin == destination or flow <= min_flow:
+                continue
+            if origins is not None and origin not in origins:
+                continue
+            if destinations is not None and destination not in destinations:
+                continue
+            flows[origin, destination] = flow
+        return flows
+
+    def calculate_flows(self, OD_trips:np.array, origins = None, destinations = None, _save_disaggregated=False, 
+                        engine='cvxpy', workers=None, use_cache=False, batch_size=None, keep_history=True,
+                        disaggregated_dtype=np.float64, disaggregated_layout='dense', min_flow=0, solver=None,
+                        callback=None, aggregate_destinations=False, checkpoint=None, resume=False, progress=True):
+        '''
+        Solves the circuit of every OD pair and caches the component voltages.
+        Parameters:
+        - OD_trips: the flows, either as a nested dict indexed by origin and then destination Station,
+            a NumPy array or scipy.sparse matrix indexed by origin and destination station index, or a
+            list of (origin, destination, flow) tuples, with the stations given as Station objects or indices.
+        - origins: the origin Stations to solve for, all of those in OD_trips by default.
+        - destinations: the destination Stations to solve for, all of those in OD_trips by default.
+        - min_flow: OD pairs with a flow of at most min_flow are skipped, as are OD pairs from a
+            station to itself.
+        - _save_disaggregated: whether to keep the per-OD currents of every line segment, in the FlowTensor
+            _disaggregated_currents.
+        - engine: 'cvxpy' builds and canonicalizes a new Problem for every OD pair, 'parametric'
+            compiles the network once as a DPP problem and re-solves it by changing parameter values,
+            and 'sparse' assembles the QP as scipy.sparse matrices and bypasses cvxpy altogether.
+        - solver: the solver of the engine. With the 'cvxpy' and 'parametric' engines, a cvxpy solver
+            name, or 'ACTIVE_SET' with the 'cvxpy' engine to solve every Problem with an ActiveSetSolver.
+            With the 'sparse' engine, one of SparseCircuit.SOLVERS.
+        - workers: if greater than 1, the OD pairs are solved in batches on a pool of this many processes,
+            each holding its own copy of the network, and the results are merged back in OD order.
+        - use_cache: whether to evaluate OD pairs by scaling cached unit-flow solutions. OD pairs that are
+            not cached yet are solved and added to the cache, which is cleared when the frequencies,
+            speeds or topology of the lines change. The network's disk_cache, if any, is always used
+            in the same way, after this in-memory cache.
+        - batch_size: with the 'sparse' engine, the number of OD pairs stacked into a single block-diagonal
+            QP and solved in one solver call.
+        - keep_history: whether the network components store the voltage of every OD pair in their
+            history. If False, they only keep running aggregates such as total_current.
+        - disaggregated_dtype: the dtype the disaggregated currents are stored with.
+        - disaggregated_layout: 'dense' or 'sparse', the layout of the disaggregated currents.
+        - callback: if given, it is called with the instrumentation.ODStats of every OD pair once it is
+            done, i.e. the time spent in every phase and the solver statistics. SolveStats collects and
+            summarizes them. Nothing is timed without a callback.
+        - aggregate_destinations: with the 'sparse' engine, whether to solve the OD pairs in destination
+            order, with all the origins of a destination in a single QP that is then disaggregated by
+            origin. The OD pairs whose disaggregated solution is not their own are solved separately,
+            see SparseCircuit.solve_destination, so the results are the same either way.
+        - checkpoint: a Checkpoint, or the directory of one, that the solution of every OD pair that is
+            solved is written to, in chunks of checkpoint.every OD pairs and when the run stops.
+        - resume: whether to read the OD pairs already in the checkpoint from it rather than solving
+            them again, e.g. after an interrupted run or once run_queue has solved every OD pair.
+        - progress: whether to show a progress bar.
+        Returns:
+        - the list of problems solved (or the SparseCircuit, for the 'sparse' engine), one per OD pair
+            that was not read from the cache. The list is empty when the OD pairs are solved in batches
+            or on workers.
+        Raises an optimization.UnsolvedError when the solver does not solve an OD pair, e.g. at its
+        iteration limit. The OD pairs solved before it are kept and cached, but not that one.
+        '''
+        if engine not in ('cvxpy', 'parametric', 'sparse'):
+            raise ValueError(f"Unknown engine {engine}.")
+        if batch_size is not None and engine != 'sparse':
+            raise ValueError("Batched solves are only supported by the 'sparse' engine.")
+        if aggregate_destinations and (engine != 'sparse' or batch_size is not None or (workers or 1) > 1):
+            raise ValueError("Destination-aggregated solves are only supported by the 'sparse' engine, without batches or workers.")
+        if resume and checkpoint is None:
+            raise ValueError("Resuming requires a checkpoint.")
+        if checkpoint is not None and not isinstance(checkpoint, Checkpoint):
+            checkpoint = Checkpoint(checkpoint)
+        OD_trips = self._od_flows(OD_trips, origins, destinations, min_flow)
+        od_pairs = list(OD_trips)
+
+        index = {s: i for i, s in enumerate(self.stations)}
+        if aggregate_destinations:
+            od_pairs.sort(key=lambda od: index[od[1]])
+        components = self.compile()
+        state = self._state()
+        for c in components.resistors + components.diodes:
+            c.keep_history = keep_history
+            if keep_history:
+                c.reserve(len(od_pairs))
+
+        cached = {}
+        if use_cache:
+            for origin, destination in od_pairs:
+                flow = OD_trips[origin, destination]
+                solution = self._unit_flow_cache.get(state, index[origin], index[destination], flow)
+                if solution is not None:
+                    cached[origin, destination] = solution
+        network_key = None
+        if self.disk_cache is not None:
+            network_key = self._network_key()
+            for origin, destination in od_pairs:
+                if (origin, destination) not in cached:
+                    flow = OD_trips[origin, destination]
+                    solution = self.disk_cache.get(network_key, index[origin], index[destination], flow)
+                    if solution is not None:
+                        cached[origin, destination] = solution
+        if checkpoint is not None:
+            network_key = network_key or self._network_key()
+            checkpointed = {}
+            if resume:
+                pairs = [(index[o], index[d]) for o, d in od_pairs if (o, d) not in cached]
+                checkpointed = checkpoint.load(network_key, pairs)
+            for origin, destination in od_pairs:
+                saved = checkpointed.get((index[origin], index[destination]))
+                if (origin, destination) not in cached and saved is not None and np.isclose(saved[0], OD_trips[origin, destination]):
+                    cached[origin, destination] = saved[1]
+        keep_solutions = use_cache or _save_disaggregated or self.disk_cache is not None or checkpoint is not None
 
-                disagg_od[s] = disagg_od.get(s, {})
-                disagg_od[s][line] = {+1: I_next, -1: I_prev}
+        solved = None
+        tasks = [(index[o], index[d], OD_trips[o, d]) for o, d in od_pairs if (o, d) not in cached]
+        if workers is not None and workers > 1:
+            solved = solve_parallel(self, tasks, workers, engine, solver=solver)
+        elif batch_size is not None:
+            solved = self._solve_sparse_batches(tasks, batch_size, solver)
+        elif aggregate_destinations:
+            solved = self._solve_sparse_destinations(tasks, solver)
 
-    def calculate_flows(self, OD_trips:np.array, origins = None, destinations = None, _save_disaggregated=False):
-        origins = origins or OD_trips.keys()
         problems = []
-        for origin in tqdm(origins):
-            if not destinations:
-                destinations = OD_trips[origin].keys()
-            for destination in destinations:
-                if origin == destination:
-                    continue
-                p = Problem()
-                self._build_subcircuit(origin, destination, OD_trips[origin][destination], p)
-                p.solve()
-                self._save_disaggregated(_save_disaggregated, origin, destination)
-                problems.append(p)
+        try:
+            for origin, destination in tqdm(od_pairs, disable=not progress):
+                o, d = index[origin], index[destination]
+                flow = OD_trips[origin, destination]
+                stats = None if callback is None else {}
+                solution = cached.get((origin, destination))
+                if stats is not None and solution is not None:
+                    stats['status'] = 'cached'
+                if solution is None and solved is not None:
+                    _, solution = next(solved)
+
+                if solution is not None:
+                    start = None if stats is None else perf_counter()
+                    self._cache_od_solution(origin, destination, flow, solution, components)
+                    if stats is not None:
+                        stats['cache_s'] = perf_counter() - start
+                else:
+                    problems.append(self._solve_od(origin, destination, flow, engine, solver, stats))
+                    if keep_solutions:
+                        solution = self._get_od_solution(origin, destination, components)
+
+                if use_cache and (origin, destination) not in cached:
+                    self._unit_flow_cache.put(state, o, d, flow, solution)
+                if self.disk_cache is not None and (origin, destination) not in cached:
+                    self.disk_cache.put(network_key, o, d, flow, solution)
+                if checkpoint is not None and (origin, destination) not in cached:
+                    checkpoint.add(network_key, o, d, flow, solution)
+                if _save_disaggregated:
+                    start = None if stats is None else perf_counter()
+                    self._save_disaggregated(o, d, solution, disaggregated_dtype, disaggregated_layout)
+                    if stats is not None:
+                        stats['save_s'] = perf_counter() - start
+                if callback is not None:
+                    callback(ODStats(o, d, flow, engine, **stats))
+        finally:
+            # Keep the OD pairs solved since the last chunk, also when the run is interrupted.
+            if checkpoint is not None:
+                checkpoint.flush()
         return problems
 
-    def reset(self):
-        """Resets all component histories in the network."""
-        for station in self.stations:
-            for line in station.lines:
-                for direction in (-1, +1):
-                    segment = station.lines[line][direction]
+    def run_queue(self, queue, checkpoint, max_shards=None, keep_history=False, heartbeat_s=60, **kwargs) -> int:
+        '''
+        Solves shards of OD pairs from a work queue until it is empty, checkpointing their solutions, so
+        that independent processes can share a run. Every process runs, e.g.
+            tn.run_queue(WorkQueue(directory), checkpoint_directory, engine='sparse')
+        on its own copy of the network, after one of them has filled the queue with WorkQueue.put, and
+        calculate_flows(OD_trips, checkpoint=checkpoint_directory, resume=True) then reads every
+        solution from the checkpoint into the network. A shard that was checkpointed in part before
+        its process stopped only has its other OD pairs solved once it is requeued, see
+        WorkQueue.requeue_stale. Only requeued shards are resumed, and the checkpoint only reads the
+        chunk files written since it last did. The trips of every shard are dropped once it is done,
+        and those of earlier calls kept.
+        Parameters:
+        - queue: a WorkQueue, or the directory of one.
+        - checkpoint: a Checkpoint, or the directory of one, shared by every process.
+        - max_shards: if given, at most this many shards are solved.
+        - keep_history: see calculate_flows. Only the checkpoint is kept, so histories are off by default.
+        - heartbeat_s: how often a claimed shard is touched while it is solved, see WorkQueue.heartbeat.
+        - kwargs: passed on to calculate_flows, e.g. engine and solver.
+        Returns:
+        - the number of shards solved.
+        '''
+        if not isinstance(queue, WorkQueue):
+            queue = WorkQueue(queue)
+        if not isinstance(checkpoint, Checkpoint):
+            checkpoint = Checkpoint(checkpoint)
+        n = 0
+        while max_shards is None or n < max_shards:
+            claimed = queue.claim()
+            if claimed is None:
+                break
+            name, tasks = claimed
+            trips = {origin: dict(destinations) for origin, destinations in self.trips.items()}
+            with queue.heartbeat(name, heartbeat_s):
+                self.calculate_flows(tasks, checkpoint=checkpoint, resume=queue.requeued(name),
+                                     keep_history=keep_history, **kwargs)
+            for origin, destinations in self.trips.items():
+                destinations.clear()
+                destinations.update(trips.get(origin, {}))
+            queue.complete(name)
+            n += 1
+        return n
 
-                    # Reset line segment components
-                    if segment.tt_resistor:
-                        segment.tt_resistor.reset()
-                    segment.td_diode.reset()
+    def iter_flows(self, OD_trips, origins=None, destinations=None, engine='sparse', solver=None, workers=None,
+                   batch_size=None, min_flow=0):
+        '''
+        Solves the circuit of every OD pair and yields its ODFlow as soon as it is solved, keeping neither
+        the problems, the trips nor the component histories, so that memory does not grow with the
+        number of OD pairs.
+        Parameters:
+        - OD_trips, origins, destinations, min_flow: the OD pairs to solve, see calculate_flows.
+        - engine, solver, workers, batch_size: how to solve them, see calculate_flows. The 'sparse'
+            engine leaves the network untouched, while the other engines still cache the voltages of
+            every OD pair into the running totals of the components, as calculate_flows does with
+            keep_history=False, and restore keep_history and the trips of earlier calls once done.
+        Returns:
+        - a generator of the ODFlow of every OD pair, in OD order. The network's disk_cache, if any, is
+            read and written like in calculate_flows.
+        '''
+        if engine not in ('cvxpy', 'parametric', 'sparse'):
+            raise ValueError(f"Unknown engine {engine}.")
+        if batch_size is not None and engine != 'sparse':
+            raise ValueError("Batched solves are only supported by the 'sparse' engine.")
+        OD_trips = self._od_flows(OD_trips, origins, destinations, min_flow)
+        index = {s: i for i, s in enumerate(self.stations)}
+        components = self.compile()
+        network_key = None if self.disk_cache is None else self._network_key()
 
-                # Reset transfer components
-                for transfer_dict in [station._transfer_resistors, station._transfer_diodes]:
-                    for components in transfer_dict[line][direction].values():
-                        for component in components.values():
-                            component.reset()
+        cached = {}
+        if self.disk_cache is not None:
+            for (origin, destination), flow in OD_trips.items():
+                solution = self.disk_cache.get(network_key, index[origin], index[destination], flow)
+                if solution is not None:
+                    cached[origin, destination] = solution
+
+        tasks = [(index[o], index[d], flow) for (o, d), flow in OD_trips.items() if (o, d) not in cached]
+        solved = None
+        if workers is not None and workers > 1:
+            solved = solve_parallel(self, tasks, workers, engine, solver=solver)
+        elif batch_size is not None:
+            solved = self._solve_sparse_batches(tasks, batch_size, solver)
+
+        # Only the 'cvxpy' and 'parametric' engines cache voltages into the components in this process.
+        history = [(c, c.keep_history) for c in components.resistors + components.diodes]
+        if solved is None and engine != 'sparse':
+            for c, _ in history:
+                c.keep_history = False
+        try:
+            for (origin, destination), flow in OD_trips.items():
+                o, d = index[origin], index[destination]
+                solution, status = cached.get((origin, destination)), 'cached'
+                if solution is None and solved is not None:
+                    (_, solution), status = next(solved), None
+                elif solution is None and engine == 'sparse':
+                    circuit = self._get_sparse_circuit(solver)
+                    v, status = circuit.solve(o, d, flow)
+                    check_solved(status, f"OD pair ({o}, {d})")
+                    solution = circuit.get_od_solution(v, o, d)
+                elif solution is None:
+                    stats = {}
+                    previous = self.trips[origin].get(destination)
+                    self._solve_od(origin, destination, flow, engine, solver, stats)
+                    solution, status = self._get_od_solution(origin, destination, components), stats['status']
+                    # Put back the trip of an earlier calculate_flows, if any.
+                    if previous is None:
+                        del self.trips[origin][destination]
+                    else:
+                        self.trips[origin][destination] = previous
+
+                if self.disk_cache is not None and (origin, destination) not in cached:
+                    self.disk_cache.put(network_key, o, d, flow, solution)
+                yield ODFlow(o, d, flow, components.segment_currents(solution.v_resistors), solution.travel_time(), status)
+        finally:
+            for c, keep_history in history:
+                c.keep_history = keep_history
+
+    def frequency_sensitivities(self, OD_trips, origins=None, destinations=None, lines=None, solver=None, min_flow=0):
+        '''
+        Computes the derivatives of the segment currents and of the total travel time with respect to the
+        frequency of every line, at the current frequencies. Every OD pair is solved with the 'sparse'
+        engine and differentiated through its KKT conditions, see SparseCircuit.voltage_sensitivities,
+        which costs about one more linear solve per OD pair for all the lines together. The derivatives
+        hold as long as the set of conducting diodes does not change.
+        Parameters:
+        - OD_trips, origins, destinations, min_flow: the OD pairs, see calculate_flows.
+        - lines: the lines to differentiate with respect to, all of them by default.
+        - solver: the solver of the 'sparse' engine.
+        Returns:
+        - d_segment_currents: array with the derivative of the total current of every segment with
+            respect to the frequency of every line in vehicles per hour, one row per line.
+        - d_travel_time: array with the derivative of the total travel time of all OD pairs, in
+            rider-minutes, with respect to the frequency of every line, see ODSolution.travel_time.
+        '''
+        OD_trips = self._od_flows(OD_trips, origins, destinations, min_flow)
+        _, d_segment_currents, d_travel_time = self._frequency_gradient(OD_trips, lines, solver)
+        return d_segment_currents, d_travel_time
+
+    def _frequency_gradient(self, OD_trips:dict, lines=None, solver=None):
+        '''
+        Solves every OD pair of a dict of flows, and returns the total travel time and the derivatives
+        of frequency_sensitivities.
+        '''
+        compiled = self.compile()
+        circuit = self._get_sparse_circuit(solver)
+        lines = self.lines if lines is None else lines
+        line_index = [compiled.lines.index(line) for line in lines]
+        index = {s: i for i, s in enumerate(self.stations)}
+
+        # Transfer and origin conductances are 2 * frequency_vpm, i.e. proportional to the frequency.
+        transfer_line = compiled.segment_line[compiled.transfer_to]
+        rows, cols, data = [], [], []
+        for i, (l, line) in enumerate(zip(line_index, lines)):
+            r = compiled.transfer_resistor[transfer_line == l]
+            rows.append(np.full(len(r), i))
+            cols.append(r)
+            data.append(compiled.resistor_C[r] / (60 * line.frequency_vpm))
+        dG = sp.csr_matrix(
+            (np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+            shape=(len(lines), len(compiled.resistors)),
+        )
+        frequency_vph = 60 * np.array([line.frequency_vpm for line in lines])
+
+        travel_time = 0.
+        d_segment_currents = np.zeros((len(lines), compiled.n_segments))
+        d_travel_time = np.zeros(len(lines))
+        has_resistor = np.maximum(compiled.segment_resistor, 0)
+        for (origin, destination), flow in OD_trips.items():
+            o, d = index[origin], index[destination]
+            v, status = circuit.solve(o, d, flow)
+            check_solved(status, f"OD pair ({o}, {d})")
+            segment_line = compiled.segment_line[compiled.station_segments[o]]
+            dG_origin = (segment_line == np.array(line_index)[:, None]) * compiled.station_origin_C[o] / frequency_vph[:, None]
+            dv = circuit.voltage_sensitivities(v, o, d, dG, dG_origin, circuit.conducting)
+
+            A_o = circuit._origin_incidence(o)
+            dv_resistors = dv @ circuit.A_R.T
+            d_segment_currents += compiled.segment_C * dv_resistors[:, has_resistor]
+            d_travel_time += dv_resistors @ np.sign(circuit.A_R @ v) + (dv @ A_o.T) @ np.sign(A_o @ v)
+            travel_time += circuit.get_od_solution(v, o, d).travel_time()
+        return travel_time, d_segment_currents, d_travel_time
+
+    def fleet_size(self, line:Line) -> float:
+        '''
+        Returns the number of vehicles a line needs to run at its frequency, i.e. its frequency times the
+        time a vehicle takes to run the line in both directions.
+        '''
+        return line.frequency_vpm * self._cycle_time_m(line)
+
+    def _cycle_time_m(self, line:Line):
+        length_km = sum(self.D[a.id, b.id] for a, b in zip(line.stations[:-1], line.stations[1:]))
+        return 2 * length_km / line.avg_speed_kpm
+
+    def design_frequencies(self, OD_trips, fleet_size=None, lines=None, min_frequency_vph=1, max_frequency_vph=None,
+                           max_iter=20, tol=1e-4, solver=None, min_flow=0):
+        '''
+        Chooses the frequencies of lines that minimize the total travel time of an OD matrix, under a
+        budget on their fleet size, and updates the lines to them.
+        The travel time is not convex in the frequencies, so rather than a single problem with variable
+        conductances, it runs projected gradient descent, with the gradients of frequency_sensitivities:
+        every iteration solves the OD matrix once, and projects a gradient step onto the budget with a
+        small cvxpy problem. Steps that do not decrease the travel time are halved.
+        Parameters:
+        - OD_trips, min_flow: the OD pairs, see calculate_flows.
+        - fleet_size: the vehicles the lines can use together, see fleet_size, and by default the ones
+            they use at their current frequencies. A budget of vehicle-hours over a service period is a
+            fleet size of the vehicle-hours divided by the hours of the period.
+        - lines: the lines to design, all of them by default. The other lines keep their frequency.
+        - min_frequency_vph, max_frequency_vph: the bounds of the frequencies, in vehicles per hour.
+        - max_iter: the maximum number of iterations.
+        - tol: the iterations stop once they decrease the travel time by less than tol, relatively.
+        - solver: the solver of the 'sparse' engine.
+        Returns:
+        - frequency_vph: array with the frequency of every designed line, in vehicles per hour.
+        - travel_times: the total travel time of every accepted iteration, starting with the initial
+            frequencies projected onto the budget.
+        '''
+        OD_trips = self._od_flows(OD_trips, min_flow=min_flow)
+        lines = self.lines if lines is None else lines
+        # Vehicles per vehicle per hour of frequency, so that the fleet size is w @ frequency_vph.
+        w = np.array([self._cycle_time_m(line) / 60 for line in lines])
+        frequency_vph = 60 * np.array([line.frequency_vpm for line in lines])
+        if fleet_size is None:
+            fleet_size = w @ frequency_vph
+
+        y = cp.Parameter(len(lines))
+        x = cp.Variable(len(lines))
+        constraints = [w @ x <= fleet_size, x >= min_frequency_vph]
+        if max_frequency_vph is not None:
+            constraints.append(x <= max_frequency_vph)
+        projection = cp.Problem(cp.Minimize(cp.sum_squares(x - y)), constraints)
+        def project(frequency_vph):
+            y.value = frequency_vph
+            projection.solve()
+            if x.value is None:
+                raise ValueError("The fleet size cannot run every line at its minimum frequency.")
+            return np.maximum(x.value, min_frequency_vph)
+
+        def evaluate(frequency_vph):
+            for line, f in zip(lines, frequency_vph):
+                self.update_frequency(line, f)
+            travel_time, _, gradient = self._frequency_gradient(OD_trips, lines, solver)
+            return travel_time, gradient
+
+        frequency_vph = project(frequency_vph)
+        travel_time, gradient = evaluate(frequency_vph)
+        travel_times = [travel_time]
+        step = 0.1 * frequency_vph.mean() / max(np.abs(gradient).max(), 1e-12)
+        for _ in range(max_iter):
+            candidate = project(frequency_vph - step * gradient)
+            if np.linalg.norm(candidate - frequency_vph) <= tol * np.linalg.norm(frequency_vph):
+                break
+            candidate_time, candidate_gradient = evaluate(candidate)
+            if candidate_time >= travel_time:
+                step /= 2
+                continue
+
+            decrease = (travel_time - candidate_time) / travel_time
+            frequency_vph, travel_time, gradient = candidate, candidate_time, candidate_gradient
+            travel_times.append(travel_time)
+            step *= 1.5
+            if decrease < tol:
+                break
+
+        for line, f in zip(lines, frequency_vph):
+            self.update_frequency(line, f)
+        return frequency_vph, travel_times
+
+    def reset(self):
+        """Resets all component histories in the network."""
+        compiled = self.compile()
+        for component in compiled.resistors + compiled.diodes:
+            component.reset()
 
         # Reset trip components
         for origin in self.trips:
@@ -298,30 +997,64 @@ class TransitNetwork():
                         component.reset()
                     trip._current_source.reset()
         
-        self._disaggregated_currents = {}
+        self._disaggregated_currents = None
 
     def update_headway(self, line: Line, headway_mpv):
         frequency_vph = 60/headway_mpv
         self.update_frequency(line=line, frequency_vph=frequency_vph)
     
     def update_frequency(self, line:Line, frequency_vph):
+        '''
+        Updates the frequency of a line in place. Only the components that depend on the line are
+        touched: the transfer resistors boarding it, and the origin resistors of the trips from its stations.
+        '''
         if isinstance(line, Line):
             line._update_frequency(frequency_vph)
         else:
             raise ValueError("Pass a Line object, not a line id.")
         
-        for o, trips_o in self.trips.items():
-            for d, trips_od in self.trips[o].items():
-                if o == d or trips_od is None: continue
-                trips_od._update_frequency()
+        for o in line.stations:
+            for trips_od in self.trips.get(o, {}).values():
+                trips_od._update_frequency(line)
+
+        self._update_line(line)
+
+    def update_speed(self, line:Line, avg_speed_kph):
+        '''
+        Updates the average speed of a line in place, along with the travel time resistors of its segments.
+        '''
+        if isinstance(line, Line):
+            line._update_speed(avg_speed_kph)
+        else:
+            raise ValueError("Pass a Line object, not a line id.")
+
+        self._update_line(line)
+
+    def _update_line(self, line:Line):
+        '''
+        Propagates a change of a line's frequency or speed to the compiled network and the engines built
+        on it, without rebuilding them.
+        '''
+        if self._compiled is not None:
+            rows, old_C = self._compiled.update_line(line)
+            if self._sparse_circuit is not None:
+                self._sparse_circuit.update_conductance(rows, old_C)
+            if self._parametric_problem is not None:
+                self._parametric_problem.update_conductance(rows, self._compiled.resistor_C[rows])
+        self._unit_flow_cache.clear()
     
     def save_state(self, filename="transit_network_state.json"):
         """
         Saves the current state of the transit network to a text file.
         
         Parameters:
-        - filename (str): Name of the file to save the state.
+        - filename (str): Name of the file to save the state. If it ends with .npz, the state is saved
+            in the binary format of _save_state_npz instead, which also keeps the solved currents.
         """
+        if str(filename).endswith('.npz'):
+            network_state = self._save_state_npz(filename)
+            print(f"Transit network state saved to {filename}.")
+            return network_state
 
         # Prepare station data
         station_data = [{
@@ -361,4 +1094,98 @@ class TransitNetwork():
             json.dump(network_state, file, indent=4)
 
         print(f"Transit network state saved to {filename}.")
-        return network_state
\ No newline at end of file
+        return network_state
+
+    def _save_state_npz(self, filename):
+        '''
+        Saves the topology, distance matrix, speeds and frequencies of the network, its trips, and the
+        currents solved so far, i.e. the total current of every resistor and segment and, if they were
+        saved, the per-OD segment currents, as the uncompressed arrays of an .npz file.
+        '''
+        index = {s: i for i, s in enumerate(self.stations)}
+        compiled = self.compile()
+        trips = [(index[o], index[d], t.flow) for o, ds in self.trips.items() for d, t in ds.items() if t]
+        arrays = {
+            'station_ids': np.array([s.id for s in self.stations]),
+            'station_xy': np.array([[np.nan if s.x is None else s.x, np.nan if s.y is None else s.y] for s in self.stations], dtype=float),
+            'line_ids': np.array([line.id for line in self.lines]),
+            'line_stations': np.array([index[s] for line in self.lines for s in line.stations], dtype=np.int64),
+            'line_indptr': np.cumsum([0] + [len(line.stations) for line in self.lines]),
+            'line_avg_speed_kpm': np.array([line.avg_speed_kpm for line in self.lines], dtype=float),
+            'line_frequency_vpm': np.array([line.frequency_vpm for line in self.lines], dtype=float),
+            'D': np.asarray(self.D),
+            'compact_transfers': np.array(self.compact_transfers),
+            'trip_od': np.array([t[:2] for t in trips], dtype=np.int64).reshape(-1, 2),
+            'trip_flow': np.array([t[2] for t in trips], dtype=float),
+            'resistor_total_current': np.array([r.total_current for r in compiled.resistors], dtype=float),
+            'segment_currents': compiled.total_segment_currents(),
+        }
+        if self._disaggregated_currents is not None:
+            for name, array in self._disaggregated_currents.to_arrays().items():
+                arrays[f'od_currents_{name}'] = array
+        np.savez(filename, **arrays)
+        return arrays
+
+    @classmethod
+    def load_state(cls, filename, D=None, compact_transfers=False, disk_cache=None):
+        '''
+        Loads a network saved with save_state.
+        Parameters:
+        - filename: the .npz or JSON file. An .npz file restores the network along with the currents
+            it had solved, so that they can be queried without solving again. A JSON file only holds
+            the stations, lines and trips, and its trips are not solved.
+        - D: the distance matrix, only needed for JSON files, which do not store it.
+        - compact_transfers: with JSON files, whether to build compact transfers. .npz files store it.
+        - disk_cache: see the constructor.
+        Returns:
+        - the TransitNetwork.
+        '''
+        if not str(filename).endswith('.npz'):
+            return cls._load_state_json(filename, D, compact_transfers, disk_cache)
+
+        with np.load(filename) as data:
+            stations = [
+                Station(id, *(None if np.isnan(c) else c.item() for c in xy))
+                for id, xy in zip(data['station_ids'].tolist(), data['station_xy'])
+            ]
+            indptr, line_stations = data['line_indptr'], data['line_stations']
+            lines = []
+            for i, (id, kpm, vpm) in enumerate(zip(data['line_ids'].tolist(), data['line_avg_speed_kpm'], data['line_frequency_vpm'])):
+                line = Line(id, [stations[k] for k in line_stations[indptr[i]:indptr[i+1]]], frequency_vph=60)
+                # The speed and frequency are set as saved, so that they compare equal to the saved state.
+                line.avg_speed_kpm, line.frequency_vpm = float(kpm), float(vpm)
+                lines.append(line)
+
+            tn = cls(data['D'], stations, lines, bool(data['compact_transfers']), disk_cache)
+            for (o, d), flow in zip(data['trip_od'].tolist(), data['trip_flow'].tolist()):
+                tn.trips[stations[o]][stations[d]] = Trip(stations[o], stations[d], flow)
+            for r, total in zip(tn.compile().resistors, data['resistor_total_current'].tolist()):
+                r.total_current = total
+
+            od_arrays = {name[len('od_currents_'):]: data[name] for name in data.files if name.startswith('od_currents_')}
+            if od_arrays:
+                tn._disaggregated_currents = FlowTensor.from_arrays(od_arrays)
+        return tn
+
+    @classmethod
+    def _load_state_json(cls, filename, D, compact_transfers=False, disk_cache=None):
+        if D is None:
+            raise ValueError("JSON states do not store the distance matrix, pass it as D.")
+        with open(filename) as file:
+            state = json.load(file)
+
+        stations = [Station(s['id'], s['x'], s['y']) for s in state['stations']]
+        by_id = {s.id: s for s in stations}
+        lines = []
+        for l in state['lines']:
+            # Older states store the speed and frequency per hour.
+            line = Line(l['id'], [by_id[i] for i in l['stations']], l.get('avg_speed', 10), frequency_vph=l.get('frequency', 60))
+            if 'avg_speed_kpm' in l:
+                line.avg_speed_kpm, line.frequency_vpm = l['avg_speed_kpm'], l['frequency_vpm']
+            lines.append(line)
+
+        tn = cls(D, stations, lines, compact_transfers, disk_cache)
+        for t in state['trips']:
+            origin, destination = by_id[t['origin']], by_id[t['destination']]
+            tn.trips[origin][destination] = Trip(origin, destination, t['flow'])
+        return tn
@@ -162,8 +162,11 @@ class TransitNetworkPlotter:
         - node_font_size (int): Font size for station labels
         - round (int): Number of decimal places for labels
         """
+        tn = self.transit_network
+        currents = tn.compile().total_segment_currents()
+
         def get_flow(line, station, direction):
-            return station.lines[line][direction].tt_resistor.total_current
+            return currents[tn.get_segment_index(station, line, direction)]
 
         ax = self._plot_network(ax=ax, directed=True, edge_data=get_flow, line_styles=None, 
                                 arrowstyle='simple', label_edges=True, round_val=round, rad=0.2, 
@@ -176,8 +179,12 @@ class TransitNetworkPlotter:
                              label_fraction=LABEL_FRACTION, node_size=NODE_SIZE, node_font_size=NODE_FONT_SIZE,
                              round=ROUND_VAL, add_legend=ADD_LEGEND):
         
+        tn = self.transit_network
+        o, d = tn.stations.index(origin), tn.stations.index(destination)
+        currents = tn._disaggregated_currents.get_od(o, d)
+
         def get_flow(line, station, direction):
-            return self.transit_network._disaggregated_currents[origin][destination][station][line][direction]
+            return currents[tn.get_segment_index(station, line, direction)]
         
         ax = self._plot_network(ax=ax, directed=True, edge_data=get_flow, line_styles=None, 
                                 arrowstyle='simple', label_edges=True, round_val=round, rad=0.2, 
@@ -190,11 +197,11 @@ class TransitNetworkPlotter:
                              label_fraction=LABEL_FRACTION, node_size=NODE_SIZE, node_font_size=NODE_FONT_SIZE,
                              round=ROUND_VAL, add_legend=ADD_LEGEND):
         
+        tn = self.transit_network
+        currents = tn._disaggregated_currents.total(origins=[tn.stations.index(origin)])
+
         def get_flow(line:Line, station:Station, direction):
-            return np.sum([
-                self.transit_network._disaggregated_currents[origin][d][station][line][direction]
-                for d in self.transit_network._disaggregated_currents[origin].keys()
-            ])
+            return currents[tn.get_segment_index(station, line, direction)]
         
         ax = self._plot_network(ax=ax, directed=True, edge_data=get_flow, line_styles=None, 
                                 arrowstyle='simple', label_edges=True, round_val=round, rad=0.2, 
@@ -207,11 +214,11 @@ class TransitNetworkPlotter:
                              label_fraction=LABEL_FRACTION, node_size=NODE_SIZE, node_font_size=NODE_FONT_SIZE,
                              round=ROUND_VAL, add_legend=ADD_LEGEND):
         
+        tn = self.transit_network
+        currents = tn._disaggregated_currents.total(destinations=[tn.stations.index(destination)])
+
         def get_flow(line:Line, station:Station, direction):
-            return np.sum([
-                self.transit_network._disaggregated_currents[o][destination][station][line][direction]
-                for o in self.transit_network._disaggregated_currents.keys()
-            ])
+            return currents[tn.get_segment_index(station, line, direction)]
         
         ax = self._plot_network(ax=ax, directed=True, edge_data=get_flow, line_styles=None, 
                                 arrowstyle='simple', label_edges=True, round_val=round, rad=0.2, 